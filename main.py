@@ -11,15 +11,45 @@ import datetime
 import re
 import os
 import pickle
+import sqlite3
 import logging
-from typing import Dict, List, Optional, Tuple, Any
+import argparse
+import time
+import functools
+import heapq
+import bisect
+import hashlib
+import random
+import multiprocessing
+import threading
+import traceback
+import sys
+import tempfile
+import tracemalloc
+import gc
+import shutil
+import inspect
+import signal
+import copy
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple, Any, Callable
 from pathlib import Path
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from array import array
 from enum import Enum
-from vkbottle import Bot, Message
+from aiohttp import web, ClientSession
+from vkbottle import API, ABCHTTPClient, Bot, Message
 from vkbottle.bot import BotLabeler
+from vkbottle_types.categories import APICategories
 from vkbottle_types.codegen.objects import UsersUserFull
 VKBOTTLE_AVAILABLE = True
 
+try:
+    import resource  # Пиковая память процесса (нет в Windows)
+except ImportError:
+    resource = None
+
 
 # ============= КОНФИГУРАЦИЯ =============
 # ↓↓↓ ЗДЕСЬ НАСТРОЙТЕ СВОЙ БОТ ↓↓↓
@@ -31,29 +61,214 @@ GROUP_ID = 235638129  # ID вашего сообщества (опциональ
 COMMAND_PREFIXES = ["/", "!"]
 ADMIN_IDS = [681391232]  # ID суперадминов (будут иметь все права)
 
-# Автосоздание папки для данных
+# Папка для данных (создаётся при запуске)
 DATA_FOLDER = "grand_data"
-if not os.path.exists(DATA_FOLDER):
-    os.makedirs(DATA_FOLDER)
+
+# Хранилище данных: "sqlite" (таблицы по сущностям), "shards" (файл на каждый чат)
+# или "pickle" (снимок + журнал). sqlite и shards читают с диска только нужные чаты;
+# pickle держит в памяти сериализованные копии всех чатов, и память и время запуска
+# растут с числом чатов. Существующий pickle-снимок переносится в sqlite/shards
+# при первом запуске
+STORAGE_BACKEND = "sqlite"
+
+# Выгрузка неактивных чатов из памяти (чаты загружаются по требованию)
+CHAT_IDLE_EVICT = 3600   # секунд без обращений до выгрузки чата
+# Предел в чатах, а не в байтах: чат занимает от единиц до сотен КБ
+# в зависимости от числа участников и истории активности
+CHAT_CACHE_MAX = 5000    # максимум чатов в памяти
+
+# Экспорт базы в JSON для чтения человеком (вне пути записи)
+JSON_EXPORT_FOLDER = f"{DATA_FOLDER}/export"
+JSON_EXPORT_INTERVAL = 0  # секунд между автоэкспортами, 0 - только по команде /export
+
+# Кэш участников бесед (для проверки прав админа)
+MEMBERS_CACHE_TTL = 60        # секунд
+MEMBERS_CACHE_SIZE = 5000     # бесед в кэше
+MEMBERS_ERROR_TTL = 30        # секунд, пока не повторяется неудачный запрос (бот не админ беседы)
+
+# Кэш профилей пользователей (имена для упоминаний и списков)
+USER_CACHE_SIZE = 20000     # профилей в памяти
+USER_CACHE_TTL = 3600       # секунд
+USER_BATCH_WINDOW = 0.01    # секунд на сбор запросов в один users.get
+
+# Объединение вызовов API в один execute (ответы, удаления, кики)
+API_BATCH_WINDOW = 0.05   # секунд на сбор вызовов в пачку
+EXECUTE_MAX_CALLS = 25    # лимит VK на число вызовов внутри execute
+
+# Рассылка по всем чатам (уведомления о глобальном бане)
+BROADCAST_RATE = 20              # запросов к API в секунду (лимит VK для сообществ)
+BROADCAST_CONCURRENCY = 5        # одновременных запросов
+BROADCAST_PEERS_PER_CALL = 100   # получателей в одном messages.send
+BROADCAST_RETRIES = 3            # повторов при ошибке
+BROADCAST_PROGRESS_INTERVAL = 10 # секунд между отчётами о ходе рассылки
+
+# Агрегация активности: счётчики сообщений копятся в памяти и пачкой
+# переносятся в данные чатов (unity_scores, last_messages, daily_stats)
+ACTIVITY_ROLLUP_INTERVAL = 60  # секунд между переносами
+ACTIVITY_KEEP_DAYS = 35        # дней истории в daily_stats
+
+# Антифлуд (пороги задаются в настройках каждого чата, см. DEFAULT_SETTINGS)
+FLOOD_MAX_MESSAGES = 50   # верхняя граница порога сообщений для /antiflood
+FLOOD_MAX_SECONDS = 60    # верхняя граница окна (секунд) для /antiflood
+FLOOD_FORGET_AFTER = 300  # секунд тишины до удаления счётчиков пользователя
+
+# Получение событий: "polling" (Long Poll) или "callback" (Callback API - HTTP-сервер,
+# можно ставить несколько экземпляров за балансировщиком)
+EVENTS_MODE = "polling"
+CALLBACK_HOST = "0.0.0.0"
+CALLBACK_PORT = 8080
+CALLBACK_PATH = "/callback"
+CALLBACK_CONFIRMATION = ""  # строка подтверждения из настроек Callback API сообщества
+CALLBACK_SECRET = ""        # секретный ключ из настроек Callback API
+CALLBACK_WORKERS = 16       # обработчиков очереди событий
+CALLBACK_QUEUE_SIZE = 10000 # событий в очереди; при переполнении VK получит ошибку и повторит
+
+# Очереди событий: события одного чата обрабатываются строго по порядку,
+# разные чаты - параллельно
+EVENT_CONCURRENCY = 64     # чатов, обрабатываемых одновременно
+EVENT_QUEUE_SIZE = 20000   # событий в очередях всего; при заполнении приём приостанавливается
+CHAT_QUEUE_SIZE = 200      # событий в очереди чата; при переполнении выбрасываются старые обычные сообщения
+CHAT_BATCH = 20            # событий чата подряд, после чего очередь уступается другим чатам
+EVENT_STALE_AFTER = 60     # секунд ожидания, после которых обычное сообщение устарело
+
+# Многопроцессный режим: супервизор принимает события и раздаёт их воркерам,
+# каждый воркер владеет своей частью чатов и своим разделом базы
+WORKER_PROCESSES = 0        # 0 - всё в одном процессе
+WORKER_RING_REPLICAS = 64   # виртуальных узлов воркера в кольце консистентного хеширования
+WORKER_OUTBOX_SIZE = 5000   # событий в очереди отправки воркеру; при заполнении обычные сообщения выбрасываются
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics
+# (воркер N многопроцессного режима - на порту METRICS_PORT + 1 + N)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0      # 0 - не запускать сервер метрик (например, 9464; 9100 обычно занят node_exporter)
+
+# Профилирование: выборочный профилировщик (команда /prof) пишет стеки
+# в DATA_FOLDER в формате folded для flamegraph; медленные шаги - в лог
+PROFILE_ON_START = 0           # секунд профилирования сразу после запуска, 0 - выключено
+PROFILE_INTERVAL = 0.005       # секунд между выборками стека
+PROFILE_MAX_SECONDS = 600      # верхняя граница длительности для /prof
+SLOW_HANDLER_THRESHOLD = 0.5   # секунд; более долгие обработчики пишутся в лог
+SLOW_CALLBACK_THRESHOLD = 0.1  # секунд; дольше этого цикл событий не должен быть занят
+
+# Журнал изменений БД: вместо полной перезаписи базы на каждое изменение
+# изменения копятся в памяти и пачкой дописываются в журнал
+JOURNAL_FLUSH_INTERVAL = 1.0           # секунд между сбросами журнала
+JOURNAL_FLUSH_THRESHOLD = 500          # изменений до внеочередного сброса
+JOURNAL_COMPACT_SIZE = 16 * 1024 * 1024  # размер журнала (байт) для компактизации
+SNAPSHOT_INTERVAL = 300                # секунд между полными снимками базы
+
+# Бенчмарк (--bench COUNT): синтетический трафик через настоящие обработчики,
+# VK API заменяется заглушкой в процессе, база создаётся во временной папке
+BENCH_CHATS = 200            # чатов с трафиком
+BENCH_USERS_PER_CHAT = 100   # участников в каждом чате
+BENCH_DB_CHATS = 1000        # чатов в базе всего (остальные без трафика)
+BENCH_RATE = 0               # сообщений в секунду, 0 - без ограничения
+BENCH_API_LATENCY = 0.03     # секунд на ответ заглушки VK API
+BENCH_COMMAND_SHARE = 0.02   # доля команд модерации (/warn, /mute, /ban)
+BENCH_BANNED_SHARE = 0.05    # доля забаненных участников чата
+BENCH_MUTED_SHARE = 0.05     # доля замученных участников чата
+BENCH_HISTORY_DAYS = 7       # суток daily_stats в чатах для --bench-memory
 
 # ↑↑↑ НАСТРОЙКИ ЗАВЕРШЕНЫ ↑↑↑
 # ======================================
 
-# Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+# Обработчики регистрируются при импорте, бот и база создаются при запуске
 labeler = BotLabeler()
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(f"{DATA_FOLDER}/grand.log"),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger("GRAND")
 
+# Объекты, которые создаются при первом обращении (см. Application)
+LAZY_GLOBALS = ("bot", "db", "json_exporter")
+
+class Application:
+    """Сборка тяжёлых объектов бота по требованию
+    
+    Импорт модуля ничего не читает с диска и не открывает соединений:
+    логирование, база и клиент VK создаются в start() или при первом
+    обращении к main.db / main.bot извне. Запуск идёт по фазам, время
+    каждой фазы записывается в timings.
+    """
+    
+    def __init__(self):
+        self.timings: List[Tuple[str, float]] = []
+        self._logging_ready = False
+        self._stopped = False
+    
+    def timed(self, phase: str, action):
+        """Выполнить фазу запуска и записать её длительность"""
+        started = time.perf_counter()
+        result = action()
+        self.timings.append((phase, time.perf_counter() - started))
+        return result
+    
+    def setup_logging(self):
+        """Создать папку данных и настроить логирование (один раз)"""
+        if self._logging_ready:
+            return
+        self._logging_ready = True
+        os.makedirs(DATA_FOLDER, exist_ok=True)
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            handlers=[
+                logging.FileHandler(f"{DATA_FOLDER}/grand.log"),
+                logging.StreamHandler()
+            ]
+        )
+    
+    def build(self, name: str):
+        """Создать объект модуля и сохранить его в глобальную переменную"""
+        module_globals = globals()
+        if name in module_globals:
+            return module_globals[name]
+        
+        self.setup_logging()
+        if name == "db":
+            # Индекс базы: разделы верхнего уровня, список чатов, муты; чаты - по требованию
+            value = self.timed("индекс базы", Database)
+        elif name == "bot":
+            value = self.timed("клиент VK", lambda: Bot(api=InstrumentedAPI(BOT_TOKEN), labeler=labeler))
+        elif name == "json_exporter":
+            value = JsonExporter(self.build("db"))
+        else:
+            raise AttributeError(name)
+        module_globals[name] = value
+        return value
+    
+    def start(self):
+        """Создать всё, что нужно для работы бота"""
+        self.timed("логирование", self.setup_logging)
+        for name in LAZY_GLOBALS:
+            self.build(name)
+    
+    def stop(self):
+        """Записать изменения из памяти и закрыть базу - при любом завершении процесса
+        
+        Активность переносится в базу раз в ACTIVITY_ROLLUP_INTERVAL, журнал
+        пишется пачками по таймеру, поэтому без этого шага остановка теряет
+        всё накопленное с последнего переноса и записи.
+        """
+        if self._stopped or "db" not in globals():
+            return
+        self._stopped = True
+        activity_aggregator.rollup()
+        db.save()
+        db.close()
+        logger.info("💾 Данные сохранены")
+    
+    def report(self) -> str:
+        """Длительность запуска по фазам"""
+        total = sum(seconds for _, seconds in self.timings)
+        phases = ", ".join(f"{phase} {seconds * 1000:.0f} мс" for phase, seconds in self.timings)
+        return f"{total * 1000:.0f} мс ({phases})"
+
+app = Application()
+
+def __getattr__(name: str):
+    # main.db, main.bot и т.п. снаружи модуля до app.start()
+    if name in LAZY_GLOBALS:
+        return app.build(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 # Константы
 MUTE_DURATIONS = {
     "15m": 15, "30m": 30, "1h": 60, "3h": 180, "6h": 360,
@@ -64,22 +279,1282 @@ DEFAULT_SETTINGS = {
     "auto_welcome": True,
     "welcome_message": "Добро пожаловать в беседу, {user}!",
     "anti_flood": True,
+    "flood_messages": 5,       # сообщений в окне до срабатывания антифлуда
+    "flood_seconds": 5,        # ширина окна, секунд
+    "flood_action": "mute",    # "mute" или "warn"
+    "flood_mute_minutes": 15,  # длительность мута за флуд
     "warns_enabled": True,
     "max_warns": 3,
     "log_actions": True,
     "allow_custom_commands": True,
     "command_prefix": "!",
-    "language": "ru"
+    "language": "ru",
+    "unmute_notice": False
+}
+
+# Упоминание пользователя: [id123|Имя], @id123 или vk.com/id123
+MENTION_RE = re.compile(r'\[id(\d+)\||@id(\d+)|vk\.com/id(\d+)')
+
+# Срок глобальной санкции для бана в общем индексе (бессрочно)
+GLOBAL_BAN = float("inf")
+
+# Сервисные действия, меняющие состав беседы
+MEMBERSHIP_ACTIONS = ("chat_invite_user", "chat_invite_user_by_link", "chat_kick_user")
+
+# ============= МЕТРИКИ =============
+
+# Границы корзин гистограмм длительностей, секунд
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    """Метки в текстовом формате Prometheus: {name="value",...}"""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Метрика с набором меток; значения хранятся по кортежам значений меток
+    
+    Вместо накопленных значений метрика может брать значение из функции
+    в момент выдачи (глубина очередей, число чатов в памяти).
+    """
+    
+    kind = "untyped"
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 func: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.func = func
+        self.values: Dict[Tuple, float] = {}
+    
+    def get(self, *label_values) -> float:
+        if self.func is not None:
+            return self.func()
+        return self.values.get(label_values, 0)
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        if self.func is not None:
+            lines.append(f"{self.name} {self.func()}")
+        else:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    """Счётчик: только растёт"""
+    
+    kind = "counter"
+    
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """Текущее значение: растёт и убывает"""
+    
+    kind = "gauge"
+    
+    def set(self, value: float, *label_values):
+        self.values[label_values] = value
+
+
+class Histogram(Metric):
+    """Распределение значений по корзинам (длительности в секундах)"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+        # Метки -> [число попаданий в каждую корзину (последняя - +Inf), сумма, количество]
+        self.values: Dict[Tuple, list] = {}
+    
+    def observe(self, value: float, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+    
+    def get(self, *label_values) -> float:
+        """Количество наблюдений"""
+        entry = self.values.get(label_values)
+        return entry[2] if entry else 0
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, hits in zip(self.buckets + (float("inf"),), counts):
+                cumulative += hits
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = format_labels(self.labels, label_values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Реестр метрик процесса; выдаёт их в текстовом формате Prometheus"""
+    
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+    
+    def _register(self, metric: Metric) -> Metric:
+        # Повторная регистрация (новый экземпляр сервера, воркер) заменяет функцию значения
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            existing.func = metric.func
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                func: Optional[Callable[[], float]] = None) -> Counter:
+        return self._register(Counter(name, help_text, labels, func))
+    
+    def gauge(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+              func: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, help_text, labels, func))
+    
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+handler_seconds = metrics.histogram("grand_handler_seconds", "Время обработчика сообщения", ("handler",))
+handler_errors = metrics.counter("grand_handler_errors_total", "Исключения в обработчиках", ("handler",))
+api_seconds = metrics.histogram("grand_api_request_seconds", "Время вызова VK API", ("method",))
+api_errors = metrics.counter("grand_api_errors_total", "Ошибки вызовов VK API", ("method", "code"))
+db_write_seconds = metrics.histogram("grand_db_write_seconds", "Время записи базы", ("op",))
+# Итоги для /stats: копятся здесь и переносятся в базу вместе с очередной пачкой записи
+statistics_counter = metrics.counter("grand_statistics_total", "Счётчики статистики бота", ("stat",))
+
+def instrumented(name: str):
+    """Декоратор обработчика: время выполнения и исключения в метриках"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                handler_errors.inc(name)
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                handler_seconds.observe(elapsed, name)
+                if elapsed > SLOW_HANDLER_THRESHOLD and args and hasattr(args[0], "peer_id"):
+                    slow_steps.inc("handler")
+                    logger.warning(f"🐢 Медленный обработчик {name}: {elapsed * 1000:.0f} мс "
+                                   f"({describe_message(args[0])})")
+        return wrapper
+    return decorator
+
+
+class InstrumentedAPI(API):
+    """VK API с замером времени и подсчётом ошибок по методам"""
+    
+    async def request(self, method: str, data: Dict[str, Any], version: Optional[str] = None) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, version)
+        except Exception as e:
+            api_errors.inc(method, getattr(e, "code", None) or type(e).__name__)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, method)
+
+
+class MetricsServer:
+    """HTTP-сервер с одной страницей /metrics для Prometheus"""
+    
+    def __init__(self, registry: MetricsRegistry = metrics):
+        self.registry = registry
+        self._runner: Optional[web.AppRunner] = None
+    
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.registry.render().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    
+    async def start(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Метрики: http://{host}:{port}/metrics")
+    
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+# ============= ПРОФИЛИРОВАНИЕ =============
+
+def frame_name(frame) -> str:
+    """Имя кадра стека: функция (файл:строка начала)"""
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def frame_context(frame) -> str:
+    """Чат и команда обрабатываемого сообщения - по локальной переменной message в стеке"""
+    while frame is not None:
+        message = frame.f_locals.get("message")
+        if message is not None and hasattr(message, "peer_id"):
+            return describe_message(message)
+        frame = frame.f_back
+    return "вне обработчика"
+
+def describe_message(message) -> str:
+    """Чат и команда сообщения для журнала"""
+    text = getattr(message, "text", None) or ""
+    command = text.split(maxsplit=1)[0] if text[:1] in COMMAND_PREFIXES else "сообщение"
+    return f"чат {message.peer_id - 2000000000}, {command}"
+
+
+class SamplingProfiler:
+    """Выборочный профилировщик: поток раз в interval секунд снимает стек потока
+    цикла событий и пишет итог в формате folded (flamegraph.pl, speedscope)
+    """
+    
+    def __init__(self, interval: float = PROFILE_INTERVAL, folder: str = DATA_FOLDER):
+        self.interval = interval
+        self.folder = folder
+        self._thread: Optional[threading.Thread] = None
+        self.last_path: Optional[str] = None
+        self.last_samples: Dict[str, int] = {}
+    
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self, seconds: float, thread_id: Optional[int] = None) -> threading.Thread:
+        """Запустить профилирование на seconds секунд (по умолчанию - текущего потока)"""
+        target = thread_id if thread_id is not None else threading.get_ident()
+        self._thread = threading.Thread(target=self._run, args=(seconds, target),
+                                        name="profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Профилирование на {seconds:.0f} с запущено")
+        return self._thread
+    
+    def _run(self, seconds: float, thread_id: int):
+        samples: Dict[str, int] = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                folded = ";".join(reversed(stack))
+                samples[folded] = samples.get(folded, 0) + 1
+            time.sleep(self.interval)
+        
+        os.makedirs(self.folder, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = f"{self.folder}/profile-{stamp}-{os.getpid()}.folded"
+        with open(path, "w", encoding="utf-8") as f:
+            for folded, count in sorted(samples.items()):
+                f.write(f"{folded} {count}\n")
+        self.last_samples = samples
+        self.last_path = path
+        logger.info(f"Профиль записан: {path} ({sum(samples.values())} выборок)")
+    
+    def top(self, limit: int = 10) -> List[Tuple[str, float]]:
+        """Функции с наибольшей долей выборок на вершине стека"""
+        total = sum(self.last_samples.values())
+        leaves: Dict[str, int] = {}
+        for folded, count in self.last_samples.items():
+            leaf = folded.rsplit(";", 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        ranked = sorted(leaves.items(), key=lambda item: -item[1])[:limit]
+        return [(name, count / total) for name, count in ranked] if total else []
+
+profiler = SamplingProfiler()
+
+loop_lag_seconds = metrics.histogram("grand_loop_lag_seconds", "Задержка шагов цикла событий")
+slow_steps = metrics.counter("grand_slow_steps_total", "Медленные обработчики и шаги цикла событий", ("kind",))
+
+class LoopWatchdog:
+    """Поиск долгих шагов цикла событий
+    
+    Задача в цикле событий ставит отметки времени; сторожевой поток, увидев
+    отметку старше порога, снимает стек застрявшего потока и пишет его в лог
+    вместе с чатом и командой. После того как цикл освободится, в лог
+    попадает и полная длительность шага.
+    """
+    
+    def __init__(self, threshold: float = SLOW_CALLBACK_THRESHOLD):
+        self.threshold = threshold
+        self._beat = time.monotonic()
+        self._reported_beat = 0.0
+        self._thread_id: Optional[int] = None
+    
+    async def run(self):
+        self._thread_id = threading.get_ident()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        step = self.threshold / 2
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(step)
+            lag = time.monotonic() - self._beat - step
+            loop_lag_seconds.observe(max(lag, 0.0))
+            if lag > self.threshold:
+                slow_steps.inc("loop")
+                logger.warning(f"🐢 Цикл событий был занят {lag * 1000:.0f} мс")
+    
+    def _watch(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            beat = self._beat
+            if time.monotonic() - beat < self.threshold or beat == self._reported_beat:
+                continue
+            # Один отчёт на каждую остановку цикла
+            self._reported_beat = beat
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame, limit=8))
+            logger.warning(f"🐢 Цикл событий занят дольше {self.threshold * 1000:.0f} мс "
+                           f"({frame_context(frame)}), стек:\n{stack}")
+
+loop_watchdog = LoopWatchdog()
+
+# ============= ЗАПИСИ ДАННЫХ ЧАТА =============
+
+class IntMap(MutableMapping):
+    """Словарь int -> int на двух отсортированных массивах
+    
+    Запись занимает 16 байт вместо ~100 у dict с объектами int; поиск -
+    бинарный, вставка сдвигает хвост массива. Подходит для счётчиков по
+    пользователям чата: unity_scores, last_messages, warns.
+    """
+    
+    __slots__ = ("_keys", "_values")
+    
+    def __init__(self, items: Any = ()):
+        pairs = sorted((int(key), int(value)) for key, value in dict(items).items())
+        self._keys = array('q', [key for key, _ in pairs])
+        self._values = array('q', [value for _, value in pairs])
+    
+    def _find(self, key: int) -> Tuple[int, bool]:
+        keys = self._keys
+        i = bisect.bisect_left(keys, key)
+        return i, i < len(keys) and keys[i] == key
+    
+    def __getitem__(self, key: int) -> int:
+        i, found = self._find(key)
+        if not found:
+            raise KeyError(key)
+        return self._values[i]
+    
+    def get(self, key: int, default: Any = None) -> Any:
+        i, found = self._find(key)
+        return self._values[i] if found else default
+    
+    def __setitem__(self, key: int, value: int):
+        i, found = self._find(key)
+        if found:
+            self._values[i] = value
+        else:
+            self._keys.insert(i, key)
+            self._values.insert(i, value)
+    
+    def __delitem__(self, key: int):
+        i, found = self._find(key)
+        if not found:
+            raise KeyError(key)
+        del self._keys[i]
+        del self._values[i]
+    
+    def __contains__(self, key: Any) -> bool:
+        return isinstance(key, int) and self._find(key)[1]
+    
+    def __iter__(self):
+        return iter(self._keys)
+    
+    def __len__(self) -> int:
+        return len(self._keys)
+    
+    def values(self) -> List[int]:
+        return self._values.tolist()
+    
+    def items(self) -> List[Tuple[int, int]]:
+        return list(zip(self._keys, self._values))
+    
+    def to_dict(self) -> Dict[int, int]:
+        return dict(zip(self._keys, self._values))
+    
+    def __repr__(self) -> str:
+        return f"IntMap({self.to_dict()!r})"
+
+
+class Record:
+    """Запись с полями в __slots__ и доступом как у словаря
+    
+    record["field"], get, update, items работают как у dict, поэтому
+    обработчики не зависят от того, словарь перед ними или запись. Поля,
+    которых нет в FIELDS (из других версий базы), хранятся в extra и
+    записываются обратно в файл.
+    """
+    
+    __slots__ = ("extra",)
+    FIELDS: Tuple[str, ...] = ()
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.FIELDS)
+    
+    def __getitem__(self, key: str) -> Any:
+        if key in self._field_set:
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+    
+    def __setitem__(self, key: str, value: Any):
+        if key in self._field_set:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self._field_set or (self.extra is not None and key in self.extra)
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def keys(self) -> List[str]:
+        return list(self.FIELDS) + list(self.extra or ())
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self) -> int:
+        return len(self.FIELDS) + len(self.extra or ())
+    
+    def items(self) -> List[Tuple[str, Any]]:
+        return [(key, self[key]) for key in self.keys()]
+    
+    def update(self, values: Dict[str, Any]):
+        for key, value in values.items():
+            self[key] = value
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Словарь в формате файла"""
+        return dict(self.items())
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Record":
+        record = cls()
+        record.update(data)
+        return record
+    
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class ChatInfo(Record):
+    """Сведения о чате; моменты времени - целые секунды эпохи"""
+    
+    FIELDS = ("title", "created", "last_active", "message_count", "user_count")
+    __slots__ = FIELDS
+    
+    def __init__(self, title: str = "", created: int = 0, last_active: int = 0,
+                 message_count: int = 0, user_count: int = 0):
+        self.extra = None
+        self.title = title
+        self.created = created
+        self.last_active = last_active
+        self.message_count = message_count
+        self.user_count = user_count
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ChatInfo":
+        record = super().from_dict(data)
+        # Старые базы хранили ISO-строки
+        for field in ("created", "last_active"):
+            value = record[field]
+            if value:
+                record[field] = int(epoch_timestamp(value))
+        return record
+
+
+class ChatSettings(Record):
+    """Настройки чата: общие значения DEFAULT_SETTINGS и переопределения чата
+    
+    В чате (и в файле) хранятся только ключи, отличающиеся от значений по
+    умолчанию, - в extra. Остальные читаются из DEFAULT_SETTINGS, поэтому
+    новое значение по умолчанию действует во всех чатах, где его не меняли.
+    Значение, совпавшее со значением по умолчанию, перестаёт быть переопределением.
+    """
+    
+    __slots__ = ()
+    
+    def __init__(self):
+        self.extra = None
+    
+    def __getitem__(self, key: str) -> Any:
+        overrides = self.extra
+        if overrides is not None and key in overrides:
+            return overrides[key]
+        return DEFAULT_SETTINGS[key]
+    
+    def __setitem__(self, key: str, value: Any):
+        if key in DEFAULT_SETTINGS and DEFAULT_SETTINGS[key] == value:
+            if self.extra is not None:
+                self.extra.pop(key, None)
+                if not self.extra:
+                    self.extra = None
+            return
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+    
+    def __contains__(self, key: str) -> bool:
+        return key in DEFAULT_SETTINGS or (self.extra is not None and key in self.extra)
+    
+    def keys(self) -> List[str]:
+        return list(DEFAULT_SETTINGS) + [key for key in self.extra or () if key not in DEFAULT_SETTINGS]
+    
+    def __len__(self) -> int:
+        return len(self.keys())
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Только переопределения чата"""
+        return dict(self.extra or {})
+
+
+class ModerationState(Record):
+    """Баны, муты, предупреждения и кики чата"""
+    
+    FIELDS = ("bans", "mutes", "warns", "kicks")
+    __slots__ = FIELDS
+    
+    def __init__(self):
+        self.extra = None
+        self.bans: set = set()
+        self.mutes: Dict[int, float] = {}  # user_id -> срок (секунды эпохи)
+        self.warns = IntMap()
+        self.kicks: List = []
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ModerationState":
+        record = super().from_dict(data)
+        record.bans = set(record.bans)
+        record.mutes = {user_id: epoch_timestamp(until) for user_id, until in record.mutes.items()}
+        record.warns = IntMap(record.warns)
+        return record
+    
+    def to_dict(self) -> Dict[str, Any]:
+        disk = super().to_dict()
+        disk["bans"] = sorted(self.bans)
+        disk["warns"] = self.warns.to_dict()
+        return disk
+
+
+class DayStats(Record):
+    """Активность чата за сутки: сообщения, по часам и по пользователям"""
+    
+    FIELDS = ("messages", "hours", "users")
+    __slots__ = FIELDS
+    
+    def __init__(self):
+        self.extra = None
+        self.messages = 0
+        self.hours = array('q', [0]) * 24
+        self.users = IntMap()
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "DayStats":
+        record = super().from_dict(data)
+        record.hours = array('q', record.hours)
+        record.users = IntMap(record.users)
+        return record
+    
+    def to_dict(self) -> Dict[str, Any]:
+        disk = super().to_dict()
+        disk["hours"] = self.hours.tolist()
+        disk["users"] = self.users.to_dict()
+        return disk
+
+# Пустые разделы чата, которые не держим в памяти (дописываются при записи в файл)
+EMPTY_CHAT_SECTIONS = {
+    "pinned_messages": [],
+    "economy": {"enabled": False, "currency": "₽", "users_balance": {}}
 }
 
 # ============= БАЗА ДАННЫХ =============
 
+class Storage:
+    """Интерфейс хранилища данных бота
+    
+    Запись идёт в два шага: prepare_batch() на цикле событий превращает
+    изменения в неизменяемый набор (байты, кортежи строк), а commit_batch()
+    выполняет ввод-вывод в отдельном потоке записи.
+    """
+    
+    # Загружает ли хранилище чаты по требованию (иначе все чаты приходят из load())
+    lazy = False
+    
+    def load(self) -> Dict:
+        """Загрузить данные верхнего уровня (и все чаты, если хранилище не ленивое)"""
+        raise NotImplementedError
+    
+    def load_chat(self, chat_id_str: str) -> Optional[Dict]:
+        """Загрузить один чат"""
+        raise NotImplementedError
+    
+    def chat_ids(self) -> List[str]:
+        """ID всех сохранённых чатов"""
+        raise NotImplementedError
+    
+    def prepare_batch(self, chats: Dict[str, Dict], keys: Dict[str, Any]) -> Any:
+        """Снять неизменяемую копию пачки изменённых чатов и разделов верхнего уровня"""
+        raise NotImplementedError
+    
+    def commit_batch(self, batch: Any):
+        """Записать подготовленную пачку (вызывается в потоке записи)"""
+        raise NotImplementedError
+    
+    def batch_committed(self, batch: Any):
+        """Пачка успешно записана (вызывается на цикле событий)"""
+    
+    def compact(self):
+        """Свернуть накопленные изменения в компактный вид (в потоке записи)"""
+    
+    def snapshot(self, data: Dict):
+        """Синхронно записать полное состояние переданных данных"""
+        raise NotImplementedError
+    
+    def needs_compaction(self) -> bool:
+        """Нужен ли хранилищу полный снимок"""
+        return False
+    
+    def mutes(self) -> List[Tuple[str, int, Any]]:
+        """Муты всех чатов, не загружая сами чаты: (chat_id_str, user_id, срок)"""
+        return []
+    
+    def forget(self, chat_id_str: str):
+        """Чат выгружен из памяти - освободить связанное с ним состояние"""
+    
+    def close(self):
+        """Освободить ресурсы хранилища (процессы, соединения)"""
+
+
+class PickleStorage(Storage):
+    """Снимок базы в pickle-файле + журнал изменений
+    
+    Каждый чат хранится в снимке отдельным сериализованным блоком: при запуске
+    читаются только разделы верхнего уровня, список чатов и индекс мутов,
+    а чат распаковывается при первом обращении.
+    """
+    
+    lazy = True
+    
+    # Версия формата снимка: {"format": 2, "keys": ..., "chats": {id: bytes}, "mutes": ...}
+    FORMAT = 2
+    
+    def __init__(self, data_folder: str = DATA_FOLDER):
+        self.data_folder = data_folder
+        self.data_file = f"{data_folder}/database.dat"
+        self.journal_file = f"{data_folder}/database.journal"
+        self._journal_size = 0
+        self._compactor: Optional[ProcessPoolExecutor] = None
+        # Сериализованные чаты и их муты - в том же виде, что и в файлах
+        self._chat_blobs: Dict[str, bytes] = {}
+        self._mute_index: Dict[str, Dict[int, Any]] = {}
+    
+    def exists(self) -> bool:
+        return os.path.exists(self.data_file)
+    
+    def _store_chat(self, chat_id_str: str, blob: bytes, mutes: Dict[int, Any]):
+        self._chat_blobs[chat_id_str] = blob
+        if mutes:
+            self._mute_index[chat_id_str] = mutes
+        else:
+            self._mute_index.pop(chat_id_str, None)
+    
+    def _store_chat_data(self, chat_id_str: str, chat: Dict):
+        self._store_chat(chat_id_str, pickle.dumps(chat), chat_mutes(chat))
+    
+    def load(self) -> Dict:
+        data = {}
+        if os.path.exists(self.data_file):
+            with open(self.data_file, 'rb') as f:
+                loaded = pickle.load(f)
+            # Проверяем структуру
+            if isinstance(loaded, dict) and loaded.get("format") == self.FORMAT:
+                data.update(loaded["keys"])
+                self._chat_blobs = loaded["chats"]
+                self._mute_index = loaded["mutes"]
+            elif isinstance(loaded, dict):
+                # Снимок старого формата: чаты целиком внутри данных
+                for chat_id_str, chat in loaded.pop("chats", {}).items():
+                    self._store_chat_data(chat_id_str, chat)
+                data.update(loaded)
+            else:
+                logger.warning("Файл данных поврежден, создаем новую БД")
+        else:
+            logger.info("Файл данных не найден, создаем новую БД")
+        
+        replayed = self._replay_journal(data)
+        if replayed:
+            logger.info(f"Из журнала восстановлено {replayed} пачек изменений")
+        return data
+    
+    def _replay_journal(self, data: Dict) -> int:
+        """Применить к данным записи журнала, вернуть число пачек"""
+        if not os.path.exists(self.journal_file):
+            return 0
+        
+        replayed = 0
+        good_offset = 0
+        with open(self.journal_file, 'rb') as f:
+            while True:
+                try:
+                    records = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception as e:
+                    logger.warning(f"Журнал поврежден после {replayed} пачек: {e}")
+                    break
+                
+                for record in records:
+                    if record[0] == "chat":
+                        if isinstance(record[2], bytes):
+                            self._store_chat(record[1], record[2], record[3])
+                        else:
+                            # Запись старого формата: чат целиком
+                            self._store_chat_data(record[1], record[2])
+                    elif record[0] == "key":
+                        data[record[1]] = record[2]
+                replayed += 1
+                good_offset = f.tell()
+        
+        # Отрезаем недописанный хвост (например, после падения во время записи)
+        if good_offset < os.path.getsize(self.journal_file):
+            with open(self.journal_file, 'r+b') as f:
+                f.truncate(good_offset)
+        self._journal_size = good_offset
+        return replayed
+    
+    def load_chat(self, chat_id_str: str) -> Optional[Dict]:
+        blob = self._chat_blobs.get(chat_id_str)
+        if blob is None:
+            return None
+        return pickle.loads(blob)
+    
+    def chat_ids(self) -> List[str]:
+        return list(self._chat_blobs)
+    
+    def mutes(self) -> List[Tuple[str, int, Any]]:
+        return [(chat_id_str, user_id, until)
+                for chat_id_str, mutes in self._mute_index.items()
+                for user_id, until in mutes.items()]
+    
+    def prepare_batch(self, chats: Dict[str, Dict], keys: Dict[str, Any]):
+        records = [("chat", chat_id_str, pickle.dumps(chat), chat_mutes(chat))
+                   for chat_id_str, chat in chats.items()]
+        records += [("key", key, value) for key, value in keys.items()]
+        return pickle.dumps(records), records
+    
+    def commit_batch(self, batch):
+        payload, _ = batch
+        with open(self.journal_file, 'ab') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+            self._journal_size = f.tell()
+    
+    def batch_committed(self, batch):
+        _, records = batch
+        for record in records:
+            if record[0] == "chat":
+                self._store_chat(record[1], record[2], record[3])
+    
+    def compact(self):
+        # Снимок собирается из файлов (снимок + журнал) в отдельном процессе:
+        # сериализация всей базы не держит GIL основного процесса. Процесс
+        # запускается через spawn: fork из потока записи копировал бы замки,
+        # занятые потоками цикла событий, сторожа и профилировщика
+        if self._compactor is None:
+            self._compactor = ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            )
+        self._compactor.submit(compact_pickle_storage, self.data_folder).result()
+        
+        # Пока шла компактизация, в журнал никто не писал: поток записи один
+        with open(self.journal_file, 'wb'):
+            pass
+        self._journal_size = 0
+    
+    def write_snapshot(self, keys: Dict):
+        """Записать снимок: разделы верхнего уровня и все известные чаты"""
+        tmp_file = f"{self.data_file}.tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({
+                "format": self.FORMAT,
+                "keys": keys,
+                "chats": self._chat_blobs,
+                "mutes": self._mute_index
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.data_file)
+    
+    def snapshot(self, data: Dict):
+        for chat_id_str, chat in data.get("chats", {}).items():
+            self._store_chat_data(chat_id_str, chat)
+        self.write_snapshot({key: value for key, value in data.items() if key != "chats"})
+        
+        # Снимок содержит все изменения, журнал больше не нужен
+        with open(self.journal_file, 'wb'):
+            pass
+        self._journal_size = 0
+    
+    def needs_compaction(self) -> bool:
+        return self._journal_size >= JOURNAL_COMPACT_SIZE
+    
+    def close(self):
+        if self._compactor is not None:
+            self._compactor.shutdown()
+            self._compactor = None
+
+
+def compact_pickle_storage(data_folder: str = DATA_FOLDER):
+    """Свернуть журнал в новый снимок, читая только файлы"""
+    storage = PickleStorage(data_folder)
+    storage.write_snapshot(storage.load())
+
+
+class SQLiteStorage(Storage):
+    """SQLite: отдельная таблица на каждую сущность, чаты грузятся по требованию"""
+    
+    lazy = True
+    
+    # Таблица -> (путь к контейнеру в данных чата, ключевые колонки, колонки значений)
+    ROW_TABLES = {
+        "bans": (("moderation", "bans"), ("user_id",), ()),
+        "mutes": (("moderation", "mutes"), ("user_id",), ("until",)),
+        "warns": (("moderation", "warns"), ("user_id",), ("count",)),
+        "nicknames": (("users", "nicknames"), ("user_id",), ("nickname",)),
+        "roles": (("users", "roles"), ("role", "user_id"), ()),
+        "unity_scores": (("activity", "unity_scores"), ("user_id",), ("score",)),
+        "last_messages": (("activity", "last_messages"), ("user_id",), ("ts",)),
+        "custom_commands": (("custom_commands",), ("name",), ("text",)),
+    }
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB);
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY, info TEXT, settings TEXT, extra BLOB
+        );
+        CREATE TABLE IF NOT EXISTS bans (
+            chat_id INTEGER, user_id INTEGER, PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS mutes (
+            chat_id INTEGER, user_id INTEGER, until, PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS warns (
+            chat_id INTEGER, user_id INTEGER, count INTEGER, PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS nicknames (
+            chat_id INTEGER, user_id INTEGER, nickname TEXT, PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS roles (
+            chat_id INTEGER, role TEXT, user_id INTEGER, PRIMARY KEY (chat_id, role, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS roles_chat_user ON roles (chat_id, user_id);
+        CREATE TABLE IF NOT EXISTS unity_scores (
+            chat_id INTEGER, user_id INTEGER, score INTEGER, PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS last_messages (
+            chat_id INTEGER, user_id INTEGER, ts, PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS custom_commands (
+            chat_id INTEGER, name TEXT, text TEXT, PRIMARY KEY (chat_id, name)
+        ) WITHOUT ROWID;
+    """
+    
+    def __init__(self, data_folder: str = DATA_FOLDER):
+        self.data_folder = data_folder
+        self.db_file = f"{data_folder}/database.sqlite"
+        # Соединение для чтения на цикле событий и отдельное - для потока записи;
+        # в режиме WAL чтение не ждёт записи
+        self.write_conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.write_conn.execute("PRAGMA journal_mode=WAL")
+        self.write_conn.execute("PRAGMA synchronous=NORMAL")
+        self.write_conn.executescript(self.SCHEMA)
+        self.conn = sqlite3.connect(self.db_file)
+        # Последнее записанное состояние строк загруженных чатов: пишем только разницу
+        self._written_rows: Dict[str, Dict[str, Dict[tuple, tuple]]] = {}
+    
+    def load(self) -> Dict:
+        rows = self.conn.execute("SELECT key, value FROM meta").fetchall()
+        if not rows:
+            data = import_legacy_snapshot(self)
+            if data is not None:
+                return data
+        return {key: pickle.loads(value) for key, value in rows}
+    
+    def load_chat(self, chat_id_str: str) -> Optional[Dict]:
+        row = self.conn.execute(
+            "SELECT info, settings, extra FROM chats WHERE chat_id = ?", (int(chat_id_str),)
+        ).fetchone()
+        if row is None:
+            return None
+        
+        chat = pickle.loads(row[2])
+        chat["info"] = json.loads(row[0])
+        chat["settings"] = json.loads(row[1])
+        for table, (path, key_cols, value_cols) in self.ROW_TABLES.items():
+            parent = chat
+            for part in path[:-1]:
+                parent = parent.setdefault(part, {})
+            columns = ", ".join(key_cols + value_cols)
+            rows = self.conn.execute(
+                f"SELECT {columns} FROM {table} WHERE chat_id = ?", (int(chat_id_str),)
+            ).fetchall()
+            
+            if table == "bans":
+                parent[path[-1]] = [user_id for (user_id,) in rows]
+            elif table == "roles":
+                roles = {}
+                for role, user_id in rows:
+                    roles.setdefault(role, []).append(user_id)
+                parent[path[-1]] = roles
+            else:
+                parent[path[-1]] = {key: value for key, value in rows}
+        
+        self._written_rows[chat_id_str] = self._chat_rows(chat)
+        return chat
+    
+    def chat_ids(self) -> List[str]:
+        return [str(chat_id) for (chat_id,) in self.conn.execute("SELECT chat_id FROM chats")]
+    
+    def mutes(self) -> List[Tuple[str, int, Any]]:
+        return [(str(chat_id), user_id, until) for chat_id, user_id, until
+                in self.conn.execute("SELECT chat_id, user_id, until FROM mutes")]
+    
+    def _chat_rows(self, chat: Dict) -> Dict[str, Dict[tuple, tuple]]:
+        """Разложить данные чата на строки таблиц"""
+        rows = {}
+        stripped = {}
+        for table, (path, key_cols, value_cols) in self.ROW_TABLES.items():
+            container = chat
+            for part in path:
+                container = container.get(part, {}) if isinstance(container, dict) else {}
+            
+            if table == "bans":
+                rows[table] = {(user_id,): () for user_id in container}
+            elif table == "roles":
+                rows[table] = {(role, user_id): ()
+                               for role, users in container.items() for user_id in users}
+            else:
+                rows[table] = {(key,): (value,) for key, value in container.items()}
+            stripped.setdefault(path[0], set()).add(path[-1] if len(path) > 1 else None)
+        
+        # Всё, что не разложено по таблицам, хранится одним блобом в строке чата
+        extra = {}
+        for key, value in chat.items():
+            if key in ("info", "settings"):
+                continue
+            parts = stripped.get(key)
+            if parts is None:
+                extra[key] = value
+            elif None not in parts and isinstance(value, dict):
+                extra[key] = {k: v for k, v in value.items() if k not in parts}
+        rows["chats"] = {(): (
+            json.dumps(chat.get("info", {}), ensure_ascii=False),
+            json.dumps(chat.get("settings", {}), ensure_ascii=False),
+            pickle.dumps(extra),
+        )}
+        return rows
+    
+    def _chat_statements(self, chat_id_str: str, new_rows: Dict[str, Dict[tuple, tuple]]) -> List[Tuple[str, list]]:
+        """SQL-операции, переводящие строки чата из записанного состояния в новое"""
+        chat_id = int(chat_id_str)
+        old_rows = self._written_rows.get(chat_id_str, {})
+        statements = []
+        
+        for table, rows in new_rows.items():
+            if table == "chats":
+                key_cols, value_cols = ("chat_id",), ("info", "settings", "extra")
+            else:
+                key_cols, value_cols = ("chat_id",) + self.ROW_TABLES[table][1], self.ROW_TABLES[table][2]
+            old = old_rows.get(table, {})
+            
+            changed = [(chat_id,) + key + value for key, value in rows.items() if old.get(key) != value]
+            removed = [(chat_id,) + key for key in old if key not in rows]
+            
+            if changed:
+                columns = key_cols + value_cols
+                placeholders = ", ".join("?" * len(columns))
+                statements.append((
+                    f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                    changed
+                ))
+            if removed:
+                condition = " AND ".join(f"{col} = ?" for col in key_cols)
+                statements.append((f"DELETE FROM {table} WHERE {condition}", removed))
+        return statements
+    
+    def prepare_batch(self, chats: Dict[str, Dict], keys: Dict[str, Any]):
+        statements = []
+        new_rows = {}
+        for chat_id_str, chat in chats.items():
+            new_rows[chat_id_str] = self._chat_rows(chat)
+            statements += self._chat_statements(chat_id_str, new_rows[chat_id_str])
+        if keys:
+            statements.append((
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(key, pickle.dumps(value)) for key, value in keys.items()]
+            ))
+        return statements, new_rows
+    
+    def commit_batch(self, batch):
+        statements, _ = batch
+        with self.write_conn:
+            for sql, params in statements:
+                self.write_conn.executemany(sql, params)
+    
+    def batch_committed(self, batch):
+        _, new_rows = batch
+        self._written_rows.update(new_rows)
+    
+    def compact(self):
+        self.write_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    
+    def forget(self, chat_id_str: str):
+        self._written_rows.pop(chat_id_str, None)
+    
+    def close(self):
+        self.conn.close()
+        self.write_conn.close()
+    
+    def snapshot(self, data: Dict):
+        keys = {key: value for key, value in data.items() if key != "chats"}
+        batch = self.prepare_batch(data.get("chats", {}), keys)
+        self.commit_batch(batch)
+        self.batch_committed(batch)
+        self.compact()
+
+
+class ShardStorage(Storage):
+    """Отдельный pickle-файл на каждый чат, общие данные - в meta.dat"""
+    
+    lazy = True
+    
+    def __init__(self, data_folder: str = DATA_FOLDER):
+        self.data_folder = data_folder
+        self.folder = f"{data_folder}/chats"
+        self.meta_file = f"{self.folder}/meta.dat"
+        self.index_file = f"{self.folder}/index.dat"
+        os.makedirs(self.folder, exist_ok=True)
+        # Сериализованные разделы верхнего уровня: meta.dat переписывается целиком
+        self._meta_blobs: Dict[str, bytes] = {}
+        # Индекс, доступный без загрузки чатов: id чатов и их муты
+        self._chat_ids = set()
+        self._mute_index: Dict[str, Dict[int, Any]] = {}
+    
+    def _shard_file(self, chat_id_str: str) -> str:
+        return f"{self.folder}/chat_{chat_id_str}.dat"
+    
+    def _write_file(self, path: str, payload: bytes):
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+    
+    def load(self) -> Dict:
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'rb') as f:
+                self._chat_ids, self._mute_index = pickle.load(f)
+        
+        if not os.path.exists(self.meta_file):
+            data = import_legacy_snapshot(self)
+            if data is not None:
+                return data
+            return {}
+        
+        with open(self.meta_file, 'rb') as f:
+            self._meta_blobs = pickle.load(f)
+        return {key: pickle.loads(blob) for key, blob in self._meta_blobs.items()}
+    
+    def load_chat(self, chat_id_str: str) -> Optional[Dict]:
+        if chat_id_str not in self._chat_ids:
+            return None
+        with open(self._shard_file(chat_id_str), 'rb') as f:
+            return pickle.load(f)
+    
+    def chat_ids(self) -> List[str]:
+        return list(self._chat_ids)
+    
+    def mutes(self) -> List[Tuple[str, int, Any]]:
+        return [(chat_id_str, user_id, until)
+                for chat_id_str, mutes in self._mute_index.items()
+                for user_id, until in mutes.items()]
+    
+    def prepare_batch(self, chats: Dict[str, Dict], keys: Dict[str, Any]):
+        shards = {chat_id_str: pickle.dumps(chat) for chat_id_str, chat in chats.items()}
+        mutes = {chat_id_str: chat_mutes(chat) for chat_id_str, chat in chats.items()}
+        blobs = {key: pickle.dumps(value) for key, value in keys.items()}
+        return shards, mutes, blobs
+    
+    def commit_batch(self, batch):
+        shards, mutes, blobs = batch
+        for chat_id_str, payload in shards.items():
+            self._write_file(self._shard_file(chat_id_str), payload)
+        
+        index_changed = False
+        for chat_id_str, chat_mutes in mutes.items():
+            if chat_id_str not in self._chat_ids:
+                self._chat_ids.add(chat_id_str)
+                index_changed = True
+            if self._mute_index.get(chat_id_str, {}) != chat_mutes:
+                if chat_mutes:
+                    self._mute_index[chat_id_str] = chat_mutes
+                else:
+                    self._mute_index.pop(chat_id_str, None)
+                index_changed = True
+        if index_changed:
+            self._write_file(self.index_file, pickle.dumps((self._chat_ids, self._mute_index)))
+        
+        if blobs:
+            self._meta_blobs.update(blobs)
+            self._write_file(self.meta_file, pickle.dumps(self._meta_blobs))
+    
+    def snapshot(self, data: Dict):
+        keys = {key: value for key, value in data.items() if key != "chats"}
+        self.commit_batch(self.prepare_batch(data.get("chats", {}), keys))
+
+
+def import_legacy_snapshot(storage: Storage) -> Optional[Dict]:
+    """Перенести данные из pickle-снимка в новое хранилище при первом запуске"""
+    legacy = PickleStorage(storage.data_folder)
+    if not legacy.exists():
+        return None
+    
+    data = legacy.load()
+    data["chats"] = {chat_id_str: legacy.load_chat(chat_id_str) for chat_id_str in legacy.chat_ids()}
+    storage.snapshot(data)
+    logger.info(f"Перенесено из {legacy.data_file}: {len(data['chats'])} чатов")
+    for chat_id_str in data.pop("chats"):
+        storage.forget(chat_id_str)
+    return data
+
+
+def create_storage(data_folder: str = DATA_FOLDER) -> Storage:
+    """Создать хранилище по настройке STORAGE_BACKEND"""
+    os.makedirs(data_folder, exist_ok=True)
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(data_folder)
+    if STORAGE_BACKEND == "shards":
+        return ShardStorage(data_folder)
+    return PickleStorage(data_folder)
+
+
+def chat_mutes(chat: Dict) -> Dict[int, Any]:
+    """Муты чата в формате файла (для индекса мутов хранилища)"""
+    return dict(chat.get("moderation", {}).get("mutes", {}))
+
+def epoch_timestamp(value: Any) -> float:
+    """Момент времени в секундах эпохи (старые базы хранили ISO-строки)"""
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value).timestamp()
+    return float(value)
+
+def chat_from_disk(chat: Dict) -> Dict:
+    """Привести данные чата из файла к виду в памяти: записи вместо словарей,
+    множества вместо списков id, секунды эпохи вместо ISO-строк"""
+    for key, record_type in (("info", ChatInfo), ("settings", ChatSettings), ("moderation", ModerationState)):
+        if key in chat:
+            chat[key] = record_type.from_dict(chat[key])
+    activity = chat.get("activity")
+    if activity is not None:
+        if "unity_scores" in activity:
+            activity["unity_scores"] = IntMap(activity["unity_scores"])
+        if "last_messages" in activity:
+            activity["last_messages"] = IntMap({user_id: epoch_timestamp(ts)
+                                                for user_id, ts in activity["last_messages"].items()})
+        if "daily_stats" in activity:
+            activity["daily_stats"] = {day_key: DayStats.from_dict(day)
+                                       for day_key, day in activity["daily_stats"].items()}
+    users = chat.get("users")
+    if users is not None and "roles" in users:
+        users["roles"] = {role: set(user_ids) for role, user_ids in users["roles"].items()}
+    for key, empty in EMPTY_CHAT_SECTIONS.items():
+        if chat.get(key) == empty:
+            del chat[key]
+    return chat
+
+def chat_to_disk(chat: Dict) -> Dict:
+    """Неглубокая копия данных чата в формате файла: словари и списки вместо
+    записей, массивов и множеств"""
+    disk = dict(chat)
+    for key, empty in EMPTY_CHAT_SECTIONS.items():
+        if key not in disk:
+            # Своя копия на каждый чат: общий объект изменился бы сразу во всех
+            disk[key] = copy.deepcopy(empty)
+    for key in ("info", "settings", "moderation"):
+        if key in chat:
+            disk[key] = chat[key].to_dict()
+    if "activity" in chat:
+        activity = disk["activity"] = dict(chat["activity"])
+        for key in ("unity_scores", "last_messages"):
+            if key in activity:
+                activity[key] = activity[key].to_dict()
+        if "daily_stats" in activity:
+            activity["daily_stats"] = {day_key: day.to_dict()
+                                       for day_key, day in activity["daily_stats"].items()}
+    if "users" in chat:
+        disk["users"] = dict(chat["users"])
+        disk["users"]["roles"] = {role: sorted(user_ids)
+                                  for role, user_ids in chat["users"]["roles"].items()}
+    return disk
+
+def key_to_disk(key: str, value: Any) -> Any:
+    """Значение раздела верхнего уровня в формате файла"""
+    if key in ("global_bans", "export_pending"):
+        return sorted(value)
+    return value
+
+
 class Database:
-    def __init__(self):
-        self.data_file = f"{DATA_FOLDER}/database.dat"
+    def __init__(self, storage: Optional[Storage] = None):
+        self.storage = storage or create_storage()
         self.data = {
-            "chats": {},          # Данные по чатам
-            "global_bans": [],    # Глобальные баны
+            "chats": {},          # Данные по чатам (для ленивого хранилища - только загруженные)
+            "global_bans": set(),  # Глобальные баны
+            "global_mutes": {},    # Глобальные муты: user_id -> срок (секунды эпохи)
             "statistics": {       # Статистика
                 "total_messages": 0,
                 "total_commands": 0,
@@ -88,135 +1563,916 @@ class Database:
                 "total_kicks": 0
             },
             "users": {},          # Глобальные данные пользователей
-            "backups": []         # Резервные копии
+            "backups": [],        # Резервные копии
+            # Чаты, изменённые после последнего экспорта в JSON (хранится в базе,
+            # чтобы изменения до перезапуска тоже попали в экспорт)
+            "export_pending": set()
         }
+        # Изменения, ещё не попавшие в хранилище
+        self._dirty_chats = set()
+        self._dirty_keys = set()
+        self._pending_changes = 0
+        # Вся запись идёт через один поток, не больше одной пачки одновременно
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_again = False
+        self._compact_requested = False
+        # Порядок обращений к загруженным чатам (для выгрузки неактивных)
+        self._last_access: "OrderedDict[str, float]" = OrderedDict()
+        # Чаты из пачки, которая сейчас пишется в хранилище
+        self._inflight_chats = set()
+        # Общий индекс глобальных санкций: user_id -> срок (GLOBAL_BAN для бана)
+        self.global_sanctions: Dict[int, float] = {}
+        # Получатель изменений глобальных санкций (в режиме воркеров - супервизор)
+        self.global_sink: Optional[Callable[[str, tuple], None]] = None
+        # Итоги по всем воркерам: {"statistics": ..., "chats": ...} от супервизора
+        self.cluster: Optional[Dict] = None
+        # Значения счётчиков статистики из метрик, уже перенесённые в data["statistics"]
+        self._stats_synced = {stat_name: statistics_counter.get(stat_name)
+                              for stat_name in self.data["statistics"]}
         self.load()
     
     def load(self):
-        """Загрузить данные из файла"""
+        """Загрузить данные из хранилища"""
         try:
-            if os.path.exists(self.data_file):
-                with open(self.data_file, 'rb') as f:
-                    loaded = pickle.load(f)
-                    # Проверяем структуру
-                    if isinstance(loaded, dict):
-                        self.data.update(loaded)
-                        logger.info(f"Загружено {len(self.data['chats'])} чатов")
-                    else:
-                        logger.warning("Файл данных поврежден, создаем новую БД")
-                        self.save()
+            self.data.update(self.storage.load())
+            self.data["global_bans"] = set(self.data["global_bans"])
+            self.data["export_pending"] = set(self.data["export_pending"])
+            self.data["global_mutes"] = {user_id: epoch_timestamp(until)
+                                         for user_id, until in self.data["global_mutes"].items()}
+            for chat in self.data["chats"].values():
+                chat_from_disk(chat)
+            if self.storage.lazy:
+                logger.info(f"В хранилище {len(self.storage.chat_ids())} чатов")
             else:
-                logger.info("Файл данных не найден, создаем новую БД")
-                self.save()
+                logger.info(f"Загружено {len(self.data['chats'])} чатов")
         except Exception as e:
             logger.error(f"Ошибка загрузки БД: {e}")
-            self.save()
+        
+        if isinstance(self.storage, PickleStorage) and not self.storage.exists():
+            self.storage.snapshot(self._disk_snapshot())
+        self._rebuild_sanctions()
+    
+    def _rebuild_sanctions(self):
+        # Бан перекрывает мут того же пользователя
+        sanctions = dict(self.data["global_mutes"])
+        sanctions.update(dict.fromkeys(self.data["global_bans"], GLOBAL_BAN))
+        self.global_sanctions = sanctions
+    
+    def _disk_snapshot(self) -> Dict:
+        """Все загруженные данные в формате файла"""
+        disk = {key: key_to_disk(key, value) for key, value in self.data.items() if key != "chats"}
+        disk["chats"] = {chat_id_str: chat_to_disk(chat)
+                         for chat_id_str, chat in self.data["chats"].items()}
+        return disk
+    
+    def _take_batch(self):
+        """Забрать накопленные изменения и снять с них неизменяемую копию"""
+        self.sync_statistics()
+        if not self._dirty_chats and not self._dirty_keys:
+            return None
+        
+        chats = self.data["chats"]
+        chat_ids = self._dirty_chats
+        keys = self._dirty_keys
+        self._dirty_chats = set()
+        self._dirty_keys = set()
+        self._pending_changes = 0
+        
+        batch = self.storage.prepare_batch(
+            {chat_id_str: chat_to_disk(chats[chat_id_str])
+             for chat_id_str in chat_ids if chat_id_str in chats},
+            {key: key_to_disk(key, self.data[key]) for key in keys}
+        )
+        return chat_ids, keys, batch
+    
+    def _batch_failed(self, taken, error: Exception):
+        # Возвращаем изменения в очередь - запишутся следующей пачкой
+        chat_ids, keys, _ = taken
+        self._dirty_chats.update(chat_ids)
+        self._dirty_keys.update(keys)
+        logger.error(f"Ошибка записи изменений: {error}")
+    
+    def flush(self):
+        """Синхронно записать накопленные изменения (без цикла событий или при остановке)"""
+        taken = self._take_batch()
+        if taken is None:
+            return
+        try:
+            # Через тот же поток записи: пачка встанет после уже идущих записей
+            self._writer.submit(self._timed_write, "flush", self.storage.commit_batch, taken[2]).result()
+        except Exception as e:
+            self._batch_failed(taken, e)
+            return
+        self.storage.batch_committed(taken[2])
     
     def save(self):
-        """Сохранить данные в файл"""
+        """Синхронно записать изменения и свернуть их в полный снимок"""
+        started = time.perf_counter()
+        self.flush()
         try:
-            with open(self.data_file, 'wb') as f:
-                pickle.dump(self.data, f)
-            
-            # Также сохраняем в JSON для читаемости
-            json_file = f"{DATA_FOLDER}/database.json"
-            with open(json_file, 'w', encoding='utf-8') as f:
-                # Функция для сериализации datetime
-                def serialize(obj):
-                    if isinstance(obj, datetime.datetime):
-                        return obj.isoformat()
-                    return str(obj)
-                
-                json.dump(self.data, f, default=serialize, indent=2, ensure_ascii=False)
+            self._writer.submit(self._timed_write, "compact", self.storage.compact).result()
         except Exception as e:
             logger.error(f"Ошибка сохранения БД: {e}")
+        db_write_seconds.observe(time.perf_counter() - started, "save")
+    
+    @staticmethod
+    def _timed_write(op: str, action, *args):
+        # Выполняется в потоке записи: замеряется сама запись, без ожидания очереди
+        started = time.perf_counter()
+        try:
+            return action(*args)
+        finally:
+            db_write_seconds.observe(time.perf_counter() - started, op)
+    
+    def close(self):
+        """Остановить поток записи и освободить хранилище (после save())"""
+        self._writer.shutdown()
+        self.storage.close()
+    
+    def request_flush(self):
+        """Запросить фоновую запись изменений; одновременно идёт не больше одной"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        
+        if self._flush_task is not None and not self._flush_task.done():
+            # Запись уже идёт - новые изменения уйдут следующей пачкой
+            self._flush_again = True
+            return
+        self._flush_task = loop.create_task(self._flush_worker())
+    
+    async def _flush_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._flush_again = False
+            taken = self._take_batch()
+            if taken is not None:
+                self._inflight_chats = taken[0]
+                try:
+                    await loop.run_in_executor(self._writer, self._timed_write, "flush",
+                                               self.storage.commit_batch, taken[2])
+                    self.storage.batch_committed(taken[2])
+                except Exception as e:
+                    self._batch_failed(taken, e)
+                finally:
+                    self._inflight_chats = set()
+            
+            if self.storage.needs_compaction() or self._compact_requested:
+                self._compact_requested = False
+                logger.info("Компактизация журнала в снимок")
+                try:
+                    await loop.run_in_executor(self._writer, self._timed_write, "compact", self.storage.compact)
+                except Exception as e:
+                    logger.error(f"Ошибка сохранения БД: {e}")
+            
+            if not self._flush_again:
+                break
+    
+    async def flush_async(self):
+        """Записать изменения в фоне и дождаться окончания записи"""
+        self.request_flush()
+        if self._flush_task is not None:
+            await asyncio.shield(self._flush_task)
+    
+    async def save_async(self):
+        """Записать изменения и свернуть их в снимок, не блокируя цикл событий"""
+        self._compact_requested = True
+        await self.flush_async()
+    
+    def mark_chat_dirty(self, chat_id: int):
+        """Отметить чат как изменённый"""
+        self._note_change()
+        chat_id_str = str(chat_id)
+        self._dirty_chats.add(chat_id_str)
+        export_pending = self.data["export_pending"]
+        if chat_id_str not in export_pending:
+            export_pending.add(chat_id_str)
+            self._dirty_keys.add("export_pending")
+    
+    def mark_key_dirty(self, key: str):
+        """Отметить раздел верхнего уровня (global_bans, statistics, ...) как изменённый"""
+        self._note_change()
+        self._dirty_keys.add(key)
+    
+    def _note_change(self):
+        # Запрашиваем запись до отметки: без цикла событий flush() синхронный,
+        # а вызывающий код ещё будет менять отмеченный объект
+        if self._pending_changes >= JOURNAL_FLUSH_THRESHOLD:
+            self.request_flush()
+        self._pending_changes += 1
     
     def init_chat(self, chat_id: int) -> Dict:
         """Инициализировать или получить данные чата"""
         chat_id_str = str(chat_id)
+        chat_data = self.get_chat(chat_id)
         
-        if chat_id_str not in self.data["chats"]:
-            self.data["chats"][chat_id_str] = {
-                "info": {
-                    "title": f"Чат {chat_id}",
-                    "created": datetime.datetime.now().isoformat(),
-                    "last_active": datetime.datetime.now().isoformat(),
-                    "message_count": 0,
-                    "user_count": 0
-                },
-                "moderation": {
-                    "bans": [],
-                    "mutes": {},
-                    "warns": {},
-                    "kicks": []
-                },
+        if chat_data is None:
+            if self.storage.lazy:
+                self._touch(chat_id_str)
+            now = int(time.time())
+            # Пустые pinned_messages и economy не храним (см. EMPTY_CHAT_SECTIONS)
+            chat_data = self.data["chats"][chat_id_str] = {
+                "info": ChatInfo(title=f"Чат {chat_id}", created=now, last_active=now),
+                "moderation": ModerationState(),
                 "users": {
                     "nicknames": {},
                     "roles": {},
                     "profiles": {}
                 },
-                "settings": DEFAULT_SETTINGS.copy(),
+                "settings": ChatSettings(),
                 "custom_commands": {},
-                "pinned_messages": [],
                 "welcome_stats": {
                     "total_welcomed": 0,
                     "last_welcome": None
                 },
-                "economy": {
-                    "enabled": False,
-                    "currency": "₽",
-                    "users_balance": {}
-                },
                 "activity": {
-                    "unity_scores": {},
-                    "last_messages": {},
+                    "unity_scores": IntMap(),
+                    "last_messages": IntMap(),
                     "daily_stats": {}
                 }
             }
             logger.info(f"Создан новый чат: {chat_id}")
-            self.save()
         
         # Обновляем время активности
-        self.data["chats"][chat_id_str]["info"]["last_active"] = datetime.datetime.now().isoformat()
-        return self.data["chats"][chat_id_str]
+        chat_data["info"]["last_active"] = int(time.time())
+        self.mark_chat_dirty(chat_id)
+        return chat_data
     
     def get_chat(self, chat_id: int) -> Optional[Dict]:
         """Получить данные чата"""
-        return self.data["chats"].get(str(chat_id))
+        chat_id_str = str(chat_id)
+        chat_data = self.data["chats"].get(chat_id_str)
+        if not self.storage.lazy:
+            return chat_data
+        
+        if chat_data is None:
+            chat_data = self.storage.load_chat(chat_id_str)
+            if chat_data is None:
+                return None
+            self.data["chats"][chat_id_str] = chat_from_disk(chat_data)
+        self._touch(chat_id_str)
+        return chat_data
+    
+    def _touch(self, chat_id_str: str):
+        self._last_access[chat_id_str] = time.monotonic()
+        self._last_access.move_to_end(chat_id_str)
+    
+    def evict_idle(self) -> int:
+        """Выгрузить из памяти давно неактивные чаты, вернуть их количество"""
+        if not self.storage.lazy:
+            return 0
+        
+        chats = self.data["chats"]
+        deadline = time.monotonic() - CHAT_IDLE_EVICT
+        evicted = 0
+        for chat_id_str, last_access in list(self._last_access.items()):
+            if last_access > deadline and len(chats) <= CHAT_CACHE_MAX:
+                break
+            # Несохранённые чаты выгружаем после записи, на следующем проходе.
+            # Чаты с событиями в обработке тоже: обработчик держит chat_data через await,
+            # и его mark_chat_dirty для выгруженного чата потерялся бы
+            if (chat_id_str in self._dirty_chats or chat_id_str in self._inflight_chats
+                    or event_scheduler.busy(int(chat_id_str) + 2000000000)):
+                continue
+            del self._last_access[chat_id_str]
+            chats.pop(chat_id_str, None)
+            self.storage.forget(chat_id_str)
+            evicted += 1
+        
+        if evicted:
+            logger.info(f"Выгружено из памяти {evicted} неактивных чатов")
+        return evicted
+    
+    def read_chat(self, chat_id: int) -> Optional[Dict]:
+        """Получить данные чата, не оставляя их в памяти, если чат не загружен"""
+        chat_id_str = str(chat_id)
+        chat_data = self.data["chats"].get(chat_id_str)
+        if chat_data is None and self.storage.lazy:
+            chat_data = self.storage.load_chat(chat_id_str)
+            if chat_data is not None:
+                chat_from_disk(chat_data)
+        return chat_data
+    
+    def chat_ids(self) -> List[str]:
+        """ID всех известных чатов, включая не загруженные в память"""
+        if not self.storage.lazy:
+            return list(self.data["chats"])
+        ids = set(self.storage.chat_ids())
+        ids.update(self.data["chats"])
+        return list(ids)
+    
+    def chat_count(self) -> int:
+        """Количество известных чатов"""
+        return len(self.chat_ids())
+    
+    def iter_mutes(self):
+        """Все муты, включая чаты не в памяти: (chat_id_str, user_id, срок)"""
+        chats = self.data["chats"]
+        for chat_id_str, chat in chats.items():
+            for user_id, until in chat["moderation"]["mutes"].items():
+                yield chat_id_str, user_id, until
+        for chat_id_str, user_id, until in self.storage.mutes():
+            if chat_id_str not in chats:
+                yield chat_id_str, user_id, epoch_timestamp(until)
+    
+    def global_ban(self, user_id: int) -> bool:
+        """Выдать глобальный бан; False, если пользователь уже забанен"""
+        if user_id in self.data["global_bans"]:
+            return False
+        self.data["global_bans"].add(user_id)
+        self.global_sanctions[user_id] = GLOBAL_BAN
+        self.mark_key_dirty("global_bans")
+        if self.global_sink is not None:
+            self.global_sink("global_ban", (user_id,))
+        return True
+    
+    def global_mute(self, user_id: int, until: float) -> bool:
+        """Выдать или продлить глобальный мут до срока until"""
+        self.data["global_mutes"][user_id] = until
+        if user_id not in self.data["global_bans"]:
+            self.global_sanctions[user_id] = until
+        self.mark_key_dirty("global_mutes")
+        if self.global_sink is not None:
+            self.global_sink("global_mute", (user_id, until))
+        return True
+    
+    def global_unmute(self, user_id: int) -> bool:
+        """Снять глобальный мут; False, если мута не было"""
+        if self.data["global_mutes"].pop(user_id, None) is None:
+            return False
+        if user_id not in self.data["global_bans"]:
+            self.global_sanctions.pop(user_id, None)
+        self.mark_key_dirty("global_mutes")
+        if self.global_sink is not None:
+            self.global_sink("global_unmute", (user_id,))
+        return True
+    
+    def global_state(self) -> Dict:
+        """Глобальные санкции в формате файла (для передачи воркерам)"""
+        return {key: key_to_disk(key, self.data[key]) for key in ("global_bans", "global_mutes")}
+    
+    def replace_globals(self, values: Dict):
+        """Заменить глобальные санкции присланными супервизором"""
+        self.data["global_bans"] = set(values["global_bans"])
+        self.data["global_mutes"] = dict(values["global_mutes"])
+        self._rebuild_sanctions()
+    
+    def global_statistics(self) -> Dict:
+        """Глобальная статистика: по всем воркерам, если они есть"""
+        return self.cluster["statistics"] if self.cluster else self.sync_statistics()
+    
+    def total_chat_count(self) -> int:
+        """Количество чатов: по всем воркерам, если они есть"""
+        return self.cluster["chats"] if self.cluster else self.chat_count()
     
     def update_chat(self, chat_id: int, data: Dict):
         """Обновить данные чата"""
-        chat_id_str = str(chat_id)
-        if chat_id_str in self.data["chats"]:
-            self.data["chats"][chat_id_str].update(data)
-            self.save()
+        chat_data = self.get_chat(chat_id)
+        if chat_data is not None:
+            chat_data.update(data)
+            self.mark_chat_dirty(chat_id)
     
     def add_stat(self, stat_name: str, value: int = 1):
-        """Добавить статистику"""
+        """Добавить статистику (в базу попадёт с очередной пачкой записи)"""
         if stat_name in self.data["statistics"]:
-            self.data["statistics"][stat_name] += value
-            self.save()
+            statistics_counter.inc(stat_name, amount=value)
+    
+    def sync_statistics(self) -> Dict:
+        """Перенести прирост счётчиков статистики из метрик в данные базы"""
+        statistics = self.data["statistics"]
+        for stat_name in statistics:
+            total = statistics_counter.get(stat_name)
+            delta = total - self._stats_synced.get(stat_name, 0)
+            if delta:
+                statistics[stat_name] += delta
+                self._stats_synced[stat_name] = total
+                # Без _note_change(): вызывается и из самой записи пачки
+                self._dirty_keys.add("statistics")
+        return statistics
+
+# Рабочая база процесса (main.db, в воркере - его раздел), а не последний созданный Database:
+# разделы split_database и базы бенчмарка в метрики не попадают и не удерживаются замыканием
+metrics.gauge("grand_db_chats_loaded", "Чатов в памяти",
+              func=lambda: len(db.data["chats"]))
+metrics.gauge("grand_db_dirty_chats", "Изменённых чатов, ожидающих записи",
+              func=lambda: len(db._dirty_chats))
+
+
+# ============= ЭКСПОРТ В JSON =============
 
-db = Database()
+def json_default(obj):
+    """Сериализация нестандартных типов для JSON"""
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    return str(obj)
+
+class JsonExporter:
+    """Экспорт базы в JSON-файлы: по файлу на чат, только изменённые чаты"""
+    
+    def __init__(self, database: Database, folder: str = JSON_EXPORT_FOLDER):
+        self.db = database
+        self.folder = folder
+    
+    def _chat_file(self, chat_id_str: str) -> str:
+        return f"{self.folder}/chat_{chat_id_str}.json"
+    
+    @staticmethod
+    def _write_blob(path: str, blob: bytes):
+        # Вне цикла событий: json.dump с отступами для больших чатов идёт долго.
+        # json.dump пишет в файл по частям, не собирая весь текст в памяти
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(pickle.loads(blob), f, default=json_default, indent=2, ensure_ascii=False)
+        os.replace(tmp_file, path)
+    
+    async def _write(self, path: str, data: Any):
+        # Снимок данных снимается на цикле событий (pickle - быстро и целиком),
+        # чтобы обработчики не меняли словари, пока поток пишет JSON
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        await asyncio.get_running_loop().run_in_executor(None, self._write_blob, path, blob)
+    
+    async def export(self, chat_id: Optional[int] = None, force: bool = False) -> Tuple[int, int]:
+        """Экспортировать один или все чаты, вернуть (записано, пропущено)"""
+        os.makedirs(self.folder, exist_ok=True)
+        
+        if chat_id is None:
+            global_data = {key: key_to_disk(key, value)
+                           for key, value in self.db.data.items() if key not in ("chats", "export_pending")}
+            await self._write(f"{self.folder}/global.json", global_data)
+            chat_ids = self.db.chat_ids()
+        else:
+            chat_ids = [str(chat_id)]
+        
+        export_pending = self.db.data["export_pending"]
+        exported = skipped = 0
+        for chat_id_str in chat_ids:
+            unchanged = (chat_id_str not in export_pending
+                         and os.path.exists(self._chat_file(chat_id_str)))
+            if unchanged and not force:
+                skipped += 1
+                continue
+            
+            chat_data = self.db.read_chat(chat_id_str)
+            if chat_data is None:
+                continue
+            # Отметку снимаем до записи: изменение чата во время записи поставит её снова
+            was_pending = chat_id_str in export_pending
+            export_pending.discard(chat_id_str)
+            try:
+                await self._write(self._chat_file(chat_id_str), chat_to_disk(chat_data))
+            except Exception:
+                if was_pending:
+                    export_pending.add(chat_id_str)
+                raise
+            if was_pending:
+                self.db.mark_key_dirty("export_pending")
+            exported += 1
+        
+        logger.info(f"Экспорт в JSON: записано {exported}, без изменений {skipped}")
+        return exported, skipped
+
+
+# ============= АГРЕГАЦИЯ АКТИВНОСТИ =============
+
+class ChatActivity:
+    """Несброшенные счётчики сообщений одного чата за текущие сутки"""
+    
+    __slots__ = ("slots", "user_ids", "counts", "last_seen", "hours", "total")
+    
+    def __init__(self):
+        self.slots: Dict[int, int] = {}  # user_id -> индекс в массивах
+        self.user_ids = array("q")
+        self.counts = array("I")
+        self.last_seen = array("q")
+        self.hours = array("I", (0,)) * 24
+        self.total = 0
+
+class ActivityAggregator:
+    """Счётчики сообщений по (чат, пользователь, сутки) в памяти
+    
+    На сообщение - только инкременты в массивах. Раз в ACTIVITY_ROLLUP_INTERVAL
+    (и на смене суток) счётчики переносятся в данные чатов: unity_scores,
+    last_messages (секунды эпохи), info.message_count и daily_stats.
+    
+    daily_stats: {"ГГГГ-ММ-ДД": DayStats} (в файле - {"messages": n, "hours": [24 числа], "users": {user_id: n}})
+    """
+    
+    def __init__(self):
+        self._chats: Dict[int, ChatActivity] = {}
+        self._start_day(time.time())
+    
+    def _start_day(self, now: float):
+        day = datetime.date.fromtimestamp(now)
+        self._day_key = day.isoformat()
+        self._day_start = datetime.datetime.combine(day, datetime.time()).timestamp()
+        self._day_end = datetime.datetime.combine(
+            day + datetime.timedelta(days=1), datetime.time()
+        ).timestamp()
+    
+    def record(self, chat_id: int, user_id: int):
+        """Учесть сообщение пользователя"""
+        now = time.time()
+        if now >= self._day_end:
+            # Счётчики относятся к прошедшим суткам - переносим их до смены дня
+            self.rollup()
+            self._start_day(now)
+        
+        pending = self._chats.get(chat_id)
+        if pending is None:
+            pending = self._chats[chat_id] = ChatActivity()
+        slot = pending.slots.get(user_id)
+        if slot is None:
+            slot = pending.slots[user_id] = len(pending.counts)
+            pending.user_ids.append(user_id)
+            pending.counts.append(0)
+            pending.last_seen.append(0)
+        pending.counts[slot] += 1
+        pending.last_seen[slot] = int(now)
+        hour = int(now - self._day_start) // 3600
+        pending.hours[hour if hour < 24 else 23] += 1
+        pending.total += 1
+    
+    def rollup(self, chat_id: Optional[int] = None) -> int:
+        """Перенести счётчики в данные чатов (одного или всех), вернуть число чатов"""
+        if chat_id is None:
+            items = list(self._chats.items())
+            self._chats = {}
+        else:
+            pending = self._chats.pop(chat_id, None)
+            items = [(chat_id, pending)] if pending is not None else []
+        
+        for pending_chat_id, pending in items:
+            chat_data = db.get_chat(pending_chat_id)
+            if chat_data is not None:
+                self._apply(pending_chat_id, chat_data, pending)
+        return len(items)
+    
+    def _apply(self, chat_id: int, chat_data: Dict, pending: ChatActivity):
+        activity = chat_data["activity"]
+        scores = activity["unity_scores"]
+        last_messages = activity["last_messages"]
+        daily_stats = activity.setdefault("daily_stats", {})
+        day = daily_stats.get(self._day_key)
+        if day is None:
+            day = daily_stats[self._day_key] = DayStats()
+        day_users = day["users"]
+        
+        board = leaderboards.find(chat_id, scores)
+        for user_id, count, seen in zip(pending.user_ids, pending.counts, pending.last_seen):
+            old = scores.get(user_id, 0)
+            scores[user_id] = old + count
+            if board is not None:
+                board.add(user_id, old, old + count)
+            last_messages[user_id] = seen
+            day_users[user_id] = day_users.get(user_id, 0) + count
+        
+        hours = day["hours"]
+        for hour, count in enumerate(pending.hours):
+            if count:
+                hours[hour] += count
+        day["messages"] += pending.total
+        
+        # Старые сутки удаляем: ключи ГГГГ-ММ-ДД сортируются как даты
+        if len(daily_stats) > ACTIVITY_KEEP_DAYS:
+            for old_day in sorted(daily_stats)[:-ACTIVITY_KEEP_DAYS]:
+                del daily_stats[old_day]
+        
+        chat_data["info"]["message_count"] += pending.total
+        chat_data["info"]["last_active"] = int(max(pending.last_seen))
+        db.mark_chat_dirty(chat_id)
+    
+    @staticmethod
+    def series(chat_data: Dict, period: str) -> List[Tuple[str, int]]:
+        """Число сообщений по корзинам: "hour" (сегодня), "day" или "week" (ISO-неделя)"""
+        daily_stats = chat_data["activity"].get("daily_stats", {})
+        if period == "hour":
+            today = daily_stats.get(datetime.date.today().isoformat())
+            hours = today["hours"] if today else [0] * 24
+            return [(f"{hour:02d}:00", count) for hour, count in enumerate(hours)]
+        
+        if period == "day":
+            return [(day_key, daily_stats[day_key]["messages"]) for day_key in sorted(daily_stats)]
+        
+        weeks: Dict[str, int] = {}
+        for day_key in sorted(daily_stats):
+            year, week, _ = datetime.date.fromisoformat(day_key).isocalendar()
+            week_key = f"{year}-W{week:02d}"
+            weeks[week_key] = weeks.get(week_key, 0) + daily_stats[day_key]["messages"]
+        return list(weeks.items())
+    
+    @staticmethod
+    def totals(chat_data: Dict, days: int = 1) -> Tuple[int, int]:
+        """Сообщений и разных авторов за последние days суток, включая сегодня"""
+        daily_stats = chat_data["activity"].get("daily_stats", {})
+        since = (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+        messages = 0
+        users = set()
+        for day_key, day in daily_stats.items():
+            if day_key >= since:
+                messages += day["messages"]
+                users.update(day["users"])
+        return messages, len(users)
+
+activity_aggregator = ActivityAggregator()
+
+class Leaderboard:
+    """Рейтинг активности чата, обновляемый на каждом приросте счёта
+    
+    Счёт только растёт, поэтому топ обновляется за O(K): пользователь
+    попадает в топ, лишь обогнав последнего в нём. Место пользователя -
+    бинарный поиск по отсортированному массиву счетов.
+    """
+    
+    TOP_SIZE = 10
+    
+    def __init__(self, scores: Dict[int, int]):
+        self.scores = scores
+        self.total = sum(scores.values())
+        self.sorted_scores = sorted(scores.values())
+        self.top = heapq.nlargest(self.TOP_SIZE, ((score, user_id) for user_id, score in scores.items()),
+                                  key=lambda x: x[0])
+    
+    def add(self, user_id: int, old: int, new: int):
+        """Счёт пользователя вырос с old до new (old = 0 - новый участник)"""
+        self.total += new - old
+        sorted_scores = self.sorted_scores
+        if old:
+            del sorted_scores[bisect.bisect_left(sorted_scores, old)]
+        bisect.insort(sorted_scores, new)
+        
+        top = self.top
+        for i, (_, top_user_id) in enumerate(top):
+            if top_user_id == user_id:
+                top[i] = (new, user_id)
+                break
+        else:
+            if len(top) < self.TOP_SIZE:
+                top.append((new, user_id))
+            elif new > top[-1][0]:
+                top[-1] = (new, user_id)
+            else:
+                return
+        top.sort(key=lambda x: x[0], reverse=True)
+    
+    def rank(self, user_id: int) -> Optional[int]:
+        """Место пользователя (1 - лучший) или None, если он не писал"""
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+        return len(self.sorted_scores) - bisect.bisect_right(self.sorted_scores, score) + 1
+
+class LeaderboardCache:
+    """Рейтинги загруженных чатов; строятся при первом запросе"""
+    
+    def __init__(self):
+        self._boards: Dict[int, Leaderboard] = {}
+    
+    def get(self, chat_id: int, chat_data: Dict) -> Leaderboard:
+        """Рейтинг чата (после выгрузки и загрузки чата строится заново)"""
+        scores = chat_data["activity"]["unity_scores"]
+        board = self._boards.get(chat_id)
+        if board is None or board.scores is not scores:
+            board = self._boards[chat_id] = Leaderboard(scores)
+        return board
+    
+    def find(self, chat_id: int, scores: Dict[int, int]) -> Optional[Leaderboard]:
+        """Уже построенный актуальный рейтинг чата"""
+        board = self._boards.get(chat_id)
+        if board is not None and board.scores is scores:
+            return board
+        return None
+    
+    def forget_unloaded(self):
+        """Удалить рейтинги чатов, выгруженных из памяти"""
+        chats = db.data["chats"]
+        for chat_id in [chat_id for chat_id in self._boards if str(chat_id) not in chats]:
+            del self._boards[chat_id]
+
+leaderboards = LeaderboardCache()
 
 # ============= ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =============
 
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    """Запустить задачу в фоне: ссылка хранится до завершения, ошибка пишется в лог"""
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+def _background_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Ошибка фоновой задачи: {task.exception()}")
+
+class UserStub:
+    """Заглушка профиля, если VK не вернул пользователя"""
+    
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = "Пользователь"
+        self.last_name = str(user_id)
+
+
+class UserResolver:
+    """Пакетная загрузка профилей через users.get с LRU+TTL кэшем"""
+    
+    # Максимум id в одном запросе users.get
+    BATCH_SIZE = 1000
+    
+    def __init__(self, size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL,
+                 window: float = USER_BATCH_WINDOW):
+        self.size = size
+        self.ttl = ttl
+        self.window = window
+        self._cache: "OrderedDict[int, Tuple[float, UsersUserFull]]" = OrderedDict()
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+    
+    def _cached(self, user_id: int):
+        entry = self._cache.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._cache[user_id]
+            return None
+        self._cache.move_to_end(user_id)
+        return entry[1]
+    
+    def _remember(self, user_id: int, user_info):
+        self._cache[user_id] = (time.monotonic() + self.ttl, user_info)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+    
+    async def resolve(self, user_ids) -> Dict[int, UsersUserFull]:
+        """Получить профили; промахи кэша собираются в общий запрос"""
+        result = {}
+        waiting = {}
+        loop = asyncio.get_running_loop()
+        
+        for user_id in user_ids:
+            if user_id in result or user_id in waiting:
+                continue
+            user_info = self._cached(user_id)
+            if user_info is not None:
+                result[user_id] = user_info
+                continue
+            
+            future = self._pending.get(user_id)
+            if future is None:
+                future = self._pending[user_id] = loop.create_future()
+            waiting[user_id] = future
+        
+        if waiting:
+            if self._flush_handle is None:
+                self._flush_handle = loop.call_later(
+                    self.window, lambda: spawn_background(self._flush())
+                )
+            for user_id, future in waiting.items():
+                result[user_id] = await asyncio.shield(future)
+        return result
+    
+    async def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        user_ids = list(pending)
+        
+        for i in range(0, len(user_ids), self.BATCH_SIZE):
+            chunk = user_ids[i:i + self.BATCH_SIZE]
+            found = {}
+            try:
+                users = await bot.api.users.get(
+                    user_ids=chunk,
+                    fields=["first_name", "last_name", "photo_50"]
+                )
+                for user_info in users:
+                    found[user_info.id] = user_info
+                    self._remember(user_info.id, user_info)
+            except Exception as e:
+                logger.error(f"Ошибка получения пользователей ({len(chunk)} шт.): {e}")
+            
+            for user_id in chunk:
+                future = pending[user_id]
+                if not future.done():
+                    future.set_result(found.get(user_id) or UserStub(user_id))
+
+user_resolver = UserResolver()
+
+async def get_users_info(user_ids) -> Dict[int, UsersUserFull]:
+    """Получить информацию о нескольких пользователях одним запросом"""
+    return await user_resolver.resolve(user_ids)
+
 async def get_user_info(user_id: int) -> UsersUserFull:
     """Получить информацию о пользователе"""
-    try:
-        users = await bot.api.users.get(
-            user_ids=[user_id],
-            fields=["first_name", "last_name", "photo_50"]
+    users = await user_resolver.resolve([user_id])
+    return users[user_id]
+
+class ConversationMembers:
+    """Снимок участников беседы"""
+    
+    __slots__ = ("members", "admins", "owners", "fetched_at")
+    
+    def __init__(self, items):
+        self.members = set()
+        self.admins = set()   # Включая владельцев
+        self.owners = set()
+        for member in items:
+            self.members.add(member.member_id)
+            if getattr(member, 'is_owner', False):
+                self.owners.add(member.member_id)
+                self.admins.add(member.member_id)
+            elif getattr(member, 'is_admin', False):
+                self.admins.add(member.member_id)
+        self.fetched_at = time.monotonic()
+
+
+class MemberCache:
+    """Кэш участников бесед с TTL и объединением одновременных запросов
+    
+    Ошибки запроса (бот не администратор беседы) тоже кэшируются, на
+    MEMBERS_ERROR_TTL. Записи хранятся в порядке получения, поэтому
+    устаревшие удаляются с начала, а при переполнении - самые старые.
+    """
+    
+    def __init__(self, ttl: float = MEMBERS_CACHE_TTL, error_ttl: float = MEMBERS_ERROR_TTL,
+                 max_size: int = MEMBERS_CACHE_SIZE):
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[int, ConversationMembers]" = OrderedDict()
+        # chat_id -> (момент ошибки, ошибка)
+        self._failures: "OrderedDict[int, Tuple[float, Exception]]" = OrderedDict()
+        self._inflight: Dict[int, asyncio.Future] = {}
+    
+    async def get(self, chat_id: int) -> ConversationMembers:
+        """Получить участников беседы из кэша или из API"""
+        now = time.monotonic()
+        entry = self._entries.get(chat_id)
+        if entry is not None and now - entry.fetched_at < self.ttl:
+            return entry
+        failure = self._failures.get(chat_id)
+        if failure is not None and now - failure[0] < self.error_ttl:
+            raise failure[1]
+        
+        # Если запрос по этому чату уже идёт - ждём его, а не делаем новый
+        task = self._inflight.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(chat_id))
+            self._inflight[chat_id] = task
+            task.add_done_callback(functools.partial(self._on_fetched, chat_id))
+        return await asyncio.shield(task)
+    
+    async def _fetch(self, chat_id: int) -> ConversationMembers:
+        response = await bot.api.messages.get_conversation_members(
+            peer_id=chat_id + 2000000000
         )
-        return users[0]
-    except Exception as e:
-        logger.error(f"Ошибка получения пользователя {user_id}: {e}")
-        # Возвращаем заглушку
-        class UserStub:
-            id = user_id
-            first_name = "Пользователь"
-            last_name = str(user_id)
-        return UserStub()
+        return ConversationMembers(response.items)
+    
+    def _on_fetched(self, chat_id: int, task: asyncio.Future):
+        # Запрос, начатый до invalidate(), в кэш не попадает
+        if self._inflight.get(chat_id) is not task:
+            return
+        del self._inflight[chat_id]
+        if task.cancelled():
+            return
+        now = time.monotonic()
+        self._prune(now)
+        if task.exception() is None:
+            self._failures.pop(chat_id, None)
+            self._put(self._entries, chat_id, task.result())
+        else:
+            self._entries.pop(chat_id, None)
+            self._put(self._failures, chat_id, (now, task.exception()))
+    
+    def _put(self, cache: OrderedDict, chat_id: int, value: Any):
+        cache[chat_id] = value
+        cache.move_to_end(chat_id)
+        while len(cache) > self.max_size:
+            cache.popitem(last=False)
+    
+    def _prune(self, now: float):
+        # Записи идут в порядке получения: устаревшие - в начале
+        entries, failures = self._entries, self._failures
+        while entries and now - next(iter(entries.values())).fetched_at >= self.ttl:
+            entries.popitem(last=False)
+        while failures and now - next(iter(failures.values()))[0] >= self.error_ttl:
+            failures.popitem(last=False)
+    
+    def invalidate(self, chat_id: int):
+        """Сбросить кэш беседы (состав участников изменился)"""
+        self._entries.pop(chat_id, None)
+        self._failures.pop(chat_id, None)
+        self._inflight.pop(chat_id, None)
+
+member_cache = MemberCache()
 
 async def is_admin(chat_id: int, user_id: int) -> bool:
     """Проверить админские права в беседе"""
@@ -226,18 +2482,8 @@ async def is_admin(chat_id: int, user_id: int) -> bool:
             return True
         
         # Проверяем права в беседе ВК
-        chat_info = await bot.api.messages.get_conversation_members(
-            peer_id=chat_id + 2000000000
-        )
-        
-        for member in chat_info.items:
-            if member.member_id == user_id:
-                if hasattr(member, 'is_admin') and member.is_admin:
-                    return True
-                if hasattr(member, 'is_owner') and member.is_owner:
-                    return True
-        
-        return False
+        members = await member_cache.get(chat_id)
+        return user_id in members.admins
     except Exception as e:
         logger.error(f"Ошибка проверки админа: {e}")
         return False
@@ -262,9 +2508,13 @@ async def check_permission(message: Message, command_type: str = "user") -> Tupl
     chat_id = message.peer_id - 2000000000
     user_id = message.from_id
     
-    # Проверка глобального бана
-    if user_id in db.data["global_bans"]:
-        return False, "🚫 Вы забанены глобально!"
+    # Проверка глобального бана и мута
+    sanction = db.global_sanctions.get(user_id)
+    if sanction is not None:
+        if sanction == GLOBAL_BAN:
+            return False, "🚫 Вы забанены глобально!"
+        if sanction > time.time():
+            return False, "🔇 У вас глобальный мут!"
     
     # Права для разных типов команд
     if command_type == "user":
@@ -287,37 +2537,147 @@ async def check_permission(message: Message, command_type: str = "user") -> Tupl
     
     return False, "❌ Недостаточно прав!"
 
+class VKExecuteError(Exception):
+    """Ошибка отдельного вызова внутри execute"""
+
+
+class ApiBatcher:
+    """Собирает вызовы API за короткое окно и отправляет их одним execute"""
+    
+    def __init__(self, window: float = API_BATCH_WINDOW, max_calls: int = EXECUTE_MAX_CALLS):
+        self.window = window
+        self.max_calls = max_calls
+        self._calls: List[Tuple[str, Dict, asyncio.Future]] = []
+        # (peer_id, delete_for_all) -> (id сообщений, общий future)
+        self._deletes: Dict[Tuple[int, int], Tuple[List[int], asyncio.Future]] = {}
+        self._flush_handle: Optional[asyncio.Handle] = None
+    
+    def submit(self, method: str, params: Dict) -> asyncio.Future:
+        """Поставить вызов в пачку; результат придёт в future"""
+        future = asyncio.get_running_loop().create_future()
+        self._calls.append((method, params, future))
+        self._schedule()
+        return future
+    
+    def fire(self, method: str, params: Dict) -> asyncio.Future:
+        """Поставить вызов в пачку, не дожидаясь результата (ошибки пишутся в лог)"""
+        future = self.submit(method, params)
+        future.add_done_callback(self._log_failure)
+        return future
+    
+    def delete_message(self, peer_id: int, message_id: int, delete_for_all: int = 0) -> asyncio.Future:
+        """Удалить сообщение; удаления в одном чате сливаются в один messages.delete"""
+        key = (peer_id, delete_for_all)
+        if key not in self._deletes:
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(self._log_failure)
+            self._deletes[key] = ([], future)
+        message_ids, future = self._deletes[key]
+        message_ids.append(message_id)
+        self._schedule()
+        return future
+    
+    @staticmethod
+    def _log_failure(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Ошибка вызова API: {future.exception()}")
+    
+    def _schedule(self):
+        loop = asyncio.get_running_loop()
+        if len(self._calls) + len(self._deletes) >= self.max_calls:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+            self._flush_handle = loop.call_soon(self._start_flush)
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._start_flush)
+    
+    def _start_flush(self):
+        self._flush_handle = None
+        calls, self._calls = self._calls, []
+        for (peer_id, delete_for_all), (message_ids, future) in self._deletes.items():
+            calls.append(("messages.delete", {
+                "peer_id": peer_id,
+                "message_ids": message_ids,
+                "delete_for_all": delete_for_all
+            }, future))
+        self._deletes = {}
+        
+        if calls:
+            spawn_background(self._flush(calls))
+    
+    async def _flush(self, calls: List[Tuple[str, Dict, asyncio.Future]]):
+        for i in range(0, len(calls), self.max_calls):
+            await self._execute(calls[i:i + self.max_calls])
+    
+    @staticmethod
+    def _encode(params: Dict) -> Dict:
+        # Списки VK принимает строкой через запятую
+        return {key: ",".join(map(str, value)) if isinstance(value, list) else value
+                for key, value in params.items()}
+    
+    async def _execute(self, chunk: List[Tuple[str, Dict, asyncio.Future]]):
+        try:
+            if len(chunk) == 1:
+                method, params, _ = chunk[0]
+                response = await bot.api.request(method, self._encode(params))
+                results = [response["response"]]
+                errors = iter(())
+            else:
+                code = "return [" + ",".join(
+                    f"API.{method}({json.dumps(self._encode(params), ensure_ascii=False)})"
+                    for method, params, _ in chunk
+                ) + "];"
+                response = await bot.api.request("execute", {"code": code})
+                results = response["response"]
+                errors = iter(response.get("execute_errors") or ())
+        except Exception as e:
+            for _, _, future in chunk:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (method, _, future), result in zip(chunk, results):
+            if future.done():
+                continue
+            # Упавший вызов execute возвращает false, а описание ошибки - в execute_errors
+            if result is False:
+                error = next(errors, {})
+                api_errors.inc(method, error.get("error_code", "execute"))
+                future.set_exception(VKExecuteError(f"{method}: {error.get('error_msg', 'ошибка')}"))
+            else:
+                future.set_result(result)
+
+api_batcher = ApiBatcher()
+
 async def send_reply(message: Message, text: str, **kwargs):
     """Отправить ответ"""
+    if not kwargs:
+        # Обычный текстовый ответ уходит в общей пачке вызовов API
+        api_batcher.fire("messages.send", {
+            "peer_id": message.peer_id,
+            "message": text,
+            "random_id": random.getrandbits(31)
+        })
+        return
     try:
         await message.answer(text, **kwargs)
     except Exception as e:
         logger.error(f"Ошибка отправки: {e}")
 
-async def extract_user_id(text: str) -> Optional[int]:
+def extract_user_id(text: str) -> Optional[int]:
     """Извлечь ID пользователя из текста"""
-    try:
-        # Паттерны для поиска ID
-        patterns = [
-            r'\[id(\d+)\|',
-            r'@id(\d+)',
-            r'vk\.com/id(\d+)'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, text)
-            if match:
-                return int(match.group(1))
-        
-        # Если это просто число
-        if text.isdigit():
-            return int(text)
-        
-        return None
-    except:
-        return None
+    # Упоминание [id123|Имя], @id123 или ссылка vk.com/id123
+    match = MENTION_RE.search(text)
+    if match:
+        return int(match.group(1) or match.group(2) or match.group(3))
+    
+    # Если это просто число
+    if text.isdigit():
+        return int(text)
+    
+    return None
 
-async def parse_duration(duration_str: str) -> Optional[int]:
+def parse_duration(duration_str: str) -> Optional[int]:
     """Парсинг длительности мута"""
     duration_str = duration_str.lower().strip()
     
@@ -338,7 +2698,7 @@ async def parse_duration(duration_str: str) -> Optional[int]:
     except:
         return None
 
-async def format_time(minutes: int) -> str:
+def format_time(minutes: int) -> str:
     """Форматировать время"""
     if minutes >= 10080:  # недели
         weeks = minutes // 10080
@@ -358,20 +2718,359 @@ async def mention_user(user_id: int, user_info: UsersUserFull = None) -> str:
         user_info = await get_user_info(user_id)
     return f"[id{user_id}|{user_info.first_name} {user_info.last_name}]"
 
+# ============= МАРШРУТИЗАЦИЯ КОМАНД =============
+
+class CommandArgs(list):
+    """Слова сообщения (args[0] - сама команда) и аргументы, разобранные по спецификации команды
+    
+    Спецификация - кортеж видов позиционных аргументов:
+    "target" - пользователь (упоминание, ссылка или id) -> target,
+    "duration" - срок в минутах -> duration,
+    "word" - слово, которое обработчик разбирает сам,
+    "text" - остаток сообщения -> text.
+    Неверное или отсутствующее значение - None; сообщение об ошибке выбирает обработчик.
+    """
+    
+    __slots__ = ("target", "duration", "text")
+    
+    def __init__(self, words: List[str], spec: Tuple[str, ...] = ()):
+        super().__init__(words)
+        self.target: Optional[int] = None
+        self.duration: Optional[int] = None
+        self.text: Optional[str] = None
+        for position, kind in enumerate(spec, 1):
+            if position >= len(words):
+                break
+            if kind == "target":
+                self.target = extract_user_id(words[position])
+            elif kind == "duration":
+                self.duration = parse_duration(words[position])
+            elif kind == "text":
+                self.text = " ".join(words[position:])
+                break
+
+
+class ParsedCommand:
+    """Команда, разобранная один раз на сообщение"""
+    
+    __slots__ = ("prefix", "name", "args")
+    
+    def __init__(self, prefix: str, name: str, args: CommandArgs):
+        self.prefix = prefix
+        self.name = name
+        self.args = args
+
+
+class CommandRouter:
+    """Таблица встроенных команд: имя -> обработчик и спецификация аргументов"""
+    
+    def __init__(self, prefixes: List[str] = COMMAND_PREFIXES):
+        self.prefixes = frozenset(prefixes)
+        self.handlers: Dict[str, Any] = {}
+        self.specs: Dict[str, Tuple[str, ...]] = {}
+    
+    def command(self, *names: str, spec: Tuple[str, ...] = ()):
+        """Зарегистрировать обработчик под одним или несколькими именами"""
+        def decorator(handler):
+            timed_handler = instrumented(names[0])(handler)
+            for name in names:
+                self.handlers[name] = timed_handler
+                self.specs[name] = spec
+            return handler
+        return decorator
+    
+    def parse(self, text: str) -> Optional[ParsedCommand]:
+        """Разобрать префикс, имя команды и аргументы за один проход"""
+        if not text or text[0] not in self.prefixes:
+            return None
+        words = text.split()
+        name = words[0][1:].lower()
+        return ParsedCommand(text[0], name, CommandArgs(words, self.specs.get(name, ())))
+
+command_router = CommandRouter()
+
+# ============= РАССЫЛКА =============
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate операций в секунду"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Дождаться разрешения на одну операцию"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Broadcaster:
+    """Рассылка одного сообщения по многим беседам с учётом лимитов VK"""
+    
+    def __init__(self, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY,
+                 peers_per_call: int = BROADCAST_PEERS_PER_CALL, retries: int = BROADCAST_RETRIES):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.peers_per_call = peers_per_call
+        self.retries = retries
+    
+    async def broadcast(self, peer_ids: List[int], text: str, progress=None) -> Tuple[int, int]:
+        """Разослать сообщение, вернуть (доставлено, ошибок)
+        
+        progress(доставлено, ошибок, всего) вызывается после каждой пачки получателей.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        chunks = [peer_ids[i:i + self.peers_per_call]
+                  for i in range(0, len(peer_ids), self.peers_per_call)]
+        counters = {"delivered": 0, "failed": 0}
+        
+        async def send_chunk(chunk: List[int]):
+            async with semaphore:
+                delivered, failed = await self._send_chunk(chunk, text)
+            counters["delivered"] += delivered
+            counters["failed"] += failed
+            if progress is not None:
+                await progress(counters["delivered"], counters["failed"], len(peer_ids))
+        
+        await asyncio.gather(*(send_chunk(chunk) for chunk in chunks))
+        return counters["delivered"], counters["failed"]
+    
+    async def _send_chunk(self, chunk: List[int], text: str) -> Tuple[int, int]:
+        # Один random_id на все попытки: VK не продублирует уже доставленное
+        random_id = random.getrandbits(31)
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            try:
+                results = await bot.api.messages.send(
+                    peer_ids=chunk,
+                    message=text,
+                    random_id=random_id
+                )
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(f"Рассылка: пачка из {len(chunk)} чатов не отправлена: {e}")
+                    return 0, len(chunk)
+                await asyncio.sleep(2 ** attempt)
+                continue
+            
+            failed = sum(1 for item in results if getattr(item, "error", None))
+            return len(chunk) - failed, failed
+        return 0, len(chunk)
+
+broadcaster = Broadcaster()
+
+# ============= ПЛАНИРОВЩИК МУТОВ =============
+
+# chat_id записи планировщика для глобального мута
+GLOBAL_MUTE_CHAT = 0
+
+class MuteScheduler:
+    """Снятие мутов по сроку: мин-куча сроков и фоновая задача"""
+    
+    def __init__(self):
+        # (срок, chat_id, user_id); снятые и продлённые муты отсеиваются при извлечении.
+        # Глобальные муты лежат в той же куче с chat_id = GLOBAL_MUTE_CHAT
+        self._heap: List[Tuple[float, int, int]] = []
+        self._wakeup = asyncio.Event()
+    
+    def schedule(self, chat_id: int, user_id: int, until: float):
+        """Запланировать снятие мута"""
+        heapq.heappush(self._heap, (until, chat_id, user_id))
+        if self._heap[0][0] == until:
+            self._wakeup.set()
+    
+    def load(self, database: "Database"):
+        """Заполнить кучу мутами из базы"""
+        for chat_id_str, user_id, until in database.iter_mutes():
+            self._heap.append((until, int(chat_id_str), user_id))
+        for user_id, until in database.data["global_mutes"].items():
+            self._heap.append((until, GLOBAL_MUTE_CHAT, user_id))
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+    
+    async def run(self):
+        """Фоновая задача: спит до ближайшего срока и снимает истёкшие муты"""
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            if not self._heap or self._heap[0][0] > now:
+                timeout = self._heap[0][0] - now if self._heap else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            while self._heap and self._heap[0][0] <= now:
+                until, chat_id, user_id = heapq.heappop(self._heap)
+                try:
+                    self._expire(chat_id, user_id, until)
+                except Exception as e:
+                    logger.error(f"Ошибка снятия мута {user_id} в чате {chat_id}: {e}")
+    
+    def _expire(self, chat_id: int, user_id: int, until: float):
+        if chat_id == GLOBAL_MUTE_CHAT:
+            if db.data["global_mutes"].get(user_id) == until:
+                db.global_unmute(user_id)
+            return
+        
+        chat_data = db.get_chat(chat_id)
+        # Мут уже снят вручную или продлён - запись в куче устарела
+        if not chat_data or chat_data["moderation"]["mutes"].get(user_id) != until:
+            return
+        
+        del chat_data["moderation"]["mutes"][user_id]
+        db.mark_chat_dirty(chat_id)
+        
+        if chat_data["settings"].get("unmute_notice", False):
+            spawn_background(self._notify(chat_id, user_id))
+    
+    async def _notify(self, chat_id: int, user_id: int):
+        try:
+            user_mention = await mention_user(user_id)
+            await api_batcher.submit("messages.send", {
+                "peer_id": chat_id + 2000000000,
+                "message": f"🔊 Срок мута {user_mention} истёк",
+                "random_id": random.getrandbits(31)
+            })
+        except Exception as e:
+            logger.error(f"Ошибка уведомления о размуте: {e}")
+
+mute_scheduler = MuteScheduler()
+
+# ============= АНТИФЛУД =============
+
+class FloodWindow:
+    """Кольцевой буфер времён последних сообщений пользователя в чате"""
+    
+    __slots__ = ("times", "pos")
+    
+    def __init__(self, size: int):
+        self.times = array("d", (float("-inf"),)) * size
+        self.pos = 0
+
+class AntiFlood:
+    """Детектор флуда на скользящем окне
+    
+    Для каждого (чат, пользователь) хранится буфер моментов N-1 последних
+    сообщений. Флуд - если N сообщений, включая текущее, уложились
+    в flood_seconds. Буфер выделяется один раз, на сообщение
+    приходится только запись числа в массив; в базу ничего не пишется.
+    """
+    
+    def __init__(self):
+        # chat_id -> {user_id: FloodWindow}
+        self._windows: Dict[int, Dict[int, FloodWindow]] = {}
+        self._last_sweep = time.monotonic()
+    
+    def hit(self, chat_id: int, user_id: int, settings: Dict) -> bool:
+        """Учесть сообщение и вернуть True, если порог превышен"""
+        # Текущее сообщение плюс N-1 предыдущих из буфера
+        size = max(settings.get("flood_messages", DEFAULT_SETTINGS["flood_messages"]) - 1, 1)
+        chat_windows = self._windows.get(chat_id)
+        if chat_windows is None:
+            chat_windows = self._windows[chat_id] = {}
+        window = chat_windows.get(user_id)
+        if window is None or len(window.times) != size:
+            window = chat_windows[user_id] = FloodWindow(size)
+        
+        now = time.monotonic()
+        times = window.times
+        pos = window.pos
+        oldest = times[pos]
+        times[pos] = now
+        window.pos = pos + 1 if pos + 1 < size else 0
+        return now - oldest < settings.get("flood_seconds", DEFAULT_SETTINGS["flood_seconds"])
+    
+    def reset(self, chat_id: int, user_id: int):
+        """Сбросить счётчик пользователя (после наказания)"""
+        chat_windows = self._windows.get(chat_id)
+        if chat_windows:
+            chat_windows.pop(user_id, None)
+    
+    def sweep(self) -> int:
+        """Удалить счётчики пользователей, давно не писавших; вернуть их количество"""
+        now = time.monotonic()
+        if now - self._last_sweep < FLOOD_FORGET_AFTER:
+            return 0
+        self._last_sweep = now
+        
+        deadline = now - FLOOD_FORGET_AFTER
+        removed = 0
+        for chat_id, chat_windows in list(self._windows.items()):
+            for user_id, window in list(chat_windows.items()):
+                if window.times[window.pos - 1] < deadline:
+                    del chat_windows[user_id]
+                    removed += 1
+            if not chat_windows:
+                del self._windows[chat_id]
+        return removed
+    
+    async def punish(self, message: Message, chat_data: Dict) -> bool:
+        """Наказать за флуд через мут или варн; True, если сообщение удалено"""
+        chat_id = message.peer_id - 2000000000
+        user_id = message.from_id
+        self.reset(chat_id, user_id)
+        
+        # Модераторов и админов не трогаем
+        if await is_moderator(chat_id, user_id):
+            return False
+        
+        settings = chat_data["settings"]
+        user_mention = await mention_user(user_id)
+        
+        if settings.get("flood_action", DEFAULT_SETTINGS["flood_action"]) == "warn":
+            warns = chat_data["moderation"]["warns"].get(user_id, 0) + 1
+            max_warns = settings.get("max_warns", 3)
+            chat_data["moderation"]["warns"][user_id] = warns
+            response = f"⚠️ {user_mention} получил предупреждение за флуд!\n📊 Варнов: {warns}/{max_warns}"
+            
+            if warns >= max_warns and user_id not in chat_data["moderation"]["bans"]:
+                chat_data["moderation"]["bans"].add(user_id)
+                db.add_stat("total_bans")
+                response += "\n🚫 Лимит предупреждений достигнут - бан"
+                api_batcher.fire("messages.removeChatUser", {"chat_id": chat_id, "user_id": user_id})
+            db.mark_chat_dirty(chat_id)
+            logger.info(f"Антифлуд: варн {user_id} в чате {chat_id} ({warns}/{max_warns})")
+        else:
+            duration = settings.get("flood_mute_minutes", DEFAULT_SETTINGS["flood_mute_minutes"])
+            mute_until = time.time() + duration * 60
+            chat_data["moderation"]["mutes"][user_id] = mute_until
+            db.mark_chat_dirty(chat_id)
+            mute_scheduler.schedule(chat_id, user_id, mute_until)
+            db.add_stat("total_mutes")
+            response = f"🔇 {user_mention} замучен на {format_time(duration)} за флуд!"
+            logger.info(f"Антифлуд: мут {user_id} в чате {chat_id} на {duration} мин.")
+        
+        api_batcher.delete_message(message.peer_id, message.id)
+        await send_reply(message, response)
+        return True
+
+anti_flood = AntiFlood()
+
 # ============= КОМАНДЫ МОДЕРАЦИИ =============
 
-@labeler.message(text=["/ban", "!ban"])
-async def ban_handler(message: Message):
+@command_router.command("ban", spec=("target", "text"))
+async def ban_handler(message: Message, args: CommandArgs):
     """Бан пользователя"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 2:
         return await send_reply(message, "❌ Использование: /ban @user [причина]")
     
-    target_id = await extract_user_id(args[1])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
@@ -385,12 +3084,12 @@ async def ban_handler(message: Message):
     if await is_admin(chat_id, target_id):
         return await send_reply(message, "❌ Нельзя забанить администратора!")
     
-    reason = " ".join(args[2:]) if len(args) > 2 else "Не указана"
+    reason = args.text or "Не указана"
     
     # Выполняем бан
     chat_data = db.init_chat(chat_id)
     if target_id not in chat_data["moderation"]["bans"]:
-        chat_data["moderation"]["bans"].append(target_id)
+        chat_data["moderation"]["bans"].add(target_id)
         db.update_chat(chat_id, chat_data)
         db.add_stat("total_bans")
     
@@ -406,26 +3105,19 @@ async def ban_handler(message: Message):
     await send_reply(message, response)
     
     # Пытаемся кикнуть
-    try:
-        await bot.api.messages.remove_chat_user(
-            chat_id=chat_id,
-            user_id=target_id
-        )
-    except:
-        pass
+    api_batcher.fire("messages.removeChatUser", {"chat_id": chat_id, "user_id": target_id})
 
-@labeler.message(text=["/unban", "!unban"])
-async def unban_handler(message: Message):
+@command_router.command("unban", spec=("target",))
+async def unban_handler(message: Message, args: CommandArgs):
     """Разбан пользователя"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 2:
         return await send_reply(message, "❌ Использование: /unban @user")
     
-    target_id = await extract_user_id(args[1])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
@@ -436,7 +3128,7 @@ async def unban_handler(message: Message):
         return await send_reply(message, "⚠️ Этот пользователь не забанен")
     
     # Удаляем бан
-    chat_data["moderation"]["bans"].remove(target_id)
+    chat_data["moderation"]["bans"].discard(target_id)
     db.update_chat(chat_id, chat_data)
     
     target_info = await get_user_info(target_id)
@@ -444,14 +3136,13 @@ async def unban_handler(message: Message):
     
     await send_reply(message, f"✅ Пользователь {target_mention} разбанен!")
 
-@labeler.message(text=["/mute", "!mute"])
-async def mute_handler(message: Message):
+@command_router.command("mute", spec=("target", "duration", "text"))
+async def mute_handler(message: Message, args: CommandArgs):
     """Мут пользователя"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 3:
         return await send_reply(message, 
             "❌ Использование: /mute @user время [причина]\n"
@@ -459,7 +3150,7 @@ async def mute_handler(message: Message):
             "Доступно: 15m, 30m, 1h, 3h, 6h, 12h, 1d, 3d, 7d, 30d"
         )
     
-    target_id = await extract_user_id(args[1])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
@@ -472,7 +3163,7 @@ async def mute_handler(message: Message):
     if await is_admin(chat_id, target_id):
         return await send_reply(message, "❌ Нельзя замутить администратора!")
     
-    duration = await parse_duration(args[2])
+    duration = args.duration
     if not duration:
         return await send_reply(message, "❌ Неверное время мута!")
     
@@ -480,18 +3171,19 @@ async def mute_handler(message: Message):
     if duration > 43200:
         duration = 43200
     
-    reason = " ".join(args[3:]) if len(args) > 3 else "Не указана"
+    reason = args.text or "Не указана"
     
     # Устанавливаем мут
-    mute_until = datetime.datetime.now() + datetime.timedelta(minutes=duration)
+    mute_until = time.time() + duration * 60
     chat_data = db.init_chat(chat_id)
-    chat_data["moderation"]["mutes"][target_id] = mute_until.isoformat()
+    chat_data["moderation"]["mutes"][target_id] = mute_until
     db.update_chat(chat_id, chat_data)
+    mute_scheduler.schedule(chat_id, target_id, mute_until)
     db.add_stat("total_mutes")
     
     target_info = await get_user_info(target_id)
     target_mention = await mention_user(target_id, target_info)
-    time_str = await format_time(duration)
+    time_str = format_time(duration)
     
     response = (
         f"🔇 Пользователь {target_mention} замучен на {time_str}!\n"
@@ -501,18 +3193,17 @@ async def mute_handler(message: Message):
     
     await send_reply(message, response)
 
-@labeler.message(text=["/unmute", "!unmute"])
-async def unmute_handler(message: Message):
+@command_router.command("unmute", spec=("target",))
+async def unmute_handler(message: Message, args: CommandArgs):
     """Снятие мута"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 2:
         return await send_reply(message, "❌ Использование: /unmute @user")
     
-    target_id = await extract_user_id(args[1])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
@@ -531,18 +3222,17 @@ async def unmute_handler(message: Message):
     
     await send_reply(message, f"🔊 Пользователь {target_mention} размучен!")
 
-@labeler.message(text=["/kick", "!kick"])
-async def kick_handler(message: Message):
+@command_router.command("kick", spec=("target", "text"))
+async def kick_handler(message: Message, args: CommandArgs):
     """Кик пользователя"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 2:
         return await send_reply(message, "❌ Использование: /kick @user [причина]")
     
-    target_id = await extract_user_id(args[1])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
@@ -555,13 +3245,10 @@ async def kick_handler(message: Message):
     if await is_admin(chat_id, target_id):
         return await send_reply(message, "❌ Нельзя кикнуть администратора!")
     
-    reason = " ".join(args[2:]) if len(args) > 2 else "Не указана"
+    reason = args.text or "Не указана"
     
     try:
-        await bot.api.messages.remove_chat_user(
-            chat_id=chat_id,
-            user_id=target_id
-        )
+        await api_batcher.submit("messages.removeChatUser", {"chat_id": chat_id, "user_id": target_id})
         
         target_info = await get_user_info(target_id)
         target_mention = await mention_user(target_id, target_info)
@@ -578,18 +3265,17 @@ async def kick_handler(message: Message):
     except Exception as e:
         await send_reply(message, f"❌ Ошибка кика: {str(e)}")
 
-@labeler.message(text=["/warn", "!warn"])
-async def warn_handler(message: Message):
+@command_router.command("warn", spec=("target", "text"))
+async def warn_handler(message: Message, args: CommandArgs):
     """Выдать предупреждение"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 2:
         return await send_reply(message, "❌ Использование: /warn @user [причина]")
     
-    target_id = await extract_user_id(args[1])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
@@ -599,7 +3285,7 @@ async def warn_handler(message: Message):
     if target_id == user_id:
         return await send_reply(message, "❌ Нельзя выдать варн себе!")
     
-    reason = " ".join(args[2:]) if len(args) > 2 else "Не указана"
+    reason = args.text or "Не указана"
     
     # Добавляем варн
     chat_data = db.init_chat(chat_id)
@@ -624,7 +3310,7 @@ async def warn_handler(message: Message):
     # Если достигнут лимит - бан
     if warns >= max_warns:
         if target_id not in chat_data["moderation"]["bans"]:
-            chat_data["moderation"]["bans"].append(target_id)
+            chat_data["moderation"]["bans"].add(target_id)
             db.update_chat(chat_id, chat_data)
             db.add_stat("total_bans")
         
@@ -634,32 +3320,25 @@ async def warn_handler(message: Message):
         )
         await send_reply(message, ban_response)
         
-        try:
-            await bot.api.messages.remove_chat_user(
-                chat_id=chat_id,
-                user_id=target_id
-            )
-        except:
-            pass
+        api_batcher.fire("messages.removeChatUser", {"chat_id": chat_id, "user_id": target_id})
 
 # ============= КОМАНДЫ НИКНЕЙМОВ =============
 
-@labeler.message(text=["/snick", "!snick"])
-async def set_nick_handler(message: Message):
+@command_router.command("snick", spec=("target", "text"))
+async def set_nick_handler(message: Message, args: CommandArgs):
     """Установить никнейм"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 3:
         return await send_reply(message, "❌ Использование: /snick @user никнейм")
     
-    target_id = await extract_user_id(args[1])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
-    nickname = " ".join(args[2:])
+    nickname = args.text
     if len(nickname) > 32:
         return await send_reply(message, "❌ Никнейм слишком длинный (макс. 32 символа)")
     
@@ -680,17 +3359,16 @@ async def set_nick_handler(message: Message):
     
     await send_reply(message, response)
 
-@labeler.message(text=["/gnick", "!gnick"])
-async def get_nick_handler(message: Message):
+@command_router.command("gnick", spec=("target",))
+async def get_nick_handler(message: Message, args: CommandArgs):
     """Получить никнейм"""
-    args = message.text.split()
     chat_id = message.peer_id - 2000000000
     chat_data = db.get_chat(chat_id)
     
     if len(args) < 2:
         target_id = message.from_id
     else:
-        target_id = await extract_user_id(args[1])
+        target_id = args.target
         if not target_id:
             return await send_reply(message, "❌ Неверное упоминание пользователя")
     
@@ -708,18 +3386,17 @@ async def get_nick_handler(message: Message):
     
     await send_reply(message, response)
 
-@labeler.message(text=["/rnick", "!rnick"])
-async def remove_nick_handler(message: Message):
+@command_router.command("rnick", spec=("target",))
+async def remove_nick_handler(message: Message, args: CommandArgs):
     """Удалить никнейм"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 2:
         return await send_reply(message, "❌ Использование: /rnick @user")
     
-    target_id = await extract_user_id(args[1])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
@@ -738,8 +3415,8 @@ async def remove_nick_handler(message: Message):
     
     await send_reply(message, f"🗑️ Никнейм удален: {target_mention} ({nickname})")
 
-@labeler.message(text=["/nlist", "!nlist"])
-async def nick_list_handler(message: Message):
+@command_router.command("nlist")
+async def nick_list_handler(message: Message, args: List[str]):
     """Список никнеймов"""
     chat_id = message.peer_id - 2000000000
     chat_data = db.get_chat(chat_id)
@@ -750,12 +3427,11 @@ async def nick_list_handler(message: Message):
     nicknames = chat_data["users"]["nicknames"]
     response = "📝 Список никнеймов:\n\n"
     
+    users_info = await get_users_info(nicknames)
+    
     for user_id, nickname in nicknames.items():
-        try:
-            user_info = await get_user_info(user_id)
-            name = f"{user_info.first_name} {user_info.last_name}"
-        except:
-            name = f"Пользователь {user_id}"
+        user_info = users_info[user_id]
+        name = f"{user_info.first_name} {user_info.last_name}"
         
         response += f"• {name}: {nickname}\n"
     
@@ -763,19 +3439,18 @@ async def nick_list_handler(message: Message):
 
 # ============= СИСТЕМА РОЛЕЙ =============
 
-@labeler.message(text=["/addrole", "!addrole"])
-async def add_role_handler(message: Message):
+@command_router.command("addrole", spec=("word", "target"))
+async def add_role_handler(message: Message, args: CommandArgs):
     """Добавить роль"""
     allowed, error = await check_permission(message, "admin")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 3:
         return await send_reply(message, "❌ Использование: /addrole роль @user")
     
     role_name = args[1].lower()
-    target_id = await extract_user_id(args[2])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
@@ -784,14 +3459,14 @@ async def add_role_handler(message: Message):
     
     # Инициализируем роль если её нет
     if role_name not in chat_data["users"]["roles"]:
-        chat_data["users"]["roles"][role_name] = []
+        chat_data["users"]["roles"][role_name] = set()
     
     # Проверяем есть ли уже роль
     if target_id in chat_data["users"]["roles"][role_name]:
         return await send_reply(message, f"⚠️ У пользователя уже есть роль '{role_name}'")
     
     # Добавляем роль
-    chat_data["users"]["roles"][role_name].append(target_id)
+    chat_data["users"]["roles"][role_name].add(target_id)
     db.update_chat(chat_id, chat_data)
     
     target_info = await get_user_info(target_id)
@@ -799,19 +3474,18 @@ async def add_role_handler(message: Message):
     
     await send_reply(message, f"🎭 Роль '{role_name}' добавлена пользователю {target_mention}")
 
-@labeler.message(text=["/rr", "!rr"])
-async def remove_role_handler(message: Message):
+@command_router.command("rr", spec=("word", "target"))
+async def remove_role_handler(message: Message, args: CommandArgs):
     """Удалить роль"""
     allowed, error = await check_permission(message, "admin")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 3:
         return await send_reply(message, "❌ Использование: /rr роль @user")
     
     role_name = args[1].lower()
-    target_id = await extract_user_id(args[2])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
@@ -825,7 +3499,7 @@ async def remove_role_handler(message: Message):
         return await send_reply(message, f"⚠️ У пользователя нет роли '{role_name}'")
     
     # Удаляем роль
-    chat_data["users"]["roles"][role_name].remove(target_id)
+    chat_data["users"]["roles"][role_name].discard(target_id)
     
     # Удаляем пустую роль
     if not chat_data["users"]["roles"][role_name]:
@@ -838,16 +3512,15 @@ async def remove_role_handler(message: Message):
     
     await send_reply(message, f"🗑️ Роль '{role_name}' удалена у пользователя {target_mention}")
 
-@labeler.message(text=["/role", "!role"])
-async def get_role_handler(message: Message):
+@command_router.command("role", spec=("target",))
+async def get_role_handler(message: Message, args: CommandArgs):
     """Получить роли пользователя"""
-    args = message.text.split()
     chat_id = message.peer_id - 2000000000
     
     if len(args) < 2:
         target_id = message.from_id
     else:
-        target_id = await extract_user_id(args[1])
+        target_id = args.target
         if not target_id:
             return await send_reply(message, "❌ Неверное упоминание пользователя")
     
@@ -871,8 +3544,8 @@ async def get_role_handler(message: Message):
     
     await send_reply(message, response)
 
-@labeler.message(text=["/roles", "!roles"])
-async def list_roles_handler(message: Message):
+@command_router.command("roles")
+async def list_roles_handler(message: Message, args: List[str]):
     """Список всех ролей"""
     chat_id = message.peer_id - 2000000000
     chat_data = db.get_chat(chat_id)
@@ -882,19 +3555,22 @@ async def list_roles_handler(message: Message):
     
     response = "🎭 Роли в чате:\n\n"
     
-    for role_name, users in chat_data["users"]["roles"].items():
-        response += f"▫️ {role_name.upper()} ({len(users)} чел.):\n"
+    # Показываем первых 5 пользователей каждой роли - загружаем их разом
+    roles = [(role_name, len(users), sorted(users)[:5])
+             for role_name, users in chat_data["users"]["roles"].items()]
+    users_info = await get_users_info(
+        user_id for _, _, shown in roles for user_id in shown
+    )
+    
+    for role_name, count, shown in roles:
+        response += f"▫️ {role_name.upper()} ({count} чел.):\n"
         
-        # Показываем первых 5 пользователей
-        for user_id in users[:5]:
-            try:
-                user_info = await get_user_info(user_id)
-                response += f"   • {user_info.first_name} {user_info.last_name}\n"
-            except:
-                response += f"   • Пользователь {user_id}\n"
+        for user_id in shown:
+            user_info = users_info[user_id]
+            response += f"   • {user_info.first_name} {user_info.last_name}\n"
         
-        if len(users) > 5:
-            response += f"   • ... и ещё {len(users) - 5} чел.\n"
+        if count > 5:
+            response += f"   • ... и ещё {count - 5} чел.\n"
         
         response += "\n"
     
@@ -902,8 +3578,8 @@ async def list_roles_handler(message: Message):
 
 # ============= УПРАВЛЕНИЕ СООБЩЕНИЯМИ =============
 
-@labeler.message(text=["/pin", "!pin"])
-async def pin_handler(message: Message):
+@command_router.command("pin")
+async def pin_handler(message: Message, args: List[str]):
     """Закрепить сообщение"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
@@ -922,8 +3598,8 @@ async def pin_handler(message: Message):
     except Exception as e:
         await send_reply(message, f"❌ Ошибка закрепления: {str(e)}")
 
-@labeler.message(text=["/unpin", "!unpin"])
-async def unpin_handler(message: Message):
+@command_router.command("unpin")
+async def unpin_handler(message: Message, args: List[str]):
     """Открепить сообщение"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
@@ -937,8 +3613,8 @@ async def unpin_handler(message: Message):
     except Exception as e:
         await send_reply(message, f"❌ Ошибка открепления: {str(e)}")
 
-@labeler.message(text=["/del", "!del", "/delete", "!delete"])
-async def delete_handler(message: Message):
+@command_router.command("del", "delete")
+async def delete_handler(message: Message, args: List[str]):
     """Удалить сообщение"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
@@ -948,48 +3624,39 @@ async def delete_handler(message: Message):
         return await send_reply(message, "❌ Ответьте на сообщение для удаления")
     
     try:
-        await bot.api.messages.delete(
-            message_ids=[message.reply_message.id],
-            delete_for_all=1
-        )
-        # Удаляем и команду
-        await bot.api.messages.delete(
-            message_ids=[message.id],
-            delete_for_all=0
+        await asyncio.gather(
+            api_batcher.delete_message(message.peer_id, message.reply_message.id, delete_for_all=1),
+            # Удаляем и команду
+            api_batcher.delete_message(message.peer_id, message.id)
         )
     except Exception as e:
         await send_reply(message, f"❌ Ошибка удаления: {str(e)}")
 
 # ============= ИНФОРМАЦИОННЫЕ КОМАНДЫ =============
 
-@labeler.message(text=["/admins", "!admins"])
-async def admins_handler(message: Message):
+@command_router.command("admins")
+async def admins_handler(message: Message, args: List[str]):
     """Список администраторов"""
     chat_id = message.peer_id - 2000000000
     
     try:
-        chat_info = await bot.api.messages.get_conversation_members(
-            peer_id=chat_id + 2000000000
-        )
-        
-        owners = []
-        admins = []
-        moderators = []
-        
-        for member in chat_info.items:
-            if hasattr(member, 'is_owner') and member.is_owner:
-                user_info = await get_user_info(member.member_id)
-                owners.append(f"[id{member.member_id}|{user_info.first_name} {user_info.last_name}]")
-            elif hasattr(member, 'is_admin') and member.is_admin:
-                user_info = await get_user_info(member.member_id)
-                admins.append(f"[id{member.member_id}|{user_info.first_name} {user_info.last_name}]")
+        members = await member_cache.get(chat_id)
         
+        owner_ids = sorted(members.owners)
+        admin_ids = sorted(members.admins - members.owners)
         # Модераторы из базы данных
         chat_data = db.get_chat(chat_id)
-        if chat_data:
-            for user_id in chat_data["users"]["roles"].get("moderator", []):
-                user_info = await get_user_info(user_id)
-                moderators.append(f"[id{user_id}|{user_info.first_name} {user_info.last_name}]")
+        moderator_ids = sorted(chat_data["users"]["roles"].get("moderator", ())) if chat_data else []
+        
+        users_info = await get_users_info(owner_ids + admin_ids + moderator_ids)
+        
+        def mentions(user_ids):
+            return [f"[id{user_id}|{users_info[user_id].first_name} {users_info[user_id].last_name}]"
+                    for user_id in user_ids]
+        
+        owners = mentions(owner_ids)
+        admins = mentions(admin_ids)
+        moderators = mentions(moderator_ids)
         
         response = "👑 Управление беседой:\n\n"
         
@@ -1010,19 +3677,19 @@ async def admins_handler(message: Message):
     except Exception as e:
         await send_reply(message, f"❌ Ошибка: {str(e)}")
 
-@labeler.message(text=["/profile", "!profile"])
-async def profile_handler(message: Message):
+@command_router.command("profile", spec=("target",))
+async def profile_handler(message: Message, args: CommandArgs):
     """Профиль пользователя"""
-    args = message.text.split()
     chat_id = message.peer_id - 2000000000
     
     if len(args) < 2:
         target_id = message.from_id
     else:
-        target_id = await extract_user_id(args[1])
+        target_id = args.target
         if not target_id:
             return await send_reply(message, "❌ Неверное упоминание пользователя")
     
+    activity_aggregator.rollup(chat_id)
     chat_data = db.get_chat(chat_id)
     user_info = await get_user_info(target_id)
     
@@ -1052,7 +3719,15 @@ async def profile_handler(message: Message):
         max_warns = chat_data["settings"].get("max_warns", 3)
         
         response += f"🏆 Активность: {unity_score}\n"
+        rank = leaderboards.get(chat_id, chat_data).rank(target_id)
+        if rank is not None:
+            response += f"🏅 Место в рейтинге: {rank} из {len(chat_data['activity']['unity_scores'])}\n"
         response += f"⚠️ Варны: {warns}/{max_warns}\n"
+        
+        last_message = chat_data["activity"]["last_messages"].get(target_id)
+        if last_message:
+            last_str = datetime.datetime.fromtimestamp(last_message).strftime('%d.%m.%Y %H:%M')
+            response += f"🕐 Последнее сообщение: {last_str}\n"
     
     # Статусы
     if chat_data:
@@ -1060,42 +3735,49 @@ async def profile_handler(message: Message):
             response += "🚫 Статус: Забанен\n"
         
         if target_id in chat_data["moderation"]["mutes"]:
-            mute_until = datetime.datetime.fromisoformat(chat_data["moderation"]["mutes"][target_id])
-            if mute_until > datetime.datetime.now():
-                minutes_left = int((mute_until - datetime.datetime.now()).total_seconds() / 60)
-                time_str = await format_time(minutes_left)
+            mute_until = chat_data["moderation"]["mutes"][target_id]
+            now = time.time()
+            if mute_until > now:
+                minutes_left = int((mute_until - now) / 60)
+                time_str = format_time(minutes_left)
                 response += f"🔇 Статус: Замучен ({time_str})\n"
     
     await send_reply(message, response)
 
-@labeler.message(text=["/unity", "!unity"])
-async def unity_handler(message: Message):
+@command_router.command("unity")
+async def unity_handler(message: Message, args: List[str]):
     """Unity Score беседы"""
     chat_id = message.peer_id - 2000000000
+    activity_aggregator.rollup(chat_id)
     chat_data = db.get_chat(chat_id)
     
     if not chat_data or not chat_data["activity"]["unity_scores"]:
         return await send_reply(message, "🏆 Активность беседы пока не оценивалась")
     
-    scores = chat_data["activity"]["unity_scores"]
-    total = sum(scores.values())
-    avg = total / len(scores) if scores else 0
+    board = leaderboards.get(chat_id, chat_data)
+    total = board.total
+    participants = len(board.sorted_scores)
+    avg = total / participants if participants else 0
     
     # Топ 10
-    top_users = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:10]
+    top_users = [(user_id, score) for score, user_id in board.top]
     
     response = f"🏆 Unity Score беседы\n\n"
     response += f"📊 Общий счёт: {total}\n"
     response += f"📈 Средний: {avg:.1f}\n"
-    response += f"👥 Участников: {len(scores)}\n\n"
+    response += f"👥 Участников: {participants}\n"
+    
+    today_messages, today_users = activity_aggregator.totals(chat_data, 1)
+    week_messages, week_users = activity_aggregator.totals(chat_data, 7)
+    response += f"📅 Сегодня: {today_messages} сообщ. от {today_users} чел.\n"
+    response += f"🗓 За неделю: {week_messages} сообщ. от {week_users} чел.\n\n"
     response += "🏅 Топ активности:\n"
     
+    users_info = await get_users_info(user_id for user_id, _ in top_users)
+    
     for i, (user_id, score) in enumerate(top_users, 1):
-        try:
-            user_info = await get_user_info(user_id)
-            name = f"{user_info.first_name} {user_info.last_name}"
-        except:
-            name = f"ID{user_id}"
+        user_info = users_info[user_id]
+        name = f"{user_info.first_name} {user_info.last_name}"
         
         medal = ""
         if i == 1: medal = "🥇 "
@@ -1108,14 +3790,13 @@ async def unity_handler(message: Message):
 
 # ============= НАСТРОЙКИ И ПРИВЕТСТВИЯ =============
 
-@labeler.message(text=["/welcome", "!welcome"])
-async def welcome_handler(message: Message):
+@command_router.command("welcome")
+async def welcome_handler(message: Message, args: List[str]):
     """Управление приветствиями"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     chat_id = message.peer_id - 2000000000
     chat_data = db.init_chat(chat_id)
     
@@ -1161,8 +3842,102 @@ async def welcome_handler(message: Message):
     else:
         await send_reply(message, "❌ Доступные команды: set, toggle, test")
 
-@labeler.message(text=["/mutelist", "!mutelist"])
-async def mutelist_handler(message: Message):
+@command_router.command("antiflood")
+async def antiflood_handler(message: Message, args: List[str]):
+    """Настройки антифлуда"""
+    allowed, error = await check_permission(message, "moderator")
+    if not allowed:
+        return await send_reply(message, error)
+    
+    chat_id = message.peer_id - 2000000000
+    chat_data = db.init_chat(chat_id)
+    settings = chat_data["settings"]
+    
+    if len(args) < 2:
+        status = "включён" if settings.get("anti_flood", True) else "выключен"
+        action = settings.get("flood_action", DEFAULT_SETTINGS["flood_action"])
+        if action == "warn":
+            action_str = "варн"
+        else:
+            action_str = f"мут на {format_time(settings.get('flood_mute_minutes', DEFAULT_SETTINGS['flood_mute_minutes']))}"
+        
+        response = (
+            f"🌊 Антифлуд: {status}\n\n"
+            f"📏 Порог: {settings.get('flood_messages', DEFAULT_SETTINGS['flood_messages'])} сообщений "
+            f"за {settings.get('flood_seconds', DEFAULT_SETTINGS['flood_seconds'])} сек.\n"
+            f"⚔️ Наказание: {action_str}\n\n"
+            f"/antiflood on|off\n"
+            f"/antiflood limit сообщений секунд\n"
+            f"/antiflood action mute [время]|warn"
+        )
+        return await send_reply(message, response)
+    
+    subcommand = args[1].lower()
+    
+    if subcommand in ["on", "off"]:
+        settings["anti_flood"] = subcommand == "on"
+        db.mark_chat_dirty(chat_id)
+        status = "включён" if settings["anti_flood"] else "выключен"
+        await send_reply(message, f"✅ Антифлуд {status}!")
+    
+    elif subcommand == "limit":
+        if len(args) < 4 or not args[2].isdigit() or not args[3].isdigit():
+            return await send_reply(message, "❌ Использование: /antiflood limit сообщений секунд")
+        
+        messages_limit, seconds = int(args[2]), int(args[3])
+        if not 2 <= messages_limit <= FLOOD_MAX_MESSAGES or not 1 <= seconds <= FLOOD_MAX_SECONDS:
+            return await send_reply(message,
+                f"❌ Допустимо: 2-{FLOOD_MAX_MESSAGES} сообщений за 1-{FLOOD_MAX_SECONDS} сек.")
+        
+        settings["flood_messages"] = messages_limit
+        settings["flood_seconds"] = seconds
+        db.mark_chat_dirty(chat_id)
+        await send_reply(message, f"✅ Порог антифлуда: {messages_limit} сообщений за {seconds} сек.")
+    
+    elif subcommand == "action":
+        if len(args) < 3 or args[2].lower() not in ["mute", "warn"]:
+            return await send_reply(message, "❌ Использование: /antiflood action mute [время]|warn")
+        
+        action = args[2].lower()
+        if action == "mute" and len(args) > 3:
+            duration = parse_duration(args[3])
+            if not duration:
+                return await send_reply(message, "❌ Неверное время мута!")
+            settings["flood_mute_minutes"] = min(duration, 43200)
+        
+        settings["flood_action"] = action
+        db.mark_chat_dirty(chat_id)
+        await send_reply(message, f"✅ Наказание за флуд: {'варн' if action == 'warn' else 'мут'}")
+    
+    else:
+        await send_reply(message, "❌ Доступные команды: on, off, limit, action")
+
+@command_router.command("mutenotice")
+async def mutenotice_handler(message: Message, args: List[str]):
+    """Уведомление в чате, когда срок мута истёк"""
+    allowed, error = await check_permission(message, "moderator")
+    if not allowed:
+        return await send_reply(message, error)
+    
+    chat_id = message.peer_id - 2000000000
+    chat_data = db.init_chat(chat_id)
+    settings = chat_data["settings"]
+    
+    if len(args) < 2:
+        status = "включены" if settings["unmute_notice"] else "выключены"
+        return await send_reply(message, f"🔊 Уведомления об окончании мута: {status}\n\n/mutenotice on|off")
+    
+    subcommand = args[1].lower()
+    if subcommand not in ["on", "off"]:
+        return await send_reply(message, "❌ Использование: /mutenotice on|off")
+    
+    settings["unmute_notice"] = subcommand == "on"
+    db.mark_chat_dirty(chat_id)
+    status = "включены" if settings["unmute_notice"] else "выключены"
+    await send_reply(message, f"✅ Уведомления об окончании мута {status}!")
+
+@command_router.command("mutelist")
+async def mutelist_handler(message: Message, args: List[str]):
     """Список замученных"""
     allowed, error = await check_permission(message, "moderator")
     if not allowed:
@@ -1175,35 +3950,34 @@ async def mutelist_handler(message: Message):
         return await send_reply(message, "🔇 В этом чате нет замученных пользователей")
     
     response = "🔇 Замученные пользователи:\n\n"
-    now = datetime.datetime.now()
+    now = time.time()
+    
+    active_mutes = [(user_id, mute_until)
+                    for user_id, mute_until in chat_data["moderation"]["mutes"].items()
+                    if mute_until > now]
     
-    for user_id, mute_until_str in chat_data["moderation"]["mutes"].items():
-        mute_until = datetime.datetime.fromisoformat(mute_until_str)
+    users_info = await get_users_info(user_id for user_id, _ in active_mutes)
+    
+    for user_id, mute_until in active_mutes:
+        minutes_left = int((mute_until - now) / 60)
+        time_str = format_time(minutes_left)
         
-        if mute_until > now:
-            minutes_left = int((mute_until - now).total_seconds() / 60)
-            time_str = await format_time(minutes_left)
-            
-            try:
-                user_info = await get_user_info(user_id)
-                name = f"{user_info.first_name} {user_info.last_name}"
-            except:
-                name = f"ID{user_id}"
-            
-            response += f"• {name}: {time_str}\n"
+        user_info = users_info[user_id]
+        name = f"{user_info.first_name} {user_info.last_name}"
+        
+        response += f"• {name}: {time_str}\n"
     
     await send_reply(message, response)
 
 # ============= КАСТОМНЫЕ КОМАНДЫ =============
 
-@labeler.message(text=["/editcmd", "!editcmd"])
-async def editcmd_handler(message: Message):
+@command_router.command("editcmd")
+async def editcmd_handler(message: Message, args: List[str]):
     """Управление кастомными командами"""
     allowed, error = await check_permission(message, "admin")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 2:
         return await send_reply(message,
             "❌ Использование:\n"
@@ -1253,29 +4027,45 @@ async def editcmd_handler(message: Message):
     else:
         await send_reply(message, "❌ Доступные команды: add, del, list")
 
+@command_router.command("export")
+async def export_handler(message: Message, args: List[str]):
+    """Экспорт данных в JSON"""
+    allowed, error = await check_permission(message, "admin")
+    if not allowed:
+        return await send_reply(message, error)
+    
+    chat_id = message.peer_id - 2000000000
+    
+    if len(args) > 1 and args[1].lower() == "all":
+        if message.from_id not in ADMIN_IDS:
+            return await send_reply(message, "❌ Требуются права суперадминистратора!")
+        exported, skipped = await json_exporter.export()
+        return await send_reply(message, f"📤 Экспорт: записано {exported} чатов, без изменений {skipped}")
+    
+    await json_exporter.export(chat_id, force=True)
+    await send_reply(message, f"📤 Данные чата выгружены в {JSON_EXPORT_FOLDER}/chat_{chat_id}.json")
+
 # ============= ГЛОБАЛЬНЫЕ КОМАНДЫ =============
 
-@labeler.message(text=["/gban", "!gban"])
-async def gban_handler(message: Message):
+@command_router.command("gban", spec=("target", "text"))
+async def gban_handler(message: Message, args: CommandArgs):
     """Глобальный бан"""
     allowed, error = await check_permission(message, "superadmin")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 3:
         return await send_reply(message, "❌ Использование: /gban @user причина")
     
-    target_id = await extract_user_id(args[1])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
-    reason = " ".join(args[2:])
+    reason = args.text
     
-    # Добавляем глобальный бан
-    if target_id not in db.data["global_bans"]:
-        db.data["global_bans"].append(target_id)
-        db.save()
+    # Добавляем глобальный бан; повторный бан не рассылаем заново
+    if not db.global_ban(target_id):
+        return await send_reply(message, "⚠️ Пользователь уже забанен глобально")
     
     target_info = await get_user_info(target_id)
     target_mention = await mention_user(target_id, target_info)
@@ -1290,42 +4080,60 @@ async def gban_handler(message: Message):
     
     await send_reply(message, response)
     
-    # Уведомляем все чаты
-    for chat_id_str in db.data["chats"]:
-        try:
-            await bot.api.messages.send(
-                peer_id=int(chat_id_str) + 2000000000,
-                message=response,
-                random_id=0
-            )
-        except:
-            pass
+    # Уведомляем все чаты в фоне, отчитываясь выдавшему бан;
+    # чаты других воркеров уведомляют сами воркеры
+    if worker_link is not None:
+        worker_link.broadcast(response, message.peer_id)
+    peer_ids = [int(chat_id_str) + 2000000000 for chat_id_str in db.chat_ids()
+                if int(chat_id_str) + 2000000000 != message.peer_id]
+    spawn_background(notify_all_chats(message, peer_ids, response))
+
+async def notify_all_chats(message: Message, peer_ids: List[int], text: str):
+    """Разослать уведомление во все чаты и сообщить о результате"""
+    last_report = time.monotonic()
+    
+    async def progress(delivered: int, failed: int, total: int):
+        nonlocal last_report
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await send_reply(message, f"📡 Рассылка: {delivered + failed}/{total}, ошибок: {failed}")
+    
+    delivered, failed = await broadcaster.broadcast(peer_ids, text, progress)
+    await send_reply(message, f"📡 Рассылка завершена: доставлено {delivered}, ошибок {failed}")
 
-@labeler.message(text=["/gmute", "!gmute"])
-async def gmute_handler(message: Message):
+@command_router.command("gmute", spec=("target", "duration", "text"))
+async def gmute_handler(message: Message, args: CommandArgs):
     """Глобальный мут (запрет команд)"""
     allowed, error = await check_permission(message, "superadmin")
     if not allowed:
         return await send_reply(message, error)
     
-    args = message.text.split()
     if len(args) < 3:
         return await send_reply(message, "❌ Использование: /gmute @user время причина")
     
-    target_id = await extract_user_id(args[1])
+    target_id = args.target
     if not target_id:
         return await send_reply(message, "❌ Неверное упоминание пользователя")
     
-    duration = await parse_duration(args[2])
+    duration = args.duration
     if not duration:
         return await send_reply(message, "❌ Неверное время")
     
-    reason = " ".join(args[3:]) if len(args) > 3 else "Не указана"
+    # Максимум 30 дней
+    if duration > 43200:
+        duration = 43200
+    
+    reason = args.text or "Не указана"
+    
+    # Устанавливаем глобальный мут
+    mute_until = time.time() + duration * 60
+    db.global_mute(target_id, mute_until)
+    mute_scheduler.schedule(GLOBAL_MUTE_CHAT, target_id, mute_until)
+    db.add_stat("total_mutes")
     
-    # В реальном проекте здесь была бы логика глобального мута
     target_info = await get_user_info(target_id)
     target_mention = await mention_user(target_id, target_info)
-    time_str = await format_time(duration)
+    time_str = format_time(duration)
     
     response = (
         f"🔇 ГЛОБАЛЬНЫЙ МУТ\n"
@@ -1336,20 +4144,77 @@ async def gmute_handler(message: Message):
     
     await send_reply(message, response)
 
+@command_router.command("ungmute", spec=("target",))
+async def ungmute_handler(message: Message, args: CommandArgs):
+    """Снятие глобального мута"""
+    allowed, error = await check_permission(message, "superadmin")
+    if not allowed:
+        return await send_reply(message, error)
+    
+    if len(args) < 2:
+        return await send_reply(message, "❌ Использование: /ungmute @user")
+    
+    target_id = args.target
+    if not target_id:
+        return await send_reply(message, "❌ Неверное упоминание пользователя")
+    
+    if not db.global_unmute(target_id):
+        return await send_reply(message, "⚠️ У этого пользователя нет глобального мута")
+    
+    target_mention = await mention_user(target_id)
+    await send_reply(message, f"🔊 Глобальный мут {target_mention} снят!")
+
+@command_router.command("prof")
+async def prof_handler(message: Message, args: List[str]):
+    """Профилирование бота на заданное время"""
+    # Профилирует весь процесс и пишет файлы на сервер - только суперадминам из ADMIN_IDS,
+    # не администраторам бесед
+    if message.from_id not in ADMIN_IDS:
+        return await send_reply(message, "❌ Требуются права суперадминистратора!")
+    
+    if profiler.running():
+        return await send_reply(message, "⚠️ Профилирование уже идёт")
+    
+    try:
+        seconds = int(args[1]) if len(args) > 1 else 30
+    except ValueError:
+        return await send_reply(message, "❌ Использование: /prof [секунд]")
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    
+    thread = profiler.start(seconds)
+    await send_reply(message, f"🔬 Профилирование на {seconds} с запущено")
+    
+    async def report():
+        # Ответ после окончания: очередь чата при этом не ждёт
+        await asyncio.get_running_loop().run_in_executor(None, thread.join)
+        lines = [f"• {share:.0%} {name}" for name, share in profiler.top(5)]
+        await send_reply(message, f"🔬 Профиль записан: {profiler.last_path}\n" + "\n".join(lines))
+    
+    spawn_background(report())
+
 # ============= СТАТИСТИКА И ИНФОРМАЦИЯ =============
 
-@labeler.message(text=["/stats", "!stats"])
-async def stats_handler(message: Message):
+@command_router.command("stats")
+async def stats_handler(message: Message, args: List[str]):
     """Статистика бота"""
     chat_id = message.peer_id - 2000000000
+    activity_aggregator.rollup(chat_id)
     chat_data = db.get_chat(chat_id)
-    global_stats = db.data["statistics"]
+    global_stats = db.global_statistics()
     
     response = "📊 Статистика GRAND\n\n"
     
     if chat_data:
+        today_messages, today_users = activity_aggregator.totals(chat_data, 1)
+        week_messages, week_users = activity_aggregator.totals(chat_data, 7)
+        peak_hour, peak_count = max(activity_aggregator.series(chat_data, "hour"), key=lambda x: x[1])
+        
         response += f"📈 Локальная статистика:\n"
         response += f"• Сообщений: {chat_data['info']['message_count']}\n"
+        response += f"• Сегодня: {today_messages} сообщ., {today_users} авторов\n"
+        response += f"• За неделю: {week_messages} сообщ., {week_users} авторов\n"
+        if peak_count:
+            response += f"• Пиковый час сегодня: {peak_hour} ({peak_count} сообщ.)\n"
         response += f"• Банов: {len(chat_data['moderation']['bans'])}\n"
         response += f"• Мутов: {len(chat_data['moderation']['mutes'])}\n"
         response += f"• Киков: {len(chat_data['moderation']['kicks'])}\n"
@@ -1357,18 +4222,19 @@ async def stats_handler(message: Message):
         response += f"• Кастомных команд: {len(chat_data['custom_commands'])}\n\n"
     
     response += f"🌍 Глобальная статистика:\n"
-    response += f"• Чатов: {len(db.data['chats'])}\n"
+    response += f"• Чатов: {db.total_chat_count()}\n"
     response += f"• Всего сообщений: {global_stats['total_messages']}\n"
     response += f"• Всего команд: {global_stats['total_commands']}\n"
     response += f"• Всего банов: {global_stats['total_bans']}\n"
     response += f"• Всего мутов: {global_stats['total_mutes']}\n"
     response += f"• Всего киков: {global_stats['total_kicks']}\n"
-    response += f"• Глобальных банов: {len(db.data['global_bans'])}"
+    response += f"• Глобальных банов: {len(db.data['global_bans'])}\n"
+    response += f"• Глобальных мутов: {len(db.data['global_mutes'])}"
     
     await send_reply(message, response)
 
-@labeler.message(text=["/help", "!help"])
-async def help_handler(message: Message):
+@command_router.command("help")
+async def help_handler(message: Message, args: List[str]):
     """Помощь по командам"""
     help_text = """
 🤖 GRAND Чат-Менеджер v2.0
@@ -1407,11 +4273,16 @@ async def help_handler(message: Message):
 
 ⚙️ НАСТРОЙКИ:
 /welcome [set/toggle/test] - Приветствия
+/antiflood [on/off/limit/action] - Антифлуд
+/mutenotice [on/off] - Уведомления об окончании мута
 /editcmd [add/del/list] - Кастомные команды
+/export [all] - Экспорт данных в JSON
 
 🌍 ГЛОБАЛЬНЫЕ (админы):
 /gban @user причина - Глобальный бан
 /gmute @user время причина - Глобальный мут
+/ungmute @user - Снять глобальный мут
+/prof [секунд] - Профилирование бота
 
 ❓ ПОМОЩЬ:
 /help - Эта справка
@@ -1421,8 +4292,8 @@ async def help_handler(message: Message):
     
     await send_reply(message, help_text)
 
-@labeler.message(text=["/about", "!about"])
-async def about_handler(message: Message):
+@command_router.command("about")
+async def about_handler(message: Message, args: List[str]):
     """Информация о боте"""
     about_text = """
 🤖 GRAND: Чат-менеджер для ВКонтакте
@@ -1459,9 +4330,9 @@ async def about_handler(message: Message):
 
 💡 Используйте /help для списка команд
 """.format(
-        len(db.data["chats"]),
-        db.data["statistics"]["total_messages"],
-        db.data["statistics"]["total_commands"]
+        db.total_chat_count(),
+        db.global_statistics()["total_messages"],
+        db.global_statistics()["total_commands"]
     )
     
     await send_reply(message, about_text)
@@ -1471,75 +4342,73 @@ async def about_handler(message: Message):
 @labeler.message()
 async def handle_all_messages(message: Message):
     """Обработка всех сообщений"""
+    # Состав беседы изменился - кэш участников устарел
+    if message.action and message.action.type in MEMBERSHIP_ACTIONS:
+        member_cache.invalidate(message.peer_id - 2000000000)
+    
     if not message.text:
         return
     
+    # Встроенные команды; их время учитывается под именем команды
+    command = command_router.parse(message.text)
+    if command is not None:
+        handler = command_router.handlers.get(command.name)
+        if handler is not None:
+            return await handler(message, command.args)
+    
+    await handle_plain_message(message, command)
+
+@instrumented("message")
+async def handle_plain_message(message: Message, command: Optional[ParsedCommand]):
+    """Обычное сообщение: санкции, антифлуд, активность, кастомные команды"""
     chat_id = message.peer_id - 2000000000
     user_id = message.from_id
     
-    # Инициализируем чат
-    chat_data = db.init_chat(chat_id)
-    
-    # Увеличиваем счетчики
-    db.add_stat("total_messages")
-    chat_data["info"]["message_count"] += 1
+    # Обычное сообщение не помечает чат изменённым: счётчики активности
+    # переносятся в базу пачкой агрегатором
+    chat_data = db.get_chat(chat_id) or db.init_chat(chat_id)
     
-    # Проверка глобального бана
-    if user_id in db.data["global_bans"]:
-        try:
-            await bot.api.messages.delete(
-                message_ids=[message.id],
-                delete_for_all=0
-            )
-        except:
-            pass
+    # Глобальные бан и мут - один поиск по общему индексу санкций
+    sanction = db.global_sanctions.get(user_id)
+    if sanction is not None and sanction > time.time():
+        api_batcher.delete_message(message.peer_id, message.id)
         return
     
     # Проверка бана в чате
     if user_id in chat_data["moderation"]["bans"]:
-        try:
-            await bot.api.messages.delete(
-                message_ids=[message.id],
-                delete_for_all=0
-            )
-        except:
-            pass
+        api_batcher.delete_message(message.peer_id, message.id)
         return
     
     # Проверка мута
-    if user_id in chat_data["moderation"]["mutes"]:
-        mute_until = datetime.datetime.fromisoformat(chat_data["moderation"]["mutes"][user_id])
-        if datetime.datetime.now() < mute_until:
-            try:
-                await bot.api.messages.delete(
-                    message_ids=[message.id],
-                    delete_for_all=0
-                )
-            except:
-                pass
+    mute_until = chat_data["moderation"]["mutes"].get(user_id)
+    if mute_until is not None:
+        if time.time() < mute_until:
+            api_batcher.delete_message(message.peer_id, message.id)
             return
         else:
             # Мут истек
             del chat_data["moderation"]["mutes"][user_id]
             db.update_chat(chat_id, chat_data)
     
-    # Обновляем активность
-    if user_id not in chat_data["activity"]["unity_scores"]:
-        chat_data["activity"]["unity_scores"][user_id] = 0
+    # Сообщения забаненных и замученных в статистику не попадают
+    db.add_stat("total_messages")
+    
+    # Антифлуд
+    settings = chat_data["settings"]
+    if settings.get("anti_flood", True) and anti_flood.hit(chat_id, user_id, settings):
+        if await anti_flood.punish(message, chat_data):
+            return
     
-    chat_data["activity"]["unity_scores"][user_id] += 1
-    chat_data["activity"]["last_messages"][user_id] = datetime.datetime.now().isoformat()
+    # Обновляем активность
+    activity_aggregator.record(chat_id, user_id)
     
     # Проверяем кастомные команды
-    if message.text.startswith("!") and chat_data["settings"]["allow_custom_commands"]:
-        parts = message.text[1:].split(maxsplit=1)
-        if len(parts) > 0:
-            cmd = parts[0].lower()
-            if cmd in chat_data["custom_commands"]:
-                response = chat_data["custom_commands"][cmd]
-                await send_reply(message, response)
-                db.add_stat("total_commands")
-                return
+    if command is not None and command.prefix == "!" and chat_data["settings"]["allow_custom_commands"]:
+        response = chat_data["custom_commands"].get(command.name)
+        if response is not None:
+            await send_reply(message, response)
+            db.add_stat("total_commands")
+            return
     
     # Обработка приветствий для новых участников
     if message.action and message.action.type == "chat_invite_user":
@@ -1556,15 +4425,1017 @@ async def handle_all_messages(message: Message):
             chat_data["welcome_stats"]["last_welcome"] = datetime.datetime.now().isoformat()
             db.update_chat(chat_id, chat_data)
 
+# ============= ОЧЕРЕДИ СОБЫТИЙ =============
+
+def event_peer_id(event: Dict) -> Optional[int]:
+    """peer_id события Long Poll / Callback API, если он есть"""
+    obj = event.get("object")
+    if not isinstance(obj, dict):
+        return None
+    message = obj.get("message")
+    if isinstance(message, dict):
+        return message.get("peer_id")
+    return obj.get("peer_id")
+
+def is_droppable_event(event: Dict) -> bool:
+    """Обычное сообщение (не команда и не сервисное действие) - его можно выбросить при перегрузке"""
+    if event.get("type") != "message_new":
+        return False
+    message = (event.get("object") or {}).get("message") or {}
+    if message.get("action"):
+        return False
+    text = message.get("text") or ""
+    return not text.startswith(tuple(COMMAND_PREFIXES))
+
+class EventScheduler:
+    """Очереди событий по чатам
+    
+    События одного чата идут строго по очереди - обработчики не гоняются
+    за общий chat_data через await. Разные чаты обрабатываются параллельно,
+    не больше EVENT_CONCURRENCY одновременно; чат уступает слот другим
+    после CHAT_BATCH событий подряд.
+    """
+    
+    def __init__(self, process_event, concurrency: int = EVENT_CONCURRENCY,
+                 max_pending: int = EVENT_QUEUE_SIZE, chat_queue_size: int = CHAT_QUEUE_SIZE):
+        self.process_event = process_event
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.chat_queue_size = chat_queue_size
+        # peer_id -> очередь (время постановки, событие); чат есть в словаре, пока у него есть события
+        self._queues: Dict[Optional[int], deque] = {}
+        # Чаты с событиями, ждущие свободного слота (каждый - не больше одного раза)
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._workers: List[asyncio.Task] = []
+        self.pending = 0
+        self.processed = 0
+        self.dropped = 0
+    
+    def start(self):
+        """Запустить обработчики (на работающем цикле событий)"""
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+    
+    def full(self) -> bool:
+        return self.pending >= self.max_pending
+    
+    def busy(self, peer_id: int) -> bool:
+        """У чата есть события в очереди или в обработке"""
+        return peer_id in self._queues
+    
+    async def wait_space(self):
+        """Дождаться места в очередях"""
+        while self.full():
+            self._space.clear()
+            await self._space.wait()
+    
+    async def submit(self, event: Dict):
+        """Поставить событие в очередь, при заполнении - дождаться места"""
+        if self.full():
+            await self.wait_space()
+        self.offer(event)
+    
+    def offer(self, event: Dict):
+        """Поставить событие в очередь без ожидания"""
+        peer_id = event_peer_id(event)
+        queue = self._queues.get(peer_id)
+        if queue is None:
+            queue = self._queues[peer_id] = deque()
+            self._ready.put_nowait(peer_id)
+        
+        if len(queue) >= self.chat_queue_size and not self._drop_oldest(queue):
+            if is_droppable_event(event):
+                self._note_drop(peer_id)
+                return
+            # Команды и сервисные события не выбрасываем: общий предел держит submit()
+        
+        queue.append((time.monotonic(), event))
+        self.pending += 1
+    
+    def _drop_oldest(self, queue: deque) -> bool:
+        for i, (_, queued_event) in enumerate(queue):
+            if is_droppable_event(queued_event):
+                del queue[i]
+                self._dequeued()
+                self._note_drop(event_peer_id(queued_event))
+                return True
+        return False
+    
+    def _note_drop(self, peer_id: Optional[int]):
+        self.dropped += 1
+        if self.dropped % 100 == 1:
+            logger.warning(f"Очереди перегружены: выброшено {self.dropped} сообщений (последнее - чат {peer_id})")
+    
+    def _dequeued(self):
+        self.pending -= 1
+        if not self._space.is_set() and not self.full():
+            self._space.set()
+    
+    async def _worker(self):
+        while True:
+            peer_id = await self._ready.get()
+            queue = self._queues[peer_id]
+            for _ in range(CHAT_BATCH):
+                if not queue:
+                    break
+                enqueued, event = queue.popleft()
+                self._dequeued()
+                if time.monotonic() - enqueued > EVENT_STALE_AFTER and is_droppable_event(event):
+                    self._note_drop(peer_id)
+                    continue
+                try:
+                    await self.process_event(event)
+                except Exception as e:
+                    logger.error(f"Ошибка обработки события в чате {peer_id}: {e}")
+                self.processed += 1
+            
+            if queue:
+                # Уступаем слот: чат встаёт в конец очереди готовых
+                self._ready.put_nowait(peer_id)
+            else:
+                del self._queues[peer_id]
+
+async def process_vk_event(event: Dict):
+    """Передать событие VK обработчикам бота"""
+    await bot.process_event(event)
+
+event_scheduler = EventScheduler(process_vk_event)
+
+metrics.gauge("grand_event_queue_depth", "Событий в очередях чатов",
+              func=lambda: event_scheduler.pending)
+metrics.counter("grand_events_processed_total", "Обработано событий",
+                func=lambda: event_scheduler.processed)
+metrics.counter("grand_events_dropped_total", "Выброшено событий при перегрузке",
+                func=lambda: event_scheduler.dropped)
+
+async def poll_events():
+    """Long Poll: события передаются в очереди чатов; при их заполнении чтение ждёт"""
+    async for event in bot.polling.listen():
+        for update in event.get("updates", []):
+            await event_scheduler.submit(update)
+
+# ============= CALLBACK API =============
+
+class CallbackServer:
+    """HTTP-сервер Callback API: сразу отвечает "ok", события обрабатывает пул воркеров"""
+    
+    # Сколько последних event_id помнить для отсева повторных доставок
+    SEEN_EVENTS = 10000
+    
+    def __init__(self, process_event, confirmation: str = CALLBACK_CONFIRMATION,
+                 secret: str = CALLBACK_SECRET, workers: int = CALLBACK_WORKERS,
+                 queue_size: int = CALLBACK_QUEUE_SIZE):
+        self.process_event = process_event
+        self.confirmation = confirmation
+        self.secret = secret
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._worker_tasks: List[asyncio.Task] = []
+        self._runner: Optional[web.AppRunner] = None
+        metrics.gauge("grand_callback_queue_depth", "Событий в очереди Callback-сервера",
+                      func=self.queue.qsize)
+    
+    async def handle(self, request: web.Request) -> web.Response:
+        try:
+            event = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="bad request")
+        if not isinstance(event, dict):
+            return web.Response(status=400, text="bad request")
+        
+        if self.secret and event.get("secret") != self.secret:
+            logger.warning(f"Callback: событие с неверным секретом от {request.remote}")
+            return web.Response(status=403, text="forbidden")
+        if GROUP_ID and event.get("group_id") not in (None, GROUP_ID):
+            return web.Response(status=403, text="forbidden")
+        
+        if event.get("type") == "confirmation":
+            return web.Response(text=self.confirmation)
+        
+        # VK повторяет доставку, если не получил "ok" вовремя
+        event_id = event.get("event_id")
+        if event_id is not None:
+            if event_id in self._seen:
+                return web.Response(text="ok")
+            self._seen[event_id] = None
+            if len(self._seen) > self.SEEN_EVENTS:
+                self._seen.popitem(last=False)
+        
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Не подтверждаем - VK доставит событие повторно позже
+            if event_id is not None:
+                self._seen.pop(event_id, None)
+            return web.Response(status=503, text="busy")
+        return web.Response(text="ok")
+    
+    async def _worker(self):
+        while True:
+            event = await self.queue.get()
+            try:
+                await self.process_event(event)
+            except Exception as e:
+                logger.error(f"Callback: ошибка обработки события {event.get('type')}: {e}")
+            finally:
+                self.queue.task_done()
+    
+    async def start(self, host: str = CALLBACK_HOST, port: int = CALLBACK_PORT,
+                    path: str = CALLBACK_PATH):
+        """Запустить воркеры и HTTP-сервер"""
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Callback API: http://{host}:{port}{path}, воркеров: {self.workers}")
+    
+    async def stop(self, drain_timeout: float = 10):
+        """Перестать принимать события, дообработать очередь и остановить воркеры"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Callback: не обработано {self.queue.qsize()} событий")
+        for task in self._worker_tasks:
+            task.cancel()
+        self._worker_tasks = []
+
+def stub_message_event(peer_id: int, from_id: int, text: str, message_id: int) -> Dict:
+    """Событие message_new в формате Callback API (для локальной проверки без VK)"""
+    return {
+        "type": "message_new",
+        "event_id": f"stub{message_id}",
+        "v": "5.199",
+        "group_id": GROUP_ID,
+        "secret": CALLBACK_SECRET,
+        "object": {
+            "message": {
+                "id": message_id,
+                "conversation_message_id": message_id,
+                "date": int(time.time()),
+                "peer_id": peer_id,
+                "from_id": from_id,
+                "text": text,
+                "out": 0,
+                "attachments": [],
+                "fwd_messages": [],
+                "important": False,
+                "is_hidden": False,
+                "version": 1
+            },
+            "client_info": {
+                "button_actions": ["text"],
+                "keyboard": True,
+                "inline_keyboard": True,
+                "carousel": True,
+                "lang_id": 0
+            }
+        }
+    }
+
+async def send_stub_events(url: str, count: int, chats: int = 10, concurrency: int = 50) -> Dict[str, int]:
+    """Отправить на сервер count синтетических сообщений, вернуть число ответов по видам"""
+    results: Dict[str, int] = {}
+    counter = iter(range(1, count + 1))
+    
+    async def sender(session: ClientSession):
+        for message_id in counter:
+            event = stub_message_event(
+                2000000000 + message_id % chats + 1, 1000 + message_id % 97,
+                f"тестовое сообщение {message_id}", message_id
+            )
+            try:
+                async with session.post(url, json=event) as response:
+                    answer = await response.text()
+            except Exception as e:
+                answer = type(e).__name__
+            results[answer] = results.get(answer, 0) + 1
+    
+    async with ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+    return results
+
+# ============= МНОГОПРОЦЕССНЫЙ РЕЖИМ =============
+
+class HashRing:
+    """Консистентное хеширование peer_id по воркерам
+    
+    У каждого воркера WORKER_RING_REPLICAS точек на кольце; при изменении
+    числа воркеров переезжает лишь ~1/N чатов.
+    """
+    
+    def __init__(self, workers: int, replicas: int = WORKER_RING_REPLICAS):
+        points = sorted((self._hash(f"worker-{index}-{replica}"), index)
+                        for index in range(workers) for replica in range(replicas))
+        self._points = [point for point, _ in points]
+        self._workers = [index for _, index in points]
+    
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+    
+    def worker(self, peer_id: int) -> int:
+        """Номер воркера, владеющего чатом"""
+        position = bisect.bisect(self._points, self._hash(str(peer_id)))
+        return self._workers[position % len(self._workers)]
+
+# Папка раздела воркера, в том числе оставшаяся от прерванного переноса
+WORKER_FOLDER_RE = re.compile(r"worker_\d+(\.old)?")
+
+def worker_folder(index: int) -> str:
+    """Папка раздела базы воркера"""
+    return f"{DATA_FOLDER}/worker_{index}"
+
+class WorkerLink:
+    """Связь воркера с супервизором через канал multiprocessing"""
+    
+    def __init__(self, index: int, conn):
+        self.index = index
+        self.conn = conn
+        self.stopped = asyncio.Event()
+        # Статистика, уже отправленная супервизору (отправляем только прирост)
+        self._reported = dict(db.sync_statistics())
+    
+    def global_op(self, op: str, args: tuple):
+        """Передать изменение глобальных санкций супервизору"""
+        self.conn.send(("global", op, args))
+    
+    def broadcast(self, text: str, exclude_peer_id: int):
+        """Попросить остальных воркеров разослать текст по своим чатам"""
+        self.conn.send(("broadcast", text, exclude_peer_id))
+    
+    def report(self):
+        """Отправить прирост статистики и число чатов воркера"""
+        statistics = db.sync_statistics()
+        delta = {key: value - self._reported.get(key, 0) for key, value in statistics.items()}
+        self._reported = dict(statistics)
+        self.conn.send(("stats", {key: value for key, value in delta.items() if value}, db.chat_count()))
+    
+    def _on_readable(self):
+        try:
+            while self.conn.poll():
+                if event_scheduler.full():
+                    # Очереди заполнены - перестаём читать канал, супервизор упрётся в него
+                    asyncio.get_running_loop().remove_reader(self.conn.fileno())
+                    spawn_background(self._resume_reading())
+                    return
+                self._dispatch(self.conn.recv())
+        except (EOFError, OSError):
+            logger.error("Связь с супервизором потеряна")
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            self.stopped.set()
+    
+    async def _resume_reading(self):
+        await event_scheduler.wait_space()
+        asyncio.get_running_loop().add_reader(self.conn.fileno(), self._on_readable)
+    
+    def _dispatch(self, message: tuple):
+        kind = message[0]
+        if kind == "event":
+            event_scheduler.offer(message[1])
+        elif kind == "globals":
+            db.replace_globals(message[1])
+        elif kind == "cluster":
+            db.cluster = message[1]
+        elif kind == "broadcast":
+            _, text, exclude_peer_id = message
+            peer_ids = [int(chat_id_str) + 2000000000 for chat_id_str in db.chat_ids()
+                        if int(chat_id_str) + 2000000000 != exclude_peer_id]
+            spawn_background(broadcaster.broadcast(peer_ids, text))
+        elif kind == "stop":
+            self.stopped.set()
+    
+    async def serve(self):
+        """Принимать сообщения супервизора до команды остановки"""
+        asyncio.get_running_loop().add_reader(self.conn.fileno(), self._on_readable)
+        while not self.stopped.is_set():
+            try:
+                await asyncio.wait_for(self.stopped.wait(), JOURNAL_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.report()
+
+# Связь с супервизором (только в процессе воркера)
+worker_link: Optional[WorkerLink] = None
+
+def run_worker(index: int, conn):
+    """Точка входа процесса-воркера (запускается через fork из супервизора)"""
+    global db, json_exporter, worker_link, logger
+    logger = logging.getLogger(f"GRAND.worker{index}")
+    global_state = db.global_state()
+    
+    db = Database(create_storage(worker_folder(index)))
+    db.replace_globals(global_state)
+    json_exporter = JsonExporter(db, f"{worker_folder(index)}/export")
+    worker_link = WorkerLink(index, conn)
+    db.global_sink = worker_link.global_op
+    
+    async def worker_main():
+        asyncio.create_task(auto_save())
+        mute_scheduler.load(db)
+        asyncio.create_task(mute_scheduler.run())
+        event_scheduler.start()
+        if METRICS_PORT:
+            await MetricsServer().start(port=METRICS_PORT + 1 + index)
+        asyncio.create_task(loop_watchdog.run())
+        logger.info(f"Воркер {index} запущен, чатов: {db.chat_count()}")
+        await worker_link.serve()
+    
+    try:
+        run_until_stopped(worker_main())
+    finally:
+        app.stop()
+        logger.info(f"Воркер {index} остановлен")
+
+class Supervisor:
+    """Приём событий и раздача их воркерам; хранит глобальные санкции и статистику"""
+    
+    def __init__(self, workers: int):
+        self.ring = HashRing(workers)
+        self.workers = workers
+        self.processes: List[multiprocessing.Process] = []
+        self.conns = []
+        self.chat_counts = [0] * workers
+        self.routed = [0] * workers
+        self.dropped = [0] * workers
+        # Очередь отправки каждому воркеру: медленный воркер не задерживает остальных
+        self.outboxes: List[asyncio.Queue] = []
+        self._writers: List[asyncio.Task] = []
+        metrics.counter("grand_supervisor_dropped_total", "Выброшено событий для перегруженных воркеров",
+                        func=lambda: sum(self.dropped))
+    
+    def split_database(self):
+        """Разложить чаты по разделам воркеров: один раз из общей базы
+        и заново - когда изменилось число воркеров"""
+        marker_file = f"{DATA_FOLDER}/workers.json"
+        if os.path.exists(marker_file):
+            with open(marker_file, encoding="utf-8") as f:
+                split_for = json.load(f)["workers"]
+            if split_for == self.workers:
+                return
+            logger.warning(f"База разложена на {split_for} воркеров, запущено {self.workers}: "
+                           f"переносим чаты между разделами")
+            # Читаем и разделы, оставшиеся от прерванного переноса (*.old)
+            sources = [Database(create_storage(f"{DATA_FOLDER}/{name}"))
+                       for name in sorted(os.listdir(DATA_FOLDER))
+                       if WORKER_FOLDER_RE.fullmatch(name)]
+        else:
+            sources = [db]
+        
+        # Новые разделы пишутся рядом (*.new) и заменяют старые, только когда записаны целиком
+        partitions: Dict[int, Database] = {}
+        for source in sources:
+            for chat_id_str in source.chat_ids():
+                chat_data = source.read_chat(int(chat_id_str))
+                if chat_data is None:
+                    continue
+                index = self.ring.worker(int(chat_id_str) + 2000000000)
+                if index not in partitions:
+                    staging = f"{worker_folder(index)}.new"
+                    shutil.rmtree(staging, ignore_errors=True)
+                    partitions[index] = Database(create_storage(staging))
+                partitions[index].data["chats"][chat_id_str] = chat_data
+                partitions[index].mark_chat_dirty(int(chat_id_str))
+            if source is not db:
+                source.close()
+        
+        for index, partition in partitions.items():
+            partition.flush()
+            # Поток записи не должен пережить fork воркеров
+            partition.close()
+            logger.info(f"Воркеру {index} передано {len(partition.data['chats'])} чатов")
+        
+        # Старые разделы (и *.old прерванного переноса) уже прочитаны - откладываем их до записи отметки
+        old_folders = []
+        for name in sorted(os.listdir(DATA_FOLDER)):
+            if not WORKER_FOLDER_RE.fullmatch(name):
+                continue
+            folder = f"{DATA_FOLDER}/{name}"
+            if not name.endswith(".old"):
+                shutil.rmtree(f"{folder}.old", ignore_errors=True)
+                os.replace(folder, f"{folder}.old")
+                folder = f"{folder}.old"
+            if folder not in old_folders:
+                old_folders.append(folder)
+        for index in partitions:
+            os.replace(f"{worker_folder(index)}.new", worker_folder(index))
+        with open(marker_file, 'w', encoding="utf-8") as f:
+            json.dump({"workers": self.workers}, f)
+        for folder in old_folders:
+            shutil.rmtree(folder, ignore_errors=True)
+    
+    def start_workers(self):
+        """Разложить базу и запустить воркеры (до запуска цикла событий)"""
+        self.split_database()
+        # Чаты живут в воркерах - супервизору они в памяти не нужны
+        db.data["chats"].clear()
+        
+        context = multiprocessing.get_context("fork")
+        for index in range(self.workers):
+            parent_conn, child_conn = context.Pipe()
+            # Не daemon: воркеру нужен свой процесс для компактизации pickle-журнала.
+            # При падении супервизора воркер увидит закрытый канал и остановится сам
+            process = context.Process(target=run_worker, args=(index, child_conn),
+                                      name=f"grand-worker-{index}")
+            process.start()
+            child_conn.close()
+            self.processes.append(process)
+            self.conns.append(parent_conn)
+    
+    async def route(self, event: Dict):
+        """Передать событие воркеру, владеющему чатом"""
+        peer_id = event_peer_id(event)
+        index = self.ring.worker(peer_id) if peer_id else 0
+        outbox = self.outboxes[index]
+        if outbox.qsize() >= WORKER_OUTBOX_SIZE and is_droppable_event(event):
+            # Воркер не успевает: выбрасываем только его обычные сообщения,
+            # команды и сервисные события ставим в очередь сверх предела
+            self.dropped[index] += 1
+            if self.dropped[index] % 100 == 1:
+                logger.warning(f"Воркер {index} не успевает: выброшено {self.dropped[index]} сообщений")
+            return
+        outbox.put_nowait(("event", event))
+        self.routed[index] += 1
+    
+    def _send_all(self, message: tuple, exclude: Optional[int] = None):
+        for index, outbox in enumerate(self.outboxes):
+            if index != exclude:
+                outbox.put_nowait(message)
+    
+    async def _write(self, index: int):
+        """Отправлять очередь воркера в его канал
+        
+        Запись в канал блокирует, пока воркер не прочитает данные, поэтому
+        идёт в отдельном потоке - по одному на воркер, чтобы сохранить порядок.
+        """
+        loop = asyncio.get_running_loop()
+        outbox, conn = self.outboxes[index], self.conns[index]
+        sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"grand-send-{index}")
+        try:
+            while True:
+                message = await outbox.get()
+                try:
+                    await loop.run_in_executor(sender, conn.send, message)
+                except (BrokenPipeError, OSError):
+                    logger.error(f"Канал воркера {index} закрыт")
+                    return
+                if message[0] == "stop":
+                    return
+        finally:
+            sender.shutdown(wait=False)
+    
+    def _on_readable(self, index: int):
+        conn = self.conns[index]
+        try:
+            while conn.poll():
+                self._dispatch(index, conn.recv())
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(conn.fileno())
+    
+    def _dispatch(self, index: int, message: tuple):
+        kind = message[0]
+        if kind == "global":
+            _, op, args = message
+            if getattr(db, op)(*args):
+                self._send_all(("globals", db.global_state()))
+        elif kind == "stats":
+            _, delta, chats = message
+            for key, value in delta.items():
+                db.add_stat(key, value)
+            self.chat_counts[index] = chats
+        elif kind == "broadcast":
+            self._send_all(message, exclude=index)
+    
+    async def run(self):
+        """Главный цикл супервизора"""
+        loop = asyncio.get_running_loop()
+        for index, conn in enumerate(self.conns):
+            loop.add_reader(conn.fileno(), self._on_readable, index)
+            self.outboxes.append(asyncio.Queue())
+            self._writers.append(asyncio.create_task(self._write(index)))
+        
+        print(f"🧩 Воркеров: {self.workers}")
+        print(f"📡 События: {'Callback API, порт ' + str(CALLBACK_PORT) if EVENTS_MODE == 'callback' else 'Long Poll'}")
+        
+        if METRICS_PORT:
+            await MetricsServer().start()
+        ingress = asyncio.create_task(self._ingress())
+        try:
+            while True:
+                await asyncio.sleep(JOURNAL_FLUSH_INTERVAL)
+                for index, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        raise RuntimeError(f"воркер {index} завершился (код {process.exitcode})")
+                self._send_all(("cluster", {
+                    "statistics": dict(db.sync_statistics()),
+                    "chats": sum(self.chat_counts)
+                }))
+                await db.flush_async()
+        finally:
+            ingress.cancel()
+            await self.stop()
+    
+    async def _ingress(self):
+        if EVENTS_MODE == "callback":
+            server = CallbackServer(self.route, workers=1)
+            await server.start()
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await server.stop()
+        else:
+            async for event in bot.polling.listen():
+                for update in event.get("updates", []):
+                    await self.route(update)
+    
+    async def stop(self):
+        """Остановить воркеры и сохранить общие данные"""
+        # Команда stop встаёт в конец очередей: воркеры получат всё, что уже принято
+        self._send_all(("stop",))
+        if self._writers:
+            await asyncio.wait(self._writers, timeout=30)
+            for writer in self._writers:
+                writer.cancel()
+        for process in self.processes:
+            process.join(timeout=30)
+        db.save()
+        logger.info(f"Супервизор остановлен, событий по воркерам: {self.routed}")
+
+# ============= БЕНЧМАРК =============
+
+# Вызов метода внутри кода execute: API.messages.send({...})
+EXECUTE_CALL_RE = re.compile(r"API\.([\w.]+)\(")
+# Вызов метода в описаниях категорий vkbottle_types: api.request("messages.send", ...)
+VK_REQUEST_RE = re.compile(r"request\(\s*\"([\w.]+)\"")
+
+# Тексты обычных сообщений синтетического трафика
+BENCH_PHRASES = (
+    "привет всем", "кто идёт вечером?", "ахах", "скиньте расписание",
+    "+", "да", "нет", "ок, понял", "спасибо!", "у кого есть конспект по матану?"
+)
+
+def bench_first_user(chat_id: int, users_per_chat: int) -> int:
+    """ID первого участника синтетического чата (он же владелец)"""
+    return 100000000 + chat_id * users_per_chat
+
+def bench_profile(user_id: int) -> Dict:
+    """Профиль пользователя в формате users.get"""
+    return {
+        "id": user_id,
+        "first_name": f"Пользователь{user_id % 10000}",
+        "last_name": "Тестовый",
+        "photo_50": "https://vk.com/images/camera_50.png",
+        "can_access_closed": True,
+        "is_closed": False
+    }
+
+def vk_method_names() -> frozenset:
+    """Имена настоящих методов VK API - из описаний категорий vkbottle_types"""
+    names = {"execute"}
+    for _, category in inspect.getmembers(APICategories, lambda member: isinstance(member, property)):
+        category_class = inspect.signature(category.fget).return_annotation
+        # Ручные дополнения vkbottle_types наследуют сгенерированные категории
+        for cls in getattr(category_class, "__mro__", ()):
+            if cls.__module__.startswith("vkbottle_types."):
+                names.update(VK_REQUEST_RE.findall(inspect.getsource(cls)))
+    return frozenset(names)
+
+def bench_ids(value) -> List[int]:
+    # Списки приходят строкой через запятую или списком - в зависимости от вызывающего кода
+    if isinstance(value, (list, tuple)):
+        return [int(item) for item in value]
+    return [int(item) for item in str(value).strip("[]").split(",") if item.strip()]
+
+
+class BenchVKClient(ABCHTTPClient):
+    """Заглушка HTTP-клиента VK API: правдоподобные ответы с заданной задержкой
+    
+    Подменяется на уровне HTTP, поэтому проверка запросов и разбор ответов
+    vkbottle работают как с настоящим VK. Неизвестные VK методы отклоняются
+    ошибкой 3, как это делает настоящий API, и попадают в unknown.
+    """
+    
+    def __init__(self, latency: float = BENCH_API_LATENCY, users_per_chat: int = BENCH_USERS_PER_CHAT):
+        self.latency = latency
+        self.users_per_chat = users_per_chat
+        self.methods = vk_method_names()
+        self.calls: Dict[str, int] = {}
+        self.unknown: Dict[str, int] = {}
+        self._message_id = 0
+    
+    def reply(self, method: str, data: Dict) -> Dict:
+        """Тело ответа на вызов метода: response или error"""
+        if method not in self.methods:
+            self.unknown[method] = self.unknown.get(method, 0) + 1
+            return {"error": {"error_code": 3, "error_msg": "Unknown method passed", "request_params": []}}
+        if method != "execute":
+            return {"response": self.respond(method, data)}
+        self.calls[method] = self.calls.get(method, 0) + 1
+        results, errors = [], []
+        for name in EXECUTE_CALL_RE.findall(data.get("code", "")):
+            # Упавший вызов внутри execute даёт false и описание в execute_errors
+            reply = self.reply(name, {})
+            if "error" in reply:
+                results.append(False)
+                errors.append(dict(reply["error"], method=name))
+            else:
+                results.append(reply["response"])
+        return {"response": results, "execute_errors": errors} if errors else {"response": results}
+    
+    def respond(self, method: str, data: Dict) -> Any:
+        """Поле response ответа на вызов известного метода"""
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "messages.send":
+            self._message_id += 1
+            if "peer_ids" in data:
+                return [{"peer_id": peer_id, "message_id": self._message_id}
+                        for peer_id in bench_ids(data["peer_ids"])]
+            return self._message_id
+        if method == "messages.getConversationMembers":
+            first = bench_first_user(int(data["peer_id"]) - 2000000000, self.users_per_chat)
+            return {
+                "count": self.users_per_chat,
+                "items": [{"member_id": user_id, "invited_by": first, "join_date": 0,
+                           "is_owner": user_id == first, "is_admin": user_id == first}
+                          for user_id in range(first, first + self.users_per_chat)],
+                "profiles": [],
+                "groups": []
+            }
+        if method == "users.get":
+            return [bench_profile(user_id) for user_id in bench_ids(data.get("user_ids", ""))]
+        if method == "messages.delete":
+            return {str(message_id): 1 for message_id in bench_ids(data.get("message_ids", ""))}
+        return 1
+    
+    async def request_json(self, url: str, method: str = "GET", data: Optional[Dict] = None, **kwargs) -> Dict:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.reply(url.rsplit("/", 1)[-1], data or {})
+    
+    async def request_text(self, url: str, method: str = "GET", data: Optional[Dict] = None, **kwargs) -> str:
+        return json.dumps(await self.request_json(url, method, data, **kwargs), ensure_ascii=False)
+    
+    async def request_raw(self, url: str, method: str = "GET", data: Optional[Dict] = None, **kwargs) -> str:
+        return await self.request_text(url, method, data, **kwargs)
+    
+    async def request_content(self, url: str, method: str = "GET", data: Optional[Dict] = None, **kwargs) -> bytes:
+        return (await self.request_text(url, method, data, **kwargs)).encode()
+    
+    async def close(self):
+        pass
+
+
+def populate_bench_database(database: "Database", chats: int, users_per_chat: int = BENCH_USERS_PER_CHAT,
+                            banned_share: float = BENCH_BANNED_SHARE, muted_share: float = BENCH_MUTED_SHARE):
+    """Заполнить базу синтетическими чатами с активностью, банами и мутами"""
+    now = time.time()
+    banned = int(users_per_chat * banned_share)
+    muted = int(users_per_chat * muted_share)
+    for chat_id in range(1, chats + 1):
+        chat_data = database.init_chat(chat_id)
+        first = bench_first_user(chat_id, users_per_chat)
+        activity = chat_data["activity"]
+        for user_id in range(first, first + users_per_chat):
+            activity["unity_scores"][user_id] = random.randint(1, 5000)
+            activity["last_messages"][user_id] = int(now) - random.randint(0, 86400)
+        # Владелец - первый участник, санкции получают следующие за ним
+        moderation = chat_data["moderation"]
+        moderation["bans"].update(range(first + 1, first + 1 + banned))
+        for user_id in range(first + 1 + banned, first + 1 + banned + muted):
+            moderation["mutes"][user_id] = now + 86400
+        database.update_chat(chat_id, chat_data)
+
+def bench_traffic(count: int, chats: int = BENCH_CHATS, users_per_chat: int = BENCH_USERS_PER_CHAT,
+                  command_share: float = BENCH_COMMAND_SHARE, seed: int = 1):
+    """Синтетические события message_new
+    
+    Нагрузка по чатам неравномерная, как в жизни: вес чата обратно
+    пропорционален его номеру. Команды модерации отправляет владелец чата.
+    """
+    rng = random.Random(seed)
+    chat_ids = rng.choices(range(1, chats + 1), weights=[1 / rank for rank in range(1, chats + 1)], k=count)
+    for message_id, chat_id in enumerate(chat_ids, 1):
+        first = bench_first_user(chat_id, users_per_chat)
+        if rng.random() < command_share:
+            target_id = first + rng.randrange(1, users_per_chat)
+            from_id = first
+            text = rng.choice((
+                f"/warn [id{target_id}|участник] флуд",
+                f"/mute [id{target_id}|участник] 15m спам",
+                f"/ban [id{target_id}|участник] реклама"
+            ))
+        else:
+            from_id = first + rng.randrange(users_per_chat)
+            text = rng.choice(BENCH_PHRASES)
+        yield stub_message_event(2000000000 + chat_id, from_id, text, message_id)
+
+def peak_rss_mb() -> float:
+    """Пиковая память процесса в МБ (0, если недоступно)"""
+    if resource is None:
+        return 0.0
+    # В Linux ru_maxrss - в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def percentile(sorted_values, share: float) -> float:
+    """Значение, ниже которого лежит доля share отсортированных замеров"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(share * len(sorted_values)))]
+
+async def run_benchmark(count: int, chats: int = BENCH_CHATS, users_per_chat: int = BENCH_USERS_PER_CHAT,
+                        db_chats: int = BENCH_DB_CHATS, rate: float = BENCH_RATE,
+                        latency: float = BENCH_API_LATENCY) -> Dict[str, Any]:
+    """Прогнать count сообщений через очереди событий и обработчики бота, вернуть замеры"""
+    global db, bot
+    data_folder = tempfile.mkdtemp(prefix="grand_bench_")
+    client = BenchVKClient(latency, users_per_chat)
+    bot = Bot(api=InstrumentedAPI("bench", http_client=client), labeler=labeler)
+    results: Dict[str, Any] = {
+        "count": count, "chats": chats, "db_chats": max(db_chats, chats),
+        "latency": latency, "backend": STORAGE_BACKEND
+    }
+    
+    try:
+        started = time.perf_counter()
+        db = Database(create_storage(data_folder))
+        populate_bench_database(db, results["db_chats"], users_per_chat)
+        db.save()
+        results["prepare"] = time.perf_counter() - started
+        results["rss_before"] = peak_rss_mb()
+        mute_scheduler.load(db)
+        asyncio.create_task(mute_scheduler.run())
+        
+        handler_times = array('d')
+        
+        async def timed_event(event: Dict):
+            begun = time.perf_counter()
+            await process_vk_event(event)
+            handler_times.append(time.perf_counter() - begun)
+        
+        scheduler = EventScheduler(timed_event)
+        scheduler.start()
+        started = time.perf_counter()
+        for i, event in enumerate(bench_traffic(count, chats, users_per_chat)):
+            if rate:
+                delay = started + i / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await scheduler.submit(event)
+        while scheduler.processed + scheduler.dropped < count:
+            await asyncio.sleep(0.005)
+        results["elapsed"] = time.perf_counter() - started
+        results["processed"] = scheduler.processed
+        results["dropped"] = scheduler.dropped
+        
+        # Дожидаемся последних пачек вызовов API
+        await asyncio.sleep(API_BATCH_WINDOW)
+        while background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+        
+        handler_times = sorted(handler_times)
+        results["p50"] = percentile(handler_times, 0.5)
+        results["p99"] = percentile(handler_times, 0.99)
+        results["max"] = handler_times[-1] if handler_times else 0.0
+        
+        started = time.perf_counter()
+        activity_aggregator.rollup()
+        results["rollup"] = time.perf_counter() - started
+        started = time.perf_counter()
+        db.flush()
+        results["flush"] = time.perf_counter() - started
+        started = time.perf_counter()
+        db.save()
+        results["snapshot"] = time.perf_counter() - started
+        results["rss_after"] = peak_rss_mb()
+        results["api_calls"] = dict(sorted(client.calls.items(), key=lambda item: -item[1]))
+        results["unknown_methods"] = dict(client.unknown)
+    finally:
+        db.close()
+        shutil.rmtree(data_folder, ignore_errors=True)
+    return results
+
+def bench_disk_chat(chat_id: int, users_per_chat: int = BENCH_USERS_PER_CHAT,
+                    days: int = BENCH_HISTORY_DAYS) -> Dict:
+    """Синтетический чат в формате файла: активность, история по суткам, предупреждения"""
+    now = int(time.time())
+    first = bench_first_user(chat_id, users_per_chat)
+    user_ids = range(first, first + users_per_chat)
+    today = datetime.date.today()
+    return {
+        "info": {"title": f"Чат {chat_id}", "created": now - 86400 * 30, "last_active": now,
+                 "message_count": random.randint(1000, 100000), "user_count": users_per_chat},
+        "moderation": {"bans": [], "mutes": {}, "warns": {user_id: 1 for user_id in user_ids[1:4]}, "kicks": []},
+        "users": {"nicknames": {}, "roles": {}, "profiles": {}},
+        "settings": {},
+        "custom_commands": {},
+        "pinned_messages": [],
+        "welcome_stats": {"total_welcomed": 0, "last_welcome": None},
+        "economy": {"enabled": False, "currency": "₽", "users_balance": {}},
+        "activity": {
+            "unity_scores": {user_id: random.randint(1, 5000) for user_id in user_ids},
+            "last_messages": {user_id: now - random.randint(0, 86400 * days) for user_id in user_ids},
+            "daily_stats": {
+                (today - datetime.timedelta(days=day)).isoformat(): {
+                    "messages": random.randint(100, 5000),
+                    "hours": [random.randint(0, 300) for _ in range(24)],
+                    "users": {user_id: random.randint(1, 300)
+                              for user_id in random.sample(user_ids, users_per_chat // 3)}
+                }
+                for day in range(days)
+            }
+        }
+    }
+
+def run_memory_benchmark(chats: int, users_per_chat: int = BENCH_USERS_PER_CHAT,
+                         days: int = BENCH_HISTORY_DAYS) -> Dict[str, Any]:
+    """Память чатов в памяти бота: словари формата файла против записей"""
+    blobs = [pickle.dumps(bench_disk_chat(chat_id, users_per_chat, days)) for chat_id in range(1, chats + 1)]
+    
+    def traced(convert) -> Tuple[int, List[Dict]]:
+        gc.collect()
+        tracemalloc.start()
+        loaded = [convert(pickle.loads(blob)) for blob in blobs]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size, loaded
+    
+    dict_bytes, _ = traced(lambda chat: chat)
+    record_bytes, records = traced(chat_from_disk)
+    # Обратное преобразование должно дать в точности исходные данные
+    lossless = all(chat_to_disk(chat) == pickle.loads(blob) for chat, blob in zip(records, blobs))
+    return {"chats": chats, "users_per_chat": users_per_chat, "days": days,
+            "dict_bytes": dict_bytes, "record_bytes": record_bytes, "lossless": lossless}
+
+def format_memory_benchmark(results: Dict[str, Any]) -> str:
+    """Отчёт бенчмарка памяти для консоли"""
+    chats = results["chats"]
+    saved = 1 - results["record_bytes"] / results["dict_bytes"]
+    return (
+        f"🧠 Память: {chats} чатов по {results['users_per_chat']} участников, "
+        f"история {results['days']} сут.\n"
+        f"📦 Словари: {results['dict_bytes'] / chats / 1024:.1f} КБ на чат, "
+        f"{results['dict_bytes'] / 1024 / 1024:.1f} МБ всего\n"
+        f"🧱 Записи: {results['record_bytes'] / chats / 1024:.1f} КБ на чат, "
+        f"{results['record_bytes'] / 1024 / 1024:.1f} МБ всего (-{saved:.0%})\n"
+        f"🔁 Обратное преобразование без потерь: {'да' if results['lossless'] else 'НЕТ'}"
+    )
+
+def format_benchmark(results: Dict[str, Any]) -> str:
+    """Отчёт бенчмарка для консоли"""
+    api_calls = ", ".join(f"{method} {calls}" for method, calls in results["api_calls"].items())
+    return (
+        f"📊 Бенчмарк: {results['count']} сообщений, {results['chats']} чатов с трафиком, "
+        f"{results['db_chats']} в базе ({results['backend']}), задержка API {results['latency'] * 1000:.0f} мс\n"
+        f"🏗 Подготовка базы: {results['prepare']:.2f} с\n"
+        f"⚡ Пропускная способность: {results['processed'] / results['elapsed']:.0f} сообщений/с "
+        f"(обработано {results['processed']}, выброшено {results['dropped']} за {results['elapsed']:.2f} с)\n"
+        f"⏱ Обработчик: p50 {results['p50'] * 1000:.2f} мс, p99 {results['p99'] * 1000:.2f} мс, "
+        f"максимум {results['max'] * 1000:.1f} мс\n"
+        f"💾 Сохранение: перенос активности {results['rollup'] * 1000:.1f} мс, "
+        f"журнал {results['flush'] * 1000:.1f} мс, снимок {results['snapshot'] * 1000:.1f} мс\n"
+        f"🧠 Память (пик): {results['rss_before']:.0f} МБ до нагрузки, {results['rss_after']:.0f} МБ после\n"
+        f"📡 Вызовы API: {api_calls}"
+        + "".join(f"\n⛔ Неизвестный метод VK API: {method} ({calls} вызовов)"
+                  for method, calls in results["unknown_methods"].items())
+    )
+
 # ============= ЗАПУСК И УТИЛИТЫ =============
 
+async def auto_export():
+    """Периодический экспорт изменённых чатов в JSON"""
+    while True:
+        await asyncio.sleep(JSON_EXPORT_INTERVAL)
+        try:
+            await json_exporter.export()
+        except Exception as e:
+            logger.error(f"❌ Ошибка экспорта: {e}")
+
 async def auto_save():
-    """Автосохранение каждые 5 минут"""
+    """Групповой сброс журнала, перенос активности и периодический полный снимок"""
+    last_snapshot = time.monotonic()
+    last_rollup = time.monotonic()
     while True:
-        await asyncio.sleep(300)  # 5 минут
+        await asyncio.sleep(JOURNAL_FLUSH_INTERVAL)
         try:
-            db.save()
-            logger.info("✅ Автосохранение выполнено")
+            if time.monotonic() - last_rollup >= ACTIVITY_ROLLUP_INTERVAL:
+                activity_aggregator.rollup()
+                last_rollup = time.monotonic()
+            if time.monotonic() - last_snapshot >= SNAPSHOT_INTERVAL:
+                await db.save_async()
+                last_snapshot = time.monotonic()
+                logger.info("✅ Автосохранение выполнено")
+            else:
+                await db.flush_async()
+            if db.evict_idle():
+                leaderboards.forget_unloaded()
+            anti_flood.sweep()
         except Exception as e:
             logger.error(f"❌ Ошибка автосохранения: {e}")
 
@@ -1581,10 +5452,14 @@ async def main():
         print("Получить токен: Управление сообществом → Работа с API")
         return
     
+    # Запуск по фазам: логирование, индекс базы, клиент VK; чаты загружаются по требованию
+    app.start()
+    
     print(f"✅ Токен: Установлен")
     print(f"📁 Данные: {DATA_FOLDER}/")
-    print(f"📊 Чатов: {len(db.data['chats'])}")
-    print(f"🔄 Команд: {len(labeler.message_view.handlers)}")
+    print(f"📡 События: {'Callback API, порт ' + str(CALLBACK_PORT) if EVENTS_MODE == 'callback' else 'Long Poll'}")
+    print(f"📊 Чатов: {db.chat_count()}")
+    print(f"🔄 Команд: {len(command_router.handlers)}")
     print("=" * 50)
     print("🚀 Бот запускается...")
     print("ℹ️ Добавляйте бота в беседы и используйте /help")
@@ -1593,25 +5468,140 @@ async def main():
     # Запускаем автосохранение
     asyncio.create_task(auto_save())
     
+    if JSON_EXPORT_INTERVAL > 0:
+        asyncio.create_task(auto_export())
+    
+    # Запускаем снятие мутов по сроку
+    app.timed("индекс мутов", lambda: mute_scheduler.load(db))
+    asyncio.create_task(mute_scheduler.run())
+    
+    if METRICS_PORT:
+        await MetricsServer().start()
+    asyncio.create_task(loop_watchdog.run())
+    if PROFILE_ON_START:
+        profiler.start(PROFILE_ON_START)
+    logger.info(f"⏱ Готов к работе за {app.report()}")
+    
     # Запускаем бота
-    bot.labeler = labeler
     try:
-        await bot.run_polling()
-    except KeyboardInterrupt:
-        print("\n🛑 Остановка бота...")
-        db.save()
-        print("💾 Данные сохранены")
-        print("👋 До свидания!")
+        event_scheduler.start()
+        if EVENTS_MODE == "callback":
+            server = CallbackServer(event_scheduler.submit)
+            await server.start()
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await server.stop()
+        else:
+            await poll_events()
     except Exception as e:
+        # Данные сохраняет app.stop() при выходе из run_until_stopped
         print(f"❌ Критическая ошибка: {e}")
-        db.save()
         raise
 
+def run_until_stopped(coro):
+    """asyncio.run, который SIGTERM останавливает так же, как Ctrl-C
+    
+    На Ctrl-C asyncio сам отменяет главную задачу и поднимает KeyboardInterrupt
+    уже после выхода из цикла. SIGTERM по умолчанию убивает процесс сразу -
+    здесь он тоже отменяет главную задачу, чтобы отработали блоки finally.
+    """
+    async def guarded():
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except (NotImplementedError, RuntimeError):
+            # Windows или не главный поток
+            pass
+        return await coro
+    
+    try:
+        return asyncio.run(guarded())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        print("\n🛑 Остановка...")
+
 if __name__ == "__main__":
     # Проверка зависимостей
     if not VKBOTTLE_AVAILABLE:
         print("Установите vkbottle: pip install vkbottle")
         exit(1)
     
+    parser = argparse.ArgumentParser(description="GRAND: чат-менеджер для ВКонтакте")
+    parser.add_argument("--export", nargs="?", const="all", metavar="CHAT_ID",
+                        help="выгрузить базу (или один чат) в JSON и выйти")
+    parser.add_argument("--mode", choices=["polling", "callback"],
+                        help="способ получения событий (по умолчанию EVENTS_MODE)")
+    parser.add_argument("--stub-events", type=int, metavar="COUNT",
+                        help="отправить COUNT тестовых событий на Callback-сервер и выйти")
+    parser.add_argument("--callback-url", default=f"http://127.0.0.1:{CALLBACK_PORT}{CALLBACK_PATH}",
+                        help="адрес Callback-сервера для --stub-events")
+    parser.add_argument("--workers", type=int, metavar="N",
+                        help="запустить N процессов-воркеров (по умолчанию WORKER_PROCESSES)")
+    parser.add_argument("--bench", type=int, metavar="COUNT",
+                        help="прогнать COUNT синтетических сообщений с заглушкой VK API и выйти")
+    parser.add_argument("--bench-chats", type=int, default=BENCH_CHATS, metavar="N",
+                        help="чатов с трафиком для --bench")
+    parser.add_argument("--bench-db-chats", type=int, default=BENCH_DB_CHATS, metavar="N",
+                        help="чатов в базе для --bench")
+    parser.add_argument("--bench-rate", type=float, default=BENCH_RATE, metavar="N",
+                        help="сообщений в секунду для --bench (0 - без ограничения)")
+    parser.add_argument("--bench-latency", type=float, default=BENCH_API_LATENCY, metavar="SEC",
+                        help="задержка ответа заглушки VK API для --bench")
+    parser.add_argument("--bench-memory", type=int, metavar="CHATS",
+                        help="сравнить память CHATS синтетических чатов в словарях и записях и выйти")
+    cli_args = parser.parse_args()
+    
+    if cli_args.bench_memory:
+        print(format_memory_benchmark(run_memory_benchmark(cli_args.bench_memory)))
+        exit(0)
+    
+    if cli_args.bench:
+        # Только предупреждения: журнал не должен влиять на замеры
+        logging.basicConfig(level=logging.WARNING,
+                            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        results = asyncio.run(run_benchmark(
+            cli_args.bench, chats=cli_args.bench_chats, db_chats=cli_args.bench_db_chats,
+            rate=cli_args.bench_rate, latency=cli_args.bench_latency
+        ))
+        print(format_benchmark(results))
+        # Вызов несуществующего метода - ошибка контракта с VK, а не шум бенчмарка
+        exit(1 if results["unknown_methods"] else 0)
+    
+    if cli_args.stub_events:
+        results = asyncio.run(send_stub_events(cli_args.callback_url, cli_args.stub_events))
+        print(f"📨 Ответы сервера: {results}")
+        exit(0)
+    
+    if cli_args.mode:
+        EVENTS_MODE = cli_args.mode
+    if cli_args.workers is not None:
+        WORKER_PROCESSES = cli_args.workers
+    
+    if WORKER_PROCESSES > 0:
+        app.start()
+        supervisor = Supervisor(WORKER_PROCESSES)
+        # Воркеры создаются через fork до запуска цикла событий
+        supervisor.start_workers()
+        try:
+            # Воркеры сохраняются сами по команде stop из Supervisor.stop()
+            run_until_stopped(supervisor.run())
+        finally:
+            app.stop()
+        exit(0)
+    
+    if cli_args.export:
+        app.start()
+        chat_id = None if cli_args.export == "all" else int(cli_args.export)
+        try:
+            exported, skipped = asyncio.run(json_exporter.export(chat_id, force=chat_id is not None))
+        finally:
+            # Записать снятые отметки export_pending
+            app.stop()
+        print(f"📤 Экспорт в {JSON_EXPORT_FOLDER}/: записано {exported}, без изменений {skipped}")
+        exit(0)
+    
     # Запуск бота
-    asyncio.run(main())
+    try:
+        run_until_stopped(main())
+    finally:
+        app.stop()
+        print("👋 До свидания!")
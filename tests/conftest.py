@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class FakeClock:
+    """Часы для main.time: monotonic() и time() двигаются только вручную"""
+    
+    def __init__(self):
+        self.now = 1000.0
+    
+    def monotonic(self) -> float:
+        return self.now
+    
+    def time(self) -> float:
+        return self.now
+    
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    # Подменяем модуль time только внутри main - цикл событий asyncio не затрагивается
+    patched = types.SimpleNamespace(**vars(time))
+    patched.monotonic = fake.monotonic
+    patched.time = fake.time
+    monkeypatch.setattr(main, "time", patched)
+    return fake
+
+
+@pytest.fixture
+def database(monkeypatch, tmp_path):
+    """Пустая база в SQLite во временной папке, подставленная в main.db"""
+    value = main.Database(main.SQLiteStorage(str(tmp_path)))
+    # Через словарь модуля: getattr(main, "db") создал бы настоящую базу в DATA_FOLDER
+    monkeypatch.setitem(vars(main), "db", value)
+    yield value
+    value.close()
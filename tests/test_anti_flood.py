@@ -0,0 +1,55 @@
+import main
+
+SETTINGS = {"flood_messages": 3, "flood_seconds": 5}
+
+
+def send(anti_flood, clock, offsets, user_id=1, settings=SETTINGS):
+    """Сообщения в моменты offsets от текущего времени; результат hit() по каждому"""
+    start = clock.now
+    results = []
+    for offset in offsets:
+        clock.now = start + offset
+        results.append(anti_flood.hit(10, user_id, settings))
+    return results
+
+
+def test_first_messages_never_flood(clock):
+    assert send(main.AntiFlood(), clock, [0, 0]) == [False, False]
+
+
+def test_n_messages_inside_window_flood(clock):
+    assert send(main.AntiFlood(), clock, [0, 1, 4.99]) == [False, False, True]
+
+
+def test_window_boundary_is_exclusive(clock):
+    # Третье сообщение ровно через flood_seconds после первого - уже не флуд
+    assert send(main.AntiFlood(), clock, [0, 1, 5]) == [False, False, False]
+
+
+def test_window_slides(clock):
+    # Каждое сообщение сравнивается с N-1 предыдущим, а не с первым в серии
+    assert send(main.AntiFlood(), clock, [0, 3, 6, 8, 9]) == [False, False, False, False, True]
+
+
+def test_users_are_counted_separately(clock):
+    anti_flood = main.AntiFlood()
+    assert send(anti_flood, clock, [0, 1], user_id=1) == [False, False]
+    assert send(anti_flood, clock, [0], user_id=2) == [False]
+    assert send(anti_flood, clock, [0], user_id=1) == [True]
+
+
+def test_reset_clears_window(clock):
+    anti_flood = main.AntiFlood()
+    send(anti_flood, clock, [0, 1])
+    anti_flood.reset(10, 1)
+    assert send(anti_flood, clock, [0]) == [False]
+
+
+def test_sweep_forgets_quiet_users(clock):
+    anti_flood = main.AntiFlood()
+    send(anti_flood, clock, [0], user_id=1)
+    clock.advance(main.FLOOD_FORGET_AFTER)
+    send(anti_flood, clock, [0], user_id=2)
+    clock.advance(1)
+    assert anti_flood.sweep() == 1
+    assert list(anti_flood._windows[10]) == [2]
@@ -0,0 +1,35 @@
+from collections import deque
+
+import main
+
+
+def test_evict_idle_skips_busy_and_dirty_chats(monkeypatch, clock, database):
+    monkeypatch.setattr(main, "CHAT_IDLE_EVICT", 60)
+    for chat_id in (1, 2, 3):
+        database.init_chat(chat_id)["custom_commands"]["hi"] = f"chat {chat_id}"
+    database.save()
+    
+    # У чата 2 есть событие в очереди, чат 3 изменён после записи
+    monkeypatch.setitem(main.event_scheduler._queues, 2000000002, deque())
+    database.mark_chat_dirty(3)
+    clock.advance(61)
+    
+    assert database.evict_idle() == 1
+    assert sorted(database.data["chats"]) == ["2", "3"]
+    
+    # Очередь разобрана и чат записан - выгружаются на следующем проходе
+    del main.event_scheduler._queues[2000000002]
+    database.save()
+    assert database.evict_idle() == 2
+    assert database.data["chats"] == {}
+    
+    assert database.get_chat(2)["custom_commands"]["hi"] == "chat 2"
+
+
+def test_evict_idle_keeps_recent_chats(monkeypatch, clock, database):
+    monkeypatch.setattr(main, "CHAT_IDLE_EVICT", 60)
+    database.init_chat(1)
+    database.save()
+    clock.advance(30)
+    assert database.evict_idle() == 0
+    assert "1" in database.data["chats"]
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+class FetchError(Exception):
+    pass
+
+
+def make_cache(monkeypatch, results):
+    """MemberCache, у которого запрос к API заменён очередью ответов"""
+    cache = main.MemberCache(ttl=60, error_ttl=30, max_size=10)
+    calls = []
+    
+    async def fake_fetch(chat_id):
+        calls.append(chat_id)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return main.ConversationMembers(result)
+    
+    monkeypatch.setattr(cache, "_fetch", fake_fetch)
+    return cache, calls
+
+
+def test_failure_is_cached_until_error_ttl(monkeypatch, clock):
+    cache, calls = make_cache(monkeypatch, [FetchError("not admin"), []])
+    
+    async def scenario():
+        with pytest.raises(FetchError):
+            await cache.get(5)
+        clock.advance(29)
+        with pytest.raises(FetchError):
+            await cache.get(5)
+        assert calls == [5]
+        
+        clock.advance(1)
+        await cache.get(5)
+        assert calls == [5, 5]
+        assert 5 not in cache._failures
+    
+    asyncio.run(scenario())
+
+
+def test_expired_failures_are_pruned(monkeypatch, clock):
+    cache, calls = make_cache(monkeypatch, [FetchError("not admin"), []])
+    
+    async def scenario():
+        with pytest.raises(FetchError):
+            await cache.get(1)
+        clock.advance(30)
+        # Устаревшие ошибки убираются при следующем сохранении в кэш
+        await cache.get(2)
+        assert list(cache._failures) == []
+        assert list(cache._entries) == [2]
+    
+    asyncio.run(scenario())
+
+
+def test_invalidate_drops_cached_failure(monkeypatch, clock):
+    cache, calls = make_cache(monkeypatch, [FetchError("not admin"), []])
+    
+    async def scenario():
+        with pytest.raises(FetchError):
+            await cache.get(7)
+        cache.invalidate(7)
+        await cache.get(7)
+        assert calls == [7, 7]
+    
+    asyncio.run(scenario())
@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+import main
+
+CHAT_ID = 42
+
+
+async def run_scheduler(scheduler, seconds):
+    task = asyncio.create_task(scheduler.run())
+    await asyncio.sleep(seconds)
+    task.cancel()
+
+
+def mute(database, scheduler, user_id, until):
+    database.get_chat(CHAT_ID)["moderation"]["mutes"][user_id] = until
+    scheduler.schedule(CHAT_ID, user_id, until)
+
+
+def test_expired_mute_is_lifted(database):
+    database.init_chat(CHAT_ID)
+    
+    async def scenario():
+        scheduler = main.MuteScheduler()
+        mute(database, scheduler, 1, time.time() + 0.05)
+        await run_scheduler(scheduler, 0.3)
+    
+    asyncio.run(scenario())
+    assert 1 not in database.get_chat(CHAT_ID)["moderation"]["mutes"]
+
+
+def test_extended_mute_survives_old_deadline(database):
+    database.init_chat(CHAT_ID)
+    
+    async def scenario():
+        scheduler = main.MuteScheduler()
+        mute(database, scheduler, 1, time.time() + 0.05)
+        extended = time.time() + 60
+        mute(database, scheduler, 1, extended)
+        await run_scheduler(scheduler, 0.3)
+        return scheduler, extended
+    
+    scheduler, extended = asyncio.run(scenario())
+    assert database.get_chat(CHAT_ID)["moderation"]["mutes"][1] == extended
+    # В куче остался только новый срок
+    assert scheduler._heap == [(extended, CHAT_ID, 1)]
+
+
+def test_cancelled_mute_is_not_touched(database):
+    database.init_chat(CHAT_ID)
+    
+    async def scenario():
+        scheduler = main.MuteScheduler()
+        mute(database, scheduler, 1, time.time() + 0.05)
+        # Снят вручную (/unmute) до срока
+        del database.get_chat(CHAT_ID)["moderation"]["mutes"][1]
+        database.save()
+        await run_scheduler(scheduler, 0.3)
+        return scheduler
+    
+    scheduler = asyncio.run(scenario())
+    assert database.get_chat(CHAT_ID)["moderation"]["mutes"] == {}
+    assert scheduler._heap == []
+    # Устаревшая запись кучи не помечает чат изменённым
+    assert str(CHAT_ID) not in database._dirty_chats
+
+
+def test_global_mute_is_lifted_only_at_current_deadline(database):
+    database.global_mute(7, time.time() + 60)
+    scheduler = main.MuteScheduler()
+    stale = time.time() - 1
+    scheduler._expire(main.GLOBAL_MUTE_CHAT, 7, stale)
+    assert 7 in database.data["global_mutes"]
+    
+    scheduler._expire(main.GLOBAL_MUTE_CHAT, 7, database.data["global_mutes"][7])
+    assert 7 not in database.data["global_mutes"]